@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import copy
+import datetime
+import json
+import os
+
+import log
+import utils
+from pollsters import Samples
+
+
+logger = log.get_logger(__name__)
+
+
+def _format_timestamp(timestamp):
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _parse_timestamp(timestamp):
+    return datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def dump_samples(samples):
+    return {
+        'samples': list({
+            'timestamp': _format_timestamp(s['timestamp']),
+            'value': s['value'],
+        } for s in samples),
+        'last_value': samples.last_value,
+        'delta': samples.delta,
+        'last_timestamp': (_format_timestamp(samples.last_timestamp)
+                           if samples.last_timestamp else None),
+        'max_gap': samples.max_gap,
+    }
+
+
+def load_samples(data):
+    samples = Samples({
+        'timestamp': _parse_timestamp(s['timestamp']),
+        'value': s['value'],
+    } for s in data['samples'])
+    samples.last_value = data['last_value']
+    samples.delta = data['delta']
+    if data['last_timestamp']:
+        samples.last_timestamp = _parse_timestamp(data['last_timestamp'])
+    samples.max_gap = data['max_gap']
+    return samples
+
+
+class Accumulator(object):
+    """ The partial state of the open periods, as measured by
+    MongoCeilometerPollster.
+
+    For each meter and project, the folded samples of each resource
+    in the current period are kept, so that every measure only
+    fetches the samples newer than the previous one. The state is
+    saved as JSON to __path__, so a restart doesn't need to measure
+    the whole period again.
+    """
+
+    path = None
+
+    def __init__(self, path):
+        self.path = path
+        self._state = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except ValueError as e:
+            logger.warn("Discarding corrupted state {path}: {e}"
+                        .format(path=self.path, e=e))
+            return {}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # write and rename, so that a crash doesn't leave a partial
+        # state behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._state, f)
+        os.rename(tmp_path, self.path)
+
+    @staticmethod
+    def _key(pollster):
+        return "{meter}/{project}".format(meter=pollster.counter_name,
+                                          project=pollster.project_id)
+
+    def _prune(self, end):
+        """ Drop the state of the periods ended before __end__, also
+        of the meters and projects not measured anymore. """
+
+        for key, state in list(self._state.items()):
+            if utils.parse_date(state['period'][1]) < end:
+                del self._state[key]
+
+    def measure(self, pollster):
+        """ Measure the period of __pollster__, resuming from the last
+        measure of the same period. """
+
+        key = self._key(pollster)
+        period = [utils.format_date(pollster.start),
+                  utils.format_date(pollster.end)]
+
+        # only the open period is kept: the state of a previous one
+        # is dropped
+        self._prune(pollster.end)
+        state = self._state.get(key)
+        if state is not None and state['period'] != period:
+            state = None
+
+        if state is None:
+            grouped_samples = {}
+        else:
+            grouped_samples = dict((r, load_samples(s))
+                                   for r, s in state['resources'].items())
+
+        resources = pollster.find_resources()
+        full_margin = pollster.ceilometer_polling_period
+
+        # the resources without samples yet are fetched as new ones
+        known = set(r for r in resources
+                    if r in grouped_samples
+                    and grouped_samples[r].last_timestamp)
+        new = list(r for r in resources if r not in known)
+        known = list(r for r in resources if r in known)
+
+        if new:
+            pollster.find_samples(new, pollster.samples_pipeline(full_margin),
+                                  grouped_samples=grouped_samples)
+
+        if known:
+            # samples may be stored late, so we look back one polling
+            # period from the resource lagging the most: the ones
+            # already folded are skipped by find_samples()
+            since = (min(grouped_samples[r].last_timestamp for r in known)
+                     - datetime.timedelta(seconds=full_margin))
+            pollster.find_samples(known,
+                                  pollster.samples_pipeline(full_margin,
+                                                            since=since),
+                                  grouped_samples=grouped_samples)
+
+        logger.debug("Accumulated {n} new and {k} known resources of "
+                     "{meter} for project {id}"
+                     .format(n=len(new), k=len(known),
+                             meter=pollster.counter_name,
+                             id=pollster.project_id))
+
+        if not any(s.last_timestamp for s in grouped_samples.values()):
+            self._state.pop(key, None)
+        else:
+            self._state[key] = {
+                'period': period,
+                'resources': dict((r, dump_samples(s))
+                                  for r, s in grouped_samples.items()),
+            }
+
+        # aggregate_resource() modifies the samples
+        return pollster.aggregate_resources(resources,
+                                            copy.deepcopy(grouped_samples))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import operator
+import threading
+
+
+class Aggregator(object):
+    """ Combines the samples of the members of groups (e.g. the
+    projects of a domain) into one sample for each group, tagged with
+    __tag_key__.
+
+    __groups__ maps each member to the list of its groups. The total
+    of a group for a window is complete only when all of its members
+    added their samples for that window (even no samples at all), so
+    that partial totals are never written.
+    """
+
+    def __init__(self, tag_key, groups, combine=operator.add):
+        self.tag_key = tag_key
+        self.combine = combine
+
+        self._groups = dict((m, list(g)) for m, g in groups.items())
+        self._sizes = {}
+        for groups in self._groups.values():
+            for group in groups:
+                self._sizes[group] = self._sizes.get(group, 0) + 1
+
+        # indexed by (group, window)
+        self._members = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, member, window, values):
+        """ Add the (metric_name, value) __values__ of __member__ for
+        __window__, any hashable identifying the sample (e.g. its
+        period and timestamp). """
+
+        values = list(values)
+        with self._lock:
+            for group in self._groups.get(member, []):
+                key = (group, window)
+                self._members.setdefault(key, set()).add(member)
+
+                totals = self._values.setdefault(key, {})
+                for metric_name, value in values:
+                    if metric_name in totals:
+                        value = self.combine(totals[metric_name], value)
+                    totals[metric_name] = value
+
+    def totals(self):
+        """ The complete totals, as (tags, window, metric_name, value)
+        tuples. """
+
+        ret = []
+        with self._lock:
+            for (group, window), members in sorted(self._members.items()):
+                if len(members) < self._sizes[group]:
+                    continue
+
+                tags = [{'key': self.tag_key, 'value': group}]
+                totals = self._values[(group, window)]
+                for metric_name, value in sorted(totals.items()):
+                    ret.append((tags, window, metric_name, value))
+        return ret
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import datetime
+import os
+import sqlite3
+import time
+
+import cfg
+import log
+import utils
+
+
+logger = log.get_logger(__name__)
+
+
+def split(start, end, period, chunk):
+    """ Split the time range between __start__ and __end__ in chunks
+    of __chunk__ seconds, aligned to __period__.
+
+    Each chunk is a (start, end) tuple, such that the samples in
+    [start, end) of consecutive chunks don't overlap.
+    """
+
+    chunk = max(period, int(chunk // period) * period)
+    d = (start - utils.EPOCH).total_seconds()
+    current = utils.EPOCH + datetime.timedelta(seconds=period * (d // period))
+
+    chunks = []
+    while current < end:
+        chunk_end = min(end, current + datetime.timedelta(seconds=chunk))
+        chunks.append((current, chunk_end))
+        current = chunk_end
+    return chunks
+
+
+class Ledger(object):
+    """ Keeps the work units of a backfill which are done, in a SQLite
+    database, so that an interrupted backfill can be resumed.
+
+    __path__ defaults to state_dir/backfill.sqlite.
+    """
+
+    def __init__(self, path=None):
+        if not path:
+            path = os.path.join(cfg.STATE_DIR, 'backfill.sqlite')
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS units ("
+            "key TEXT PRIMARY KEY, "
+            "done_at REAL NOT NULL)")
+
+    def done(self, key):
+        self._connection.execute(
+            "INSERT OR REPLACE INTO units (key, done_at) VALUES (?, ?)",
+            (key, time.time()))
+
+    def done_all(self, keys):
+        now = time.time()
+        self._connection.execute("BEGIN")
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO units (key, done_at) VALUES (?, ?)",
+            ((key, now) for key in keys))
+        self._connection.execute("COMMIT")
+
+    def is_done(self, key):
+        row = self._connection.execute(
+            "SELECT 1 FROM units WHERE key = ?", (key, )).fetchone()
+        return row is not None
+
+    def clear(self):
+        self._connection.execute("DELETE FROM units")
+
+    def close(self):
+        self._connection.close()
+
+
+class Progress(object):
+    """ Logs the throughput and the ETA of __total__ work units. """
+
+    def __init__(self, total, now=None):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self._t0 = now if now is not None else time.time()
+
+    def update(self, failed=False, now=None):
+        if failed:
+            self.failed += 1
+        else:
+            self.done += 1
+
+        if now is None:
+            now = time.time()
+        elapsed = now - self._t0
+        completed = self.done + self.failed
+
+        rate = float(completed) / elapsed if elapsed > 0 else 0.0
+        eta = (self.total - completed) / rate if rate > 0 else None
+
+        logger.info("Backfilled {n}/{total} units ({failed} failed), "
+                    "{rate:.2f} units/s, ETA {eta}"
+                    .format(n=self.done, total=self.total,
+                            failed=self.failed, rate=rate,
+                            eta=(datetime.timedelta(seconds=int(eta))
+                                 if eta is not None else 'unknown')))
+        return rate, eta
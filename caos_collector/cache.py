@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import collections
+import threading
+import time
+
+import log
+
+
+logger = log.get_logger(__name__)
+
+
+# the caches living as long as the process, indexed by name
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class LRUCache(object):
+    """ A cache of at most __maxsize__ entries, evicting the least
+    recently used ones. A __maxsize__ of 0 disables the cache.
+
+    If __ttl__ is given, entries older than __ttl__ seconds are
+    dropped as well.
+    """
+
+    name = None
+    maxsize = None
+    ttl = None
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, name, maxsize, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+
+            # move it to the end, as the most recently used
+            value, stored = self._entries.pop(key)
+            if self.ttl and time.time() - stored >= self.ttl:
+                self.misses += 1
+                self.evictions += 1
+                return default
+
+            self._entries[key] = (value, stored)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time())
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def get_cache(name, maxsize, ttl=None):
+    """ The LRUCache called __name__, created the first time. """
+
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = LRUCache(name, maxsize, ttl=ttl)
+        return _caches[name]
+
+
+def report_stats():
+    for name, c in sorted(_caches.items()):
+        logger.info("Cache {name}: {size}/{maxsize} entries, {hits} hits, "
+                    "{misses} misses, {evictions} evictions"
+                    .format(name=name, **c.stats()))
@@ -24,10 +24,16 @@
 #
 ################################################################################
 
+import datetime
+import heapq
+import json
 import pymongo
 from bson import SON
+from bson.raw_bson import RawBSONDocument
+from gnocchiclient import utils as gnocchi_utils
 
 import cfg
+import limiter
 import log
 import openstack
 import utils
@@ -64,6 +70,24 @@ class CeilometerBackend(object):
     def find(self, *args, **kwargs):
         raise NotImplementedError
 
+    def aggregate(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def aggregate_chunks(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def build_resources_query(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def explain(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def index_information(self, *args, **kwargs):
+        raise NotImplementedError
+
+    def aggregates(self, *args, **kwargs):
+        raise NotImplementedError
+
 
 class MongoCeilometerBackend(CeilometerBackend):
     _mongo = None
@@ -78,11 +102,18 @@ class MongoCeilometerBackend(CeilometerBackend):
         connect_timeout = cfg.CEILOMETER_MONGODB_CONNECTION_TIMEOUT
         self.logger.info("Connecting to: %s." % mongodb)
 
+        options = {
+            'connectTimeoutMS': connect_timeout * 1000,
+            'serverSelectionTimeoutMS': connect_timeout * 1000,
+            'maxPoolSize': cfg.CEILOMETER_MONGODB_MAX_POOL_SIZE,
+            'readPreference': cfg.CEILOMETER_MONGODB_READ_PREFERENCE,
+        }
+
+        if cfg.CEILOMETER_MONGODB_COMPRESSORS:
+            options['compressors'] = cfg.CEILOMETER_MONGODB_COMPRESSORS
+
         try:
-            self._mongo = pymongo.MongoClient(
-                mongodb,
-                connectTimeoutMS=connect_timeout * 1000,
-                serverSelectionTimeoutMS=connect_timeout * 1000)
+            self._mongo = pymongo.MongoClient(mongodb, **options)
             server_info = self._mongo.server_info()
         except pymongo.errors.ServerSelectionTimeoutError as e:
             raise ConnectionError(e)
@@ -96,29 +127,125 @@ class MongoCeilometerBackend(CeilometerBackend):
             self.logger.info("Disconnecting from mongodb")
             self._mongo.close()
 
+    def _collection(self, dbname, raw=False):
+        collection = getattr(self._db, dbname)
+        if raw:
+            # documents are decoded lazily, when accessed
+            codec_options = collection.codec_options._replace(
+                document_class=RawBSONDocument)
+            collection = collection.with_options(codec_options=codec_options)
+        return collection
+
+    @limiter.limited('mongodb')
     def find(self, dbname, query, *args, **kwargs):
+        """ Find the documents matching __query__ in the collection
+        __dbname__, as a list. If __raw__ is True, the documents are
+        returned as RawBSONDocument.
+
+        The cursor is read within the limiter slot, as the query runs
+        only when it is iterated.
+        """
+
+        raw = kwargs.pop('raw', False)
+
+        if cfg.CEILOMETER_MONGODB_BATCH_SIZE:
+            kwargs.setdefault('batch_size', cfg.CEILOMETER_MONGODB_BATCH_SIZE)
+        if cfg.CEILOMETER_MONGODB_MAX_TIME_MS:
+            kwargs.setdefault('max_time_ms', cfg.CEILOMETER_MONGODB_MAX_TIME_MS)
+
         self.logger.debug("Mongo query: %s" % query)
-        db = getattr(self._db, dbname)
-        return db.find(query, *args, **kwargs)
+        db = self._collection(dbname, raw=raw)
+        return list(db.find(query, *args, **kwargs))
 
-    def find_resources(self, project_id, meter, start=None, end=None):
-        """ Find the resources in the given project that:
-        - have a meter named __meter__
-        - have at least one sample between start and end
+    @limiter.limited('mongodb')
+    def aggregate(self, dbname, pipeline, *args, **kwargs):
+        """ Run the aggregation __pipeline__ on the collection
+        __dbname__ and return its documents, as a list. If __raw__ is
+        True, the documents are returned as RawBSONDocument.
+
+        As in find(), all the batches are read within the limiter
+        slot.
         """
 
-        # NOTE: on missing data
-        #
-        # Due to the way ceilometer stores information about resources, a
-        # query to meter_db is necessary to be sure to have at least one
-        # sample between start and end
+        raw = kwargs.pop('raw', False)
+
+        if cfg.CEILOMETER_MONGODB_BATCH_SIZE:
+            kwargs.setdefault('batchSize', cfg.CEILOMETER_MONGODB_BATCH_SIZE)
+        if cfg.CEILOMETER_MONGODB_MAX_TIME_MS:
+            kwargs.setdefault('maxTimeMS', cfg.CEILOMETER_MONGODB_MAX_TIME_MS)
+
+        self.logger.debug("Mongo pipeline: %s" % pipeline)
+        db = self._collection(dbname, raw=raw)
+        return list(db.aggregate(pipeline, *args, allowDiskUse=True,
+                                 **kwargs))
+
+    @limiter.limited('mongodb')
+    def explain(self, dbname, query, sort=None):
+        """ Explain the execution of __query__ on the collection
+        __dbname__. """
+
+        self.logger.debug("Mongo explain: %s" % query)
+        cursor = self._collection(dbname).find(query)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        return cursor.explain()
+
+    @limiter.limited('mongodb')
+    def index_information(self, dbname):
+        return self._collection(dbname).index_information()
+
+    def aggregate_chunks(self, dbname, pipeline, items, sort_key,
+                         *args, **kwargs):
+        """ Run the aggregation pipelines built by __pipeline__ for
+        each chunk of __items__ and merge their results, which must
+        be sorted by __sort_key__.
+
+        Chunks are of CEILOMETER_MONGODB_IN_CHUNK items and up to
+        CEILOMETER_MONGODB_QUERY_WORKERS of them are queried
+        concurrently.
+        """
+
+        size = cfg.CEILOMETER_MONGODB_IN_CHUNK
+        chunks = list(items[i:i + size] for i in range(0, len(items), size))
+        if len(chunks) <= 1:
+            return self.aggregate(dbname, pipeline(items), *args, **kwargs)
+
+        self.logger.debug("Querying {n} items in {c} chunks"
+                          .format(n=len(items), c=len(chunks)))
+
+        def run(chunk):
+            return self.aggregate(dbname, pipeline(chunk), *args, **kwargs)
+
+        # the chunks are read concurrently, then their results are
+        # merged
+        cursors = list(utils.imap_bounded(
+            run, chunks, workers=cfg.CEILOMETER_MONGODB_QUERY_WORKERS))
+        return self.merge_sorted(cursors, sort_key)
+
+    @staticmethod
+    def merge_sorted(cursors, key):
+        """ Merge the sorted __cursors__ into a single sorted stream. """
+
+        # heapq.merge() has no key argument on python 2
+        def decorate(cursor, i):
+            for doc in cursor:
+                yield (doc[key], i, doc)
 
+        streams = list(decorate(c, i) for i, c in enumerate(cursors))
+        for _, _, doc in heapq.merge(*streams):
+            yield doc
+
+    def build_resources_query(self, project_id, meter, start=None, end=None):
         query_list = [
             ('project_id', project_id),
             ('source', 'openstack'),
-            ('meter.counter_name', meter)
         ]
 
+        if isinstance(meter, list):
+            query_list.append(('meter.counter_name', {'$in': meter}))
+        else:
+            query_list.append(('meter.counter_name', meter))
+
         if end is None and start is not None:
             self.logger.warn("find_resources: cannot ensure query order with end=None")
 
@@ -135,13 +262,29 @@ class MongoCeilometerBackend(CeilometerBackend):
                 }))
 
         query = SON(query_list)
+        return query
+
+    def find_resources(self, project_id, meter, start=None, end=None):
+        """ Find the resources in the given project that:
+        - have a meter named __meter__ (or any of them, if a list)
+        - have at least one sample between start and end
+        """
+
+        # NOTE: on missing data
+        #
+        # Due to the way ceilometer stores information about resources, a
+        # query to meter_db is necessary to be sure to have at least one
+        # sample between start and end
+
+        query = self.build_resources_query(project_id, meter,
+                                           start=start, end=end)
 
         projection = {
             "_id": True
         }
 
         resources = self.find("resource", query, projection=projection)
-        self.logger.debug("Got %d resources" % resources.count())
+        self.logger.debug("Got %d resources" % len(resources))
         ret = []
         for r in resources:
             ret.append(r['_id'])
@@ -150,10 +293,12 @@ class MongoCeilometerBackend(CeilometerBackend):
 
 class GnocchiCeilometerBackend(CeilometerBackend):
     _gnocchi = None
+    _archive_policies = None
 
     def __init__(self, *args, **kwargs):
         super(GnocchiCeilometerBackend, self).__init__(
             name=__name__, *args, **kwargs)
+        self._archive_policies = {}
 
     def initialize(self):
         try:
@@ -167,43 +312,202 @@ class GnocchiCeilometerBackend(CeilometerBackend):
     def disconnect(self):
         pass
 
+    def search_resources(self, query, attrs):
+        """ Search the instances matching __query__, only returning
+        the attributes __attrs__.
+
+        Resources are requested in pages of
+        CEILOMETER_GNOCCHI_RESOURCES_PAGE_SIZE, and yielded as soon as
+        each page is received.
+        """
+
+        limit = cfg.CEILOMETER_GNOCCHI_RESOURCES_PAGE_SIZE
+        marker = None
+        while True:
+            params = {
+                'limit': limit,
+                'sort': 'id:asc',
+                'attrs': attrs,
+            }
+
+            if marker is not None:
+                params['marker'] = marker
+
+            url = "v1/search/resource/instance?%s" % (
+                gnocchi_utils.dict_to_querystring(params))
+
+            page = self._search_page(url, query)
+
+            for r in page:
+                yield r
+
+            if len(page) < limit:
+                break
+            marker = page[-1]['id']
+
+    @limiter.limited('gnocchi')
+    def _search_page(self, url, query):
+        return self._gnocchi.api.post(
+            url,
+            headers={'Content-Type': "application/json"},
+            data=json.dumps(query)).json()
+
     def find_resources(self, project_id, meter, start=None, end=None):
+        """ Find the resources in the given project that:
+        - have a meter named __meter__
+        - were alive between start and end
+        """
+
+        # NOTE: the lifetime of the instance is enough to select the
+        # resources, so we don't need to search the history of
+        # revisions.
         query_list = [
             {"=": {"project_id": project_id}},
         ]
 
         if end is not None:
             query_list.append(
-                {"or": [
-                    {"gt": {"revision_end": utils.format_date(end)}},
-                    {"=": {"revision_end": None}},
-                ]})
+                {"<=": {"started_at": utils.format_date(end)}})
 
         if start is not None:
             query_list.append(
                 {"or": [
-                    {"lt": {"revision_start": utils.format_date(start)}},
-                    {"=": {"revision_start": None}},
+                    {">=": {"ended_at": utils.format_date(start)}},
+                    {"=": {"ended_at": None}},
                 ]})
 
         query = {"and": query_list}
-        resources = self._gnocchi.resource.search(
-            resource_type="instance",
-            details=True,
-            history=True,
-            query=query,
-        )
+        resources = self.search_resources(query, attrs=['id', 'metrics'])
 
-        self.logger.debug("Got %d resources" % len(resources))
         ret = []
+        seen = set()
+        n = 0
         for r in resources:
+            n += 1
+            if r['id'] in seen:
+                continue
+
             if meter in r['metrics']:
+                seen.add(r['id'])
                 ret.append(r['id'])
+
+        self.logger.debug("Got %d resources" % n)
         return ret
 
+    @limiter.limited('gnocchi')
     def find(self, *args, **kwargs):
         return self._gnocchi.metric.aggregation(*args, **kwargs)
 
+    def find_chunks(self, start, stop, granularity, *args, **kwargs):
+        """ Like find(), but the window from __start__ to __stop__ is
+        split into chunks of CEILOMETER_GNOCCHI_FETCH_CHUNK seconds,
+        which are fetched concurrently.
+
+        If __aggregates__ is True, chunks are fetched with
+        aggregates() instead of find().
+
+        Yields (chunk_start, chunk_stop, result) in time order. Each
+        chunk is fetched with a margin of one granularity on both
+        sides, so the caller is expected to only consider the
+        measures between chunk_start and chunk_stop. Those are None
+        for the first and last chunk respectively.
+
+        At most CEILOMETER_GNOCCHI_FETCH_WORKERS results are kept in
+        memory at any time.
+        """
+
+        func = self.find
+        if kwargs.pop('aggregates', False):
+            func = self.aggregates
+
+        # chunks are aligned to the granularity
+        chunk = max(cfg.CEILOMETER_GNOCCHI_FETCH_CHUNK, granularity)
+        chunk = chunk - chunk % granularity
+        margin = datetime.timedelta(seconds=granularity)
+
+        bounds = []
+        chunk_start = start
+        while chunk_start < stop:
+            chunk_stop = min(
+                chunk_start + datetime.timedelta(seconds=chunk), stop)
+            bounds.append((chunk_start, chunk_stop))
+            chunk_start = chunk_stop
+
+        def fetch(b):
+            return func(start=max(start, b[0] - margin),
+                        stop=min(stop, b[1] + margin),
+                        granularity=granularity,
+                        *args, **kwargs)
+
+        if len(bounds) > 1:
+            self.logger.debug("Fetching from {s} to {e} in {n} chunks"
+                              .format(s=start, e=stop, n=len(bounds)))
+            results = utils.imap_bounded(
+                fetch, bounds, workers=cfg.CEILOMETER_GNOCCHI_FETCH_WORKERS)
+        else:
+            results = (fetch(b) for b in bounds)
+
+        for i, result in enumerate(results):
+            chunk_start, chunk_stop = bounds[i]
+            yield (chunk_start if i > 0 else None,
+                   chunk_stop if i < len(bounds) - 1 else None,
+                   result)
+
+    @limiter.limited('gnocchi')
+    def aggregates(self, *args, **kwargs):
+        self.logger.debug("Gnocchi aggregates: %s" % kwargs.get('operations'))
+        return self._gnocchi.aggregates.fetch(*args, **kwargs)
+
+    def _find_metric(self, meter):
+        # the most recent instances are the ones most likely to have
+        # the metric
+        resources = self._gnocchi.resource.search(
+            resource_type="instance",
+            limit=100,
+            sorts=["started_at:desc"])
+
+        for r in resources:
+            if meter in r['metrics']:
+                return self._gnocchi.metric.get(r['metrics'][meter])
+        return None
+
+    @limiter.limited('gnocchi')
+    def archive_policy(self, meter):
+        """ Return the archive policy definition of the metrics named
+        __meter__, as a list of (granularity, timespan) in seconds.
+
+        Ceilometer creates all the metrics with the same name with the
+        same archive policy, so we discover it from one metric and
+        cache it.
+        """
+
+        if meter in self._archive_policies:
+            return self._archive_policies[meter]
+
+        metric = self._find_metric(meter)
+        if metric is None:
+            self.logger.warn("Cannot find archive policy for %s" % meter)
+            return None
+
+        if 'archive_policy' in metric:
+            archive_policy = metric['archive_policy']
+        else:
+            archive_policy = self._gnocchi.archive_policy.get(
+                metric['archive_policy_name'])
+
+        definition = sorted(
+            (utils.timedelta_seconds(d['granularity']),
+             utils.timedelta_seconds(d.get('timespan')))
+            for d in archive_policy['definition'])
+
+        self.logger.info("Archive policy for {meter} is {name}: {d}"
+                         .format(meter=meter,
+                                 name=archive_policy['name'],
+                                 d=definition))
+
+        self._archive_policies[meter] = definition
+        return definition
+
 
 def initialize():
     global _ceilometer_backend
@@ -233,3 +537,43 @@ def find_resources(*args, **kwargs):
 def find(*args, **kwargs):
     global _ceilometer_backend
     return _ceilometer_backend.find(*args, **kwargs)
+
+
+def aggregate(*args, **kwargs):
+    global _ceilometer_backend
+    return _ceilometer_backend.aggregate(*args, **kwargs)
+
+
+def aggregate_chunks(*args, **kwargs):
+    global _ceilometer_backend
+    return _ceilometer_backend.aggregate_chunks(*args, **kwargs)
+
+
+def build_resources_query(*args, **kwargs):
+    global _ceilometer_backend
+    return _ceilometer_backend.build_resources_query(*args, **kwargs)
+
+
+def explain(*args, **kwargs):
+    global _ceilometer_backend
+    return _ceilometer_backend.explain(*args, **kwargs)
+
+
+def index_information(*args, **kwargs):
+    global _ceilometer_backend
+    return _ceilometer_backend.index_information(*args, **kwargs)
+
+
+def aggregates(*args, **kwargs):
+    global _ceilometer_backend
+    return _ceilometer_backend.aggregates(*args, **kwargs)
+
+
+def archive_policy(*args, **kwargs):
+    global _ceilometer_backend
+    return _ceilometer_backend.archive_policy(*args, **kwargs)
+
+
+def find_chunks(*args, **kwargs):
+    global _ceilometer_backend
+    return _ceilometer_backend.find_chunks(*args, **kwargs)
@@ -26,6 +26,7 @@
 
 import yaml
 import os
+import socket
 from pprint import pprint
 import sys
 
@@ -62,17 +63,56 @@ SCHEDULERS = None
 CAOS_TSDB_API_URL = None
 CAOS_TSDB_API_USERNAME = None
 CAOS_TSDB_API_PASSWORD = None
+CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL = None
+CAOS_TSDB_SPOOL_ENABLED = None
+CAOS_TSDB_SPOOL_PATH = None
+CAOS_TSDB_SPOOL_SYNCHRONOUS = None
+CAOS_TSDB_SPOOL_MAX_SAMPLES = None
+CAOS_TSDB_SPOOL_BATCH_SIZE = None
+CAOS_TSDB_SPOOL_DRAIN_INTERVAL = None
+CAOS_TSDB_SPOOL_MAX_BACKOFF = None
+CAOS_TSDB_SPOOL_SHUTDOWN_TIMEOUT = None
 
 CEILOMETER_BACKEND = None
 CEILOMETER_MONGODB = None
 CEILOMETER_MONGODB_CONNECTION_TIMEOUT = None
+CEILOMETER_MONGODB_MAX_POOL_SIZE = None
+CEILOMETER_MONGODB_COMPRESSORS = None
+CEILOMETER_MONGODB_BATCH_SIZE = None
+CEILOMETER_MONGODB_READ_PREFERENCE = None
+CEILOMETER_MONGODB_MAX_TIME_MS = None
+CEILOMETER_MONGODB_IN_CHUNK = None
+CEILOMETER_MONGODB_QUERY_WORKERS = None
 CEILOMETER_POLLING_PERIOD = None
+CEILOMETER_ADAPTIVE_MARGIN = None
+CEILOMETER_RESULTS_CACHE_SIZE = None
+CEILOMETER_RESULTS_CACHE_TTL = None
 CEILOMETER_GNOCCHI_POLICY_GRANULARITY = None
+CEILOMETER_GNOCCHI_MIN_POINTS_PER_PERIOD = None
+CEILOMETER_GNOCCHI_FETCH_CHUNK = None
+CEILOMETER_GNOCCHI_FETCH_WORKERS = None
+CEILOMETER_GNOCCHI_RESOURCES_PAGE_SIZE = None
+CEILOMETER_GNOCCHI_SERVER_SIDE_AGGREGATES = None
+CEILOMETER_GNOCCHI_AGGREGATES_TOLERANCE = None
 
 LOGGER_ROTATE_KEEP_COUNT = None
 LOGGER_LOG_FILE_PATH = None
 LOGGER_ERROR_FILE_PATH = None
 
+STATE_DIR = None
+
+HTTP_POOL_SIZE = None
+HTTP_WORKERS = None
+
+LIMITS = None
+
+SHARDING_ENABLED = None
+SHARDING_MEMBER_ID = None
+SHARDING_STORE = None
+SHARDING_STORE_PATH = None
+SHARDING_LEASE_TTL = None
+SHARDING_REPLICAS = None
+
 OPENSTACK_NOVA_API_VERSION = None
 
 OPENSTACK_PLACEMENT_API_VERSION = None
@@ -82,8 +122,32 @@ OPENSTACK_VERSION = None
 
 # defaults
 DEFAULT_CEILOMETER_BACKEND = "mongodb"
+DEFAULT_CEILOMETER_ADAPTIVE_MARGIN = False
+DEFAULT_CEILOMETER_RESULTS_CACHE_SIZE = 10000
+DEFAULT_CEILOMETER_RESULTS_CACHE_TTL = 3600
 DEFAULT_CEILOMETER_MONGODB_CONNECTION_TIMEOUT = 1
+DEFAULT_CEILOMETER_MONGODB_MAX_POOL_SIZE = 100
+DEFAULT_CEILOMETER_MONGODB_BATCH_SIZE = 0
+DEFAULT_CEILOMETER_MONGODB_READ_PREFERENCE = "primary"
+DEFAULT_CEILOMETER_MONGODB_MAX_TIME_MS = 0
+DEFAULT_CEILOMETER_MONGODB_IN_CHUNK = 1000
+DEFAULT_CEILOMETER_MONGODB_QUERY_WORKERS = 4
 DEFAULT_CEILOMETER_GNOCCHI_POLICY_GRANULARITY = 300
+DEFAULT_CEILOMETER_GNOCCHI_FALLBACK_GRANULARITY = 300
+DEFAULT_CEILOMETER_GNOCCHI_MIN_POINTS_PER_PERIOD = 12
+DEFAULT_CEILOMETER_GNOCCHI_FETCH_CHUNK = 86400
+DEFAULT_CEILOMETER_GNOCCHI_FETCH_WORKERS = 4
+DEFAULT_CEILOMETER_GNOCCHI_RESOURCES_PAGE_SIZE = 1000
+DEFAULT_CEILOMETER_GNOCCHI_SERVER_SIDE_AGGREGATES = False
+DEFAULT_CEILOMETER_GNOCCHI_AGGREGATES_TOLERANCE = 0.05
+DEFAULT_CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL = 3600
+DEFAULT_CAOS_TSDB_SPOOL_ENABLED = False
+DEFAULT_CAOS_TSDB_SPOOL_SYNCHRONOUS = "normal"
+DEFAULT_CAOS_TSDB_SPOOL_MAX_SAMPLES = 1000000
+DEFAULT_CAOS_TSDB_SPOOL_BATCH_SIZE = 100
+DEFAULT_CAOS_TSDB_SPOOL_DRAIN_INTERVAL = 5
+DEFAULT_CAOS_TSDB_SPOOL_MAX_BACKOFF = 300
+DEFAULT_CAOS_TSDB_SPOOL_SHUTDOWN_TIMEOUT = 30
 DEFAULT_KEYSTONE_API_VERSION = "v3"
 DEFAULT_OPENSTACK_NOVA_API_VERSION = "2"
 DEFAULT_OPENSTACK_PLACEMENT_API_VERSION = "1.4"
@@ -92,8 +156,20 @@ DEFAULT_OPENSTACK_VERSION = 'newton'
 DEFAULT_LOGGER_ROTATE_KEEP_COUNT = 30
 DEFAULT_LOGGER_LOG_FILE_PATH = "/var/log/caos/collector.log"
 DEFAULT_LOGGER_ERROR_FILE_PATH = "/var/log/caos/collector.error.log"
+DEFAULT_STATE_DIR = "/var/lib/caos/collector"
+DEFAULT_HTTP_POOL_SIZE = 20
+DEFAULT_HTTP_WORKERS = 20
+DEFAULT_LIMITS_MAX_CONCURRENCY = 16
+DEFAULT_LIMITS_LATENCY_TARGET = 10.0
+DEFAULT_LIMITS_RATE = 0
+DEFAULT_LIMITS_BURST = 0
+DEFAULT_SHARDING_ENABLED = False
+DEFAULT_SHARDING_STORE = "sqlite"
+DEFAULT_SHARDING_LEASE_TTL = 300
+DEFAULT_SHARDING_REPLICAS = 100
 
 # misc
+CAOS_CLUSTER_TAG_KEY = 'cluster'
 CAOS_DOMAIN_TAG_KEY = 'domain'
 CAOS_HYPERVISOR_TAG_KEY = 'hypervisor'
 CAOS_PROJECT_TAG_KEY = 'project'
@@ -117,6 +193,64 @@ def _parse_cfg():
                      env_var="CAOS_COLLECTOR_LOGGER_ERROR_FILE_PATH",
                      default=DEFAULT_LOGGER_ERROR_FILE_PATH))
 
+    _assign('STATE_DIR',
+            _get_str("state_dir",
+                     env_var="CAOS_COLLECTOR_STATE_DIR",
+                     default=DEFAULT_STATE_DIR))
+
+    _assign('HTTP_POOL_SIZE',
+            _get_int("http.pool_size",
+                     env_var="CAOS_COLLECTOR_HTTP_POOL_SIZE",
+                     default=DEFAULT_HTTP_POOL_SIZE,
+                     required=False))
+
+    _assign('HTTP_WORKERS',
+            _get_int("http.workers",
+                     env_var="CAOS_COLLECTOR_HTTP_WORKERS",
+                     default=DEFAULT_HTTP_WORKERS,
+                     required=False))
+
+    _assign('LIMITS',
+            _get("limits",
+                 default={},
+                 required=False))
+
+    _assign('SHARDING_ENABLED',
+            _get_bool("sharding.enabled",
+                      env_var="CAOS_COLLECTOR_SHARDING_ENABLED",
+                      default=DEFAULT_SHARDING_ENABLED,
+                      required=False))
+
+    _assign('SHARDING_MEMBER_ID',
+            _get_str("sharding.member_id",
+                     env_var="CAOS_COLLECTOR_SHARDING_MEMBER_ID",
+                     default="{host}-{pid}".format(
+                         host=socket.gethostname(), pid=os.getpid()),
+                     required=False))
+
+    _assign('SHARDING_STORE',
+            _get_str("sharding.store",
+                     env_var="CAOS_COLLECTOR_SHARDING_STORE",
+                     default=DEFAULT_SHARDING_STORE,
+                     required=False))
+
+    _assign('SHARDING_STORE_PATH',
+            _get_str("sharding.store_path",
+                     env_var="CAOS_COLLECTOR_SHARDING_STORE_PATH",
+                     required=False))
+
+    _assign('SHARDING_LEASE_TTL',
+            _get_int("sharding.lease_ttl",
+                     env_var="CAOS_COLLECTOR_SHARDING_LEASE_TTL",
+                     default=DEFAULT_SHARDING_LEASE_TTL,
+                     required=False))
+
+    _assign('SHARDING_REPLICAS',
+            _get_int("sharding.replicas",
+                     env_var="CAOS_COLLECTOR_SHARDING_REPLICAS",
+                     default=DEFAULT_SHARDING_REPLICAS,
+                     required=False))
+
     _assign('KEYSTONE_USERNAME',
             _get_str("keystone.username",
                      env_var="OS_USERNAME"))
@@ -214,6 +348,59 @@ def _parse_cfg():
             _get_str('caos-tsdb.password',
                      env_var="CAOS_COLLECTOR_TSDB_PASSWORD"))
 
+    _assign('CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL',
+            _get_int('caos-tsdb.gauge_keyframe_interval',
+                     env_var="CAOS_COLLECTOR_TSDB_GAUGE_KEYFRAME_INTERVAL",
+                     default=DEFAULT_CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL,
+                     required=False))
+
+    _assign('CAOS_TSDB_SPOOL_ENABLED',
+            _get_bool('caos-tsdb.spool.enabled',
+                      env_var="CAOS_COLLECTOR_TSDB_SPOOL_ENABLED",
+                      default=DEFAULT_CAOS_TSDB_SPOOL_ENABLED,
+                      required=False))
+
+    _assign('CAOS_TSDB_SPOOL_PATH',
+            _get_str('caos-tsdb.spool.path',
+                     env_var="CAOS_COLLECTOR_TSDB_SPOOL_PATH",
+                     required=False))
+
+    _assign('CAOS_TSDB_SPOOL_SYNCHRONOUS',
+            _get_str('caos-tsdb.spool.synchronous',
+                     env_var="CAOS_COLLECTOR_TSDB_SPOOL_SYNCHRONOUS",
+                     default=DEFAULT_CAOS_TSDB_SPOOL_SYNCHRONOUS,
+                     required=False))
+
+    _assign('CAOS_TSDB_SPOOL_MAX_SAMPLES',
+            _get_int('caos-tsdb.spool.max_samples',
+                     env_var="CAOS_COLLECTOR_TSDB_SPOOL_MAX_SAMPLES",
+                     default=DEFAULT_CAOS_TSDB_SPOOL_MAX_SAMPLES,
+                     required=False))
+
+    _assign('CAOS_TSDB_SPOOL_BATCH_SIZE',
+            _get_int('caos-tsdb.spool.batch_size',
+                     env_var="CAOS_COLLECTOR_TSDB_SPOOL_BATCH_SIZE",
+                     default=DEFAULT_CAOS_TSDB_SPOOL_BATCH_SIZE,
+                     required=False))
+
+    _assign('CAOS_TSDB_SPOOL_DRAIN_INTERVAL',
+            _get_int('caos-tsdb.spool.drain_interval',
+                     env_var="CAOS_COLLECTOR_TSDB_SPOOL_DRAIN_INTERVAL",
+                     default=DEFAULT_CAOS_TSDB_SPOOL_DRAIN_INTERVAL,
+                     required=False))
+
+    _assign('CAOS_TSDB_SPOOL_MAX_BACKOFF',
+            _get_int('caos-tsdb.spool.max_backoff',
+                     env_var="CAOS_COLLECTOR_TSDB_SPOOL_MAX_BACKOFF",
+                     default=DEFAULT_CAOS_TSDB_SPOOL_MAX_BACKOFF,
+                     required=False))
+
+    _assign('CAOS_TSDB_SPOOL_SHUTDOWN_TIMEOUT',
+            _get_int('caos-tsdb.spool.shutdown_timeout',
+                     env_var="CAOS_COLLECTOR_TSDB_SPOOL_SHUTDOWN_TIMEOUT",
+                     default=DEFAULT_CAOS_TSDB_SPOOL_SHUTDOWN_TIMEOUT,
+                     required=False))
+
     # [ceilometer]
     _assign('CEILOMETER_BACKEND',
             _get_str("ceilometer.backend",
@@ -232,16 +419,111 @@ def _parse_cfg():
                      default=DEFAULT_CEILOMETER_MONGODB_CONNECTION_TIMEOUT,
                      required=False))
 
+    _assign('CEILOMETER_MONGODB_MAX_POOL_SIZE',
+            _get_int('ceilometer.mongodb_max_pool_size',
+                     env_var="CAOS_COLLECTOR_MONGODB_MAX_POOL_SIZE",
+                     default=DEFAULT_CEILOMETER_MONGODB_MAX_POOL_SIZE,
+                     required=False))
+
+    _assign('CEILOMETER_MONGODB_COMPRESSORS',
+            _get_str('ceilometer.mongodb_compressors',
+                     env_var="CAOS_COLLECTOR_MONGODB_COMPRESSORS",
+                     required=False))
+
+    _assign('CEILOMETER_MONGODB_BATCH_SIZE',
+            _get_int('ceilometer.mongodb_batch_size',
+                     env_var="CAOS_COLLECTOR_MONGODB_BATCH_SIZE",
+                     default=DEFAULT_CEILOMETER_MONGODB_BATCH_SIZE,
+                     required=False))
+
+    _assign('CEILOMETER_MONGODB_READ_PREFERENCE',
+            _get_str('ceilometer.mongodb_read_preference',
+                     env_var="CAOS_COLLECTOR_MONGODB_READ_PREFERENCE",
+                     default=DEFAULT_CEILOMETER_MONGODB_READ_PREFERENCE,
+                     required=False))
+
+    _assign('CEILOMETER_MONGODB_MAX_TIME_MS',
+            _get_int('ceilometer.mongodb_max_time_ms',
+                     env_var="CAOS_COLLECTOR_MONGODB_MAX_TIME_MS",
+                     default=DEFAULT_CEILOMETER_MONGODB_MAX_TIME_MS,
+                     required=False))
+
+    _assign('CEILOMETER_MONGODB_IN_CHUNK',
+            _get_int('ceilometer.mongodb_in_chunk',
+                     env_var="CAOS_COLLECTOR_MONGODB_IN_CHUNK",
+                     default=DEFAULT_CEILOMETER_MONGODB_IN_CHUNK,
+                     required=False))
+
+    _assign('CEILOMETER_MONGODB_QUERY_WORKERS',
+            _get_int('ceilometer.mongodb_query_workers',
+                     env_var="CAOS_COLLECTOR_MONGODB_QUERY_WORKERS",
+                     default=DEFAULT_CEILOMETER_MONGODB_QUERY_WORKERS,
+                     required=False))
+
     _assign('CEILOMETER_POLLING_PERIOD',
             _get_int("ceilometer.polling_period",
                      env_var="CAOS_COLLECTOR_CEILOMETER_POLLING_PERIOD"))
 
+    _assign('CEILOMETER_ADAPTIVE_MARGIN',
+            _get_bool("ceilometer.adaptive_margin",
+                      env_var="CAOS_COLLECTOR_CEILOMETER_ADAPTIVE_MARGIN",
+                      default=DEFAULT_CEILOMETER_ADAPTIVE_MARGIN,
+                      required=False))
+
+    _assign('CEILOMETER_RESULTS_CACHE_SIZE',
+            _get_int("ceilometer.results_cache_size",
+                     env_var="CAOS_COLLECTOR_CEILOMETER_RESULTS_CACHE_SIZE",
+                     default=DEFAULT_CEILOMETER_RESULTS_CACHE_SIZE,
+                     required=False))
+
+    _assign('CEILOMETER_RESULTS_CACHE_TTL',
+            _get_int("ceilometer.results_cache_ttl",
+                     env_var="CAOS_COLLECTOR_CEILOMETER_RESULTS_CACHE_TTL",
+                     default=DEFAULT_CEILOMETER_RESULTS_CACHE_TTL,
+                     required=False))
+
     _assign('CEILOMETER_GNOCCHI_POLICY_GRANULARITY',
-            _get_str('ceilometer.gnocchi.policy_granularity',
-                     env_var="CAOS_COLLECTOR_CEILOMETER_GNOCCHI_POLICY_GRANULARITY",
-                     default=DEFAULT_CEILOMETER_GNOCCHI_POLICY_GRANULARITY,
+            _get_int_or_str('ceilometer.gnocchi.policy_granularity',
+                            env_var="CAOS_COLLECTOR_CEILOMETER_GNOCCHI_POLICY_GRANULARITY",  # noqa: E501
+                            default=DEFAULT_CEILOMETER_GNOCCHI_POLICY_GRANULARITY,  # noqa: E501
+                            required=False))
+
+    _assign('CEILOMETER_GNOCCHI_MIN_POINTS_PER_PERIOD',
+            _get_int('ceilometer.gnocchi.min_points_per_period',
+                     env_var="CAOS_COLLECTOR_CEILOMETER_GNOCCHI_MIN_POINTS_PER_PERIOD",  # noqa: E501
+                     default=DEFAULT_CEILOMETER_GNOCCHI_MIN_POINTS_PER_PERIOD,
                      required=False))
 
+    _assign('CEILOMETER_GNOCCHI_FETCH_CHUNK',
+            _get_int('ceilometer.gnocchi.fetch_chunk',
+                     env_var="CAOS_COLLECTOR_CEILOMETER_GNOCCHI_FETCH_CHUNK",
+                     default=DEFAULT_CEILOMETER_GNOCCHI_FETCH_CHUNK,
+                     required=False))
+
+    _assign('CEILOMETER_GNOCCHI_FETCH_WORKERS',
+            _get_int('ceilometer.gnocchi.fetch_workers',
+                     env_var="CAOS_COLLECTOR_CEILOMETER_GNOCCHI_FETCH_WORKERS",
+                     default=DEFAULT_CEILOMETER_GNOCCHI_FETCH_WORKERS,
+                     required=False))
+
+    _assign('CEILOMETER_GNOCCHI_RESOURCES_PAGE_SIZE',
+            _get_int('ceilometer.gnocchi.resources_page_size',
+                     env_var="CAOS_COLLECTOR_CEILOMETER_GNOCCHI_RESOURCES_PAGE_SIZE",  # noqa: E501
+                     default=DEFAULT_CEILOMETER_GNOCCHI_RESOURCES_PAGE_SIZE,
+                     required=False))
+
+    _assign('CEILOMETER_GNOCCHI_SERVER_SIDE_AGGREGATES',
+            _get_bool('ceilometer.gnocchi.server_side_aggregates',
+                      env_var="CAOS_COLLECTOR_CEILOMETER_GNOCCHI_SERVER_SIDE_AGGREGATES",  # noqa: E501
+                      default=DEFAULT_CEILOMETER_GNOCCHI_SERVER_SIDE_AGGREGATES,
+                      required=False))
+
+    _assign('CEILOMETER_GNOCCHI_AGGREGATES_TOLERANCE',
+            _get_float('ceilometer.gnocchi.aggregates_tolerance',
+                       env_var="CAOS_COLLECTOR_CEILOMETER_GNOCCHI_AGGREGATES_TOLERANCE",  # noqa: E501
+                       default=DEFAULT_CEILOMETER_GNOCCHI_AGGREGATES_TOLERANCE,
+                       required=False))
+
 
 def dump():
     pprint({'CFG': CFG})
@@ -308,6 +590,37 @@ def _get_int(*args, **kwargs):
     return _get(*args, check_type=int, **kwargs)
 
 
+def _get_float(*args, **kwargs):
+    return _get(*args, check_type=float, **kwargs)
+
+
+def _get_bool(name, default=None, required=True, env_var=None):
+    # `false` is a valid value, so we can't rely on _get()
+    value = utils.deep_get(_config, name)
+
+    if env_var and value is None:
+        value = os.getenv(env_var, None)
+
+    if value is None:
+        value = default
+
+    if required and value is None:
+        raise RuntimeError("Required option `{name}` not found in config file."
+                           .format(name=name))
+
+    if value is None or type(value) is bool:
+        return value
+
+    if str(value).lower() in ('1', 'true', 'yes', 'on'):
+        return True
+
+    if str(value).lower() in ('0', 'false', 'no', 'off'):
+        return False
+
+    raise RuntimeError("Cannot convert option `{name}` to `bool`"
+                       .format(name=name))
+
+
 def _get_int_or_str(*args, **kwargs):
     try:
         value = _get_int(*args, **kwargs)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2017 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import argparse
+import datetime
+import multiprocessing
+
+from job import Job
+from vm_usage_job import VMUsageJob
+from caos_collector import backfill
+from caos_collector import log
+from caos_collector import metrics
+from caos_collector import openstack
+from caos_collector import tsdb
+from caos_collector import utils
+
+
+# the meters of vm_usage, with the option disabling each of them
+_METRICS = {
+    'nova_usages': '--no-nova-usages',
+    'cputime': '--no-cputime',
+    'wallclocktime': '--no-wallclocktime',
+}
+
+# so that ^C can interrupt the wait for the results (python 2)
+_RESULT_TIMEOUT = 365*86400
+
+logger = log.get_logger(__name__)
+
+# the VMUsageJob of each worker process
+_job = None
+
+
+def _init_worker():
+    global _job
+
+    # the samples are written directly by the workers
+    tsdb.set_spool(None)
+
+    _job = VMUsageJob()
+    _job._check_connectivity()
+    metrics.check_metrics()
+
+
+def _run_unit(unit):
+    """ Run vm_usage on the work __unit__, in a worker process. """
+
+    key, cmdline = unit
+
+    parser = argparse.ArgumentParser()
+    VMUsageJob.setup_parser(parser)
+    args = parser.parse_args(cmdline)
+
+    try:
+        if not tsdb.refresh_token():
+            raise RuntimeError("TSDB API auth problems.")
+        _job._run(args)
+    except Exception as e:
+        logger.exception("Backfill of {key} failed".format(key=key))
+        return key, str(e)
+    return key, None
+
+
+class BackfillJob(Job):
+    """The backfill job"""
+
+    _pool = None
+
+    def __init__(self, *args, **kwargs):
+        super(BackfillJob, self).__init__(
+            name=__name__, *args, **kwargs)
+
+    @staticmethod
+    def setup_parser(parser):
+        parser.add_argument(
+            '-d', '--domain',
+            dest='domain_id', metavar='ID',
+            nargs='?',
+            default=None,
+            help='Limit by domain id')
+
+        parser.add_argument(
+            '-p', '--project',
+            dest='project_id', metavar='ID',
+            nargs='?',
+            default=None,
+            help='Limit by project id')
+
+        parser.add_argument(
+            '-s', '--start',
+            dest='start', metavar='TS',
+            required=True,
+            help='Backfill since TIMESTAMP')
+
+        parser.add_argument(
+            '-e', '--end',
+            dest='end', metavar='TS',
+            nargs='?',
+            default=utils.format_date(datetime.datetime.utcnow()),
+            help='Backfill up to TIMESTAMP (default to now)')
+
+        parser.add_argument(
+            '-P', '--period',
+            dest='period', metavar='PERIOD',
+            nargs='?',
+            type=int,
+            default=3600,
+            help='Limit by period')
+
+        parser.add_argument(
+            '-M', '--metrics',
+            dest='metrics', metavar='NAMES',
+            default=','.join(sorted(_METRICS)),
+            help='Comma separated metrics to backfill '
+            '(default to {m})'.format(m=','.join(sorted(_METRICS))))
+
+        parser.add_argument(
+            '--chunk',
+            dest='chunk', metavar='SECONDS',
+            type=int,
+            default=7*86400,
+            help='Length of the time range of each work unit')
+
+        parser.add_argument(
+            '-w', '--workers',
+            dest='workers', metavar='N',
+            type=int,
+            default=4,
+            help='Number of worker processes')
+
+        parser.add_argument(
+            '-o', '--overwrite',
+            dest='overwrite',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Overwrite samples')
+
+        parser.add_argument(
+            '--ledger',
+            dest='ledger', metavar='FILE',
+            default=None,
+            help='Progress ledger (default to state_dir/backfill.sqlite)')
+
+        parser.add_argument(
+            '--restart',
+            dest='restart',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Forget the progress of previous runs')
+
+    def run_job(self, args):
+        # the workers are forked before any connection is opened, and
+        # open their own ones
+        self._pool = multiprocessing.Pool(args.workers,
+                                          initializer=_init_worker)
+        try:
+            super(BackfillJob, self).run_job(args)
+            self._pool.close()
+        except BaseException:
+            self._pool.terminate()
+            raise
+        finally:
+            self._pool.join()
+            self._pool = None
+
+    def _units(self, keystone_projects, start, end, args):
+        names = list(m.strip() for m in args.metrics.split(',') if m.strip())
+        for name in names:
+            if name not in _METRICS:
+                raise RuntimeError("Unknown metric `{m}`".format(m=name))
+
+        chunks = backfill.split(start=start, end=end, period=args.period,
+                                chunk=args.chunk)
+
+        for project_id in sorted(keystone_projects):
+            for chunk_start, chunk_end in chunks:
+                for name in names:
+                    key = "{m}/{p}/{period}/{s}/{e}".format(
+                        m=name, p=project_id, period=args.period,
+                        s=utils.format_date(chunk_start),
+                        e=utils.format_date(chunk_end))
+
+                    cmdline = [
+                        '--project', project_id,
+                        '--start', utils.format_date(chunk_start),
+                        '--end', utils.format_date(chunk_end),
+                        '--period', str(args.period),
+                    ]
+                    cmdline.extend(o for m, o in sorted(_METRICS.items())
+                                   if m != name)
+                    if args.overwrite:
+                        cmdline.append('--overwrite')
+
+                    yield key, cmdline
+
+    def _run(self, args):
+        start = utils.parse_date(args.start)
+        end = min(utils.parse_date(args.end), datetime.datetime.utcnow())
+
+        if args.project_id:
+            keystone_projects = openstack.project(project_id=args.project_id)
+        else:
+            keystone_projects = openstack.projects(domain_id=args.domain_id)
+
+        ledger = backfill.Ledger(args.ledger)
+        if args.restart:
+            ledger.clear()
+
+        try:
+            units = list(self._units(keystone_projects, start, end, args))
+            pending = list(u for u in units if not ledger.is_done(u[0]))
+
+            self.logger.info("Backfilling {n} units ({d} already done) "
+                             "with {w} workers"
+                             .format(n=len(pending),
+                                     d=len(units) - len(pending),
+                                     w=args.workers))
+
+            progress = backfill.Progress(total=len(pending))
+            results = self._pool.imap_unordered(_run_unit, pending)
+            for _ in pending:
+                key, error = results.next(timeout=_RESULT_TIMEOUT)
+                if error is None:
+                    ledger.done(key)
+                progress.update(failed=error is not None)
+        finally:
+            ledger.close()
+
+        if progress.failed:
+            raise RuntimeError("{n} backfill units failed, run again to "
+                               "retry them".format(n=progress.failed))
+
+        self.logger.info("Backfill done")
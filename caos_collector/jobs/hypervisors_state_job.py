@@ -29,9 +29,11 @@ import re
 import yaml
 
 from job import Job
+from caos_collector.aggregates import Aggregator
 from caos_collector import cfg
 from caos_collector import metrics
 from caos_collector import openstack
+from caos_collector import sharding
 from caos_collector import tsdb
 from caos_collector import utils
 
@@ -47,10 +49,33 @@ _DEFAULT_ALLOCATION_RATIO = {
 
 _REGEX_LOADS = re.compile(".*load average:\s(.+),\s(.+),\s(.+)")
 
+# the clusters of the totals: the whole cloud, each host aggregate
+# and each availability zone
+_CLUSTER_CLOUD = 'cloud'
+_CLUSTER_AGGREGATE = 'aggregate/{name}'
+_CLUSTER_AZ = 'az/{name}'
+
+# the metrics summed in the totals, the others (e.g. the status and
+# the loads) don't add up
+_CLUSTER_METRICS = (
+    metrics.METRIC_HYPERVISOR_CPUS_TOTAL,
+    metrics.METRIC_HYPERVISOR_VCPUS_TOTAL,
+    metrics.METRIC_HYPERVISOR_VCPUS_USED,
+    metrics.METRIC_HYPERVISOR_RUNNING_VMS,
+    metrics.METRIC_HYPERVISOR_RAM_TOTAL,
+    metrics.METRIC_HYPERVISOR_MEMORY_TOTAL,
+    metrics.METRIC_HYPERVISOR_MEMORY_USED,
+    metrics.METRIC_HYPERVISOR_DISK_TOTAL,
+    metrics.METRIC_HYPERVISOR_DISK_USED,
+    metrics.METRIC_HYPERVISOR_DISK_FREE,
+)
+
 
 class HypervisorsStateJob(Job):
     """The hypervisors state job"""
 
+    _uptimes = None
+
     def __init__(self, *args, **kwargs):
         super(HypervisorsStateJob, self).__init__(
             name=__name__, *args, **kwargs)
@@ -80,6 +105,14 @@ class HypervisorsStateJob(Job):
             default=False,
             help='Don\'t query placement api (ocata and above)')
 
+        parser.add_argument(
+            '--no-cluster-totals',
+            dest='no_cluster_totals',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Disable the totals of the clusters')
+
     def _run(self, args):
         tz = datetime.datetime.utcnow()
 
@@ -105,6 +138,24 @@ class HypervisorsStateJob(Job):
             hypervisors = {
                 hypervisor: hypervisors[hypervisor]
             }
+        else:
+            # only the ones of this collector, if sharded
+            hypervisors = dict(
+                (h, hypervisors[h])
+                for h in sharding.owned(hypervisors.keys()))
+
+        # the uptimes (i.e. the loads) are queried concurrently
+        self._uptimes = dict(
+            (h['id'], openstack.hypervisor_uptime_async(hypervisor=h['id']))
+            for h in hypervisors.values() if h['state'] == 'up')
+
+        # the totals of the clusters, if all of the hypervisors are
+        # checked
+        cluster_totals = None
+        if not (hypervisor or sharding.enabled() or args.no_cluster_totals):
+            cluster_totals = Aggregator(
+                tag_key=cfg.CAOS_CLUSTER_TAG_KEY,
+                groups=self._clusters(hypervisors))
 
         for hypervisor_host, hypervisor_data in hypervisors.items():
             self.logger.info("Checking hypervisor state for hypervisor {name}"
@@ -113,12 +164,51 @@ class HypervisorsStateJob(Job):
             cpu_ar = self._get_allocation_ratio(ar, 'cpu', hypervisor_host)
             ram_ar = self._get_allocation_ratio(ar, 'ram', hypervisor_host)
 
-            self.check_hypervisor(tz=tz, hypervisor_host=hypervisor_host,
-                                  hypervisor_data=hypervisor_data,
-                                  cpu_ar=cpu_ar, ram_ar=ram_ar)
+            values = self.check_hypervisor(tz=tz,
+                                           hypervisor_host=hypervisor_host,
+                                           hypervisor_data=hypervisor_data,
+                                           cpu_ar=cpu_ar, ram_ar=ram_ar)
+            if cluster_totals is not None:
+                cluster_totals.add(member=hypervisor_host, window=None,
+                                   values=values.items())
+
+        if cluster_totals is not None:
+            for tags, _, metric_name, value in cluster_totals.totals():
+                tsdb.create_gauge_sample(metric_name=metric_name, tags=tags,
+                                         timestamp=tz, value=value)
 
         self.logger.info("Hypervisors state updated")
 
+    def _clusters(self, hypervisors):
+        """ The clusters of each hypervisor. """
+
+        clusters = dict((h, [_CLUSTER_CLOUD]) for h in hypervisors)
+
+        try:
+            nova_aggregates = openstack.aggregates()
+        except Exception as e:
+            self.logger.warn("Cannot query host aggregates: {e}".format(e=e))
+            return clusters
+
+        # the aggregates list the compute hosts of the hypervisors
+        hosts = {}
+        for h, data in hypervisors.items():
+            host = utils.deep_get(data, 'service.host')
+            if host:
+                hosts.setdefault(host, []).append(h)
+
+        for name, data in nova_aggregates.items():
+            names = [_CLUSTER_AGGREGATE.format(name=name)]
+            if data.get('availability_zone'):
+                names.append(_CLUSTER_AZ.format(
+                    name=data['availability_zone']))
+
+            for host in data.get('hosts') or []:
+                for h in hosts.get(host, []):
+                    clusters[h].extend(n for n in names
+                                       if n not in clusters[h])
+        return clusters
+
     def _query_ar_from_placement(self):
         ar = {
             'cpu': {},
@@ -128,15 +218,21 @@ class HypervisorsStateJob(Job):
         placement = openstack.get_placement_client()
 
         providers = placement.resource_providers()
+
+        # the inventories are queried concurrently
+        inventories = []
         for p in providers:
             uuid = p['uuid']
             name = p['name']
 
-            cpu_inventory = placement.inventory(uuid, 'VCPU')
-            ram_inventory = placement.inventory(uuid, 'MEMORY_MB')
+            inventories.append((
+                name,
+                placement.inventory_async(uuid, 'VCPU'),
+                placement.inventory_async(uuid, 'MEMORY_MB')))
 
-            ar['cpu'][name] = cpu_inventory['allocation_ratio']
-            ar['ram'][name] = ram_inventory['allocation_ratio']
+        for name, cpu_inventory, ram_inventory in inventories:
+            ar['cpu'][name] = cpu_inventory.result()['allocation_ratio']
+            ar['ram'][name] = ram_inventory.result()['allocation_ratio']
 
         return ar
 
@@ -149,7 +245,10 @@ class HypervisorsStateJob(Job):
         return ar
 
     def _get_hypervisor_load(self, hypervisor):
-        data = openstack.hypervisor_uptime(hypervisor=hypervisor)
+        if self._uptimes and hypervisor in self._uptimes:
+            data = self._uptimes[hypervisor].result()
+        else:
+            data = openstack.hypervisor_uptime(hypervisor=hypervisor)
         if 'uptime' not in data:
             return None
 
@@ -181,9 +280,14 @@ class HypervisorsStateJob(Job):
             'value': hypervisor_host
         }
 
+        # the values summed in the cluster totals
+        values = {}
+
         def add_sample(metric, value, tz=tz):
-            tsdb.create_sample(metric_name=metric, period=0, tags=[tag],
-                               timestamp=tz, value=value)
+            tsdb.create_gauge_sample(metric_name=metric, tags=[tag],
+                                     timestamp=tz, value=value)
+            if metric in _CLUSTER_METRICS:
+                values[metric] = value
 
         h_status = 1 if hypervisor_data['status'] == 'enabled' else 0
         add_sample(metrics.METRIC_HYPERVISOR_STATUS, h_status)
@@ -223,7 +327,7 @@ class HypervisorsStateJob(Job):
             hypervisor_data['current_workload'])
 
         if not h_state:
-            return
+            return values
         tz = datetime.datetime.utcnow()
         h_loads = self._get_hypervisor_load(hypervisor_data['id'])
         if h_loads:
@@ -232,3 +336,5 @@ class HypervisorsStateJob(Job):
             add_sample(metrics.METRIC_HYPERVISOR_LOAD_5m, h_load_5m, tz=tz)
             add_sample(metrics.METRIC_HYPERVISOR_LOAD_10m, h_load_10m, tz=tz)
             add_sample(metrics.METRIC_HYPERVISOR_LOAD_15m, h_load_15m, tz=tz)
+
+        return values
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import datetime
+
+from pymongo import ASCENDING
+
+from job import Job
+from caos_collector import ceilometer
+from caos_collector import cfg
+from caos_collector import utils
+from caos_collector.pollsters import MongoCPUTimePollster
+from caos_collector.pollsters import MongoWallClockTimePollster
+from caos_collector.pollsters import MongoWallClockTimeOcataPollster
+
+
+_RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte', '$ne', '$nin')
+
+
+def plan_stages(plan):
+    """ Walk all the stages of a query plan. """
+
+    stages = [plan]
+    while stages:
+        stage = stages.pop()
+        yield stage
+
+        if 'inputStage' in stage:
+            stages.append(stage['inputStage'])
+        stages.extend(stage.get('inputStages', []))
+
+
+def analyze_explain(explain):
+    """ Summarize the output of explain(). """
+
+    stages = list(plan_stages(explain['queryPlanner']['winningPlan']))
+    stats = explain.get('executionStats', {})
+
+    n_returned = stats.get('nReturned', 0)
+    docs_examined = stats.get('totalDocsExamined', 0)
+
+    return {
+        'collscan': any(s['stage'] == 'COLLSCAN' for s in stages),
+        'blocking_sort': any(s['stage'] == 'SORT' for s in stages),
+        'indexes': list(s['indexName'] for s in stages
+                        if s['stage'] == 'IXSCAN'),
+        'n_returned': n_returned,
+        'docs_examined': docs_examined,
+        'keys_examined': stats.get('totalKeysExamined', 0),
+        'ratio': docs_examined / float(max(n_returned, 1)),
+    }
+
+
+def recommend_index(query, sort=None):
+    """ Recommend a compound index for __query__ following the
+    Equality, Sort, Range rule. """
+
+    equality = []
+    ranges = []
+    for field, value in query.items():
+        if not isinstance(value, dict):
+            equality.append(field)
+        elif set(value) & set(_RANGE_OPERATORS):
+            ranges.append(field)
+        elif '$in' in value and sort:
+            # the results of an $in would need a blocking sort
+            ranges.append(field)
+        else:
+            equality.append(field)
+
+    sort = sort or []
+    keys = []
+    fields = (list((f, ASCENDING) for f in equality)
+              + list(sort)
+              + list((f, ASCENDING) for f in ranges))
+    for field, direction in fields:
+        if field not in list(k for k, _ in keys):
+            keys.append((field, direction))
+    return keys
+
+
+def has_index(index_information, keys):
+    """ Check if an existing index has __keys__ as prefix. """
+
+    for index in index_information.values():
+        # directions are numbers, or strings for special indexes
+        index_keys = list(
+            (k, int(d) if isinstance(d, (int, long, float)) else d)
+            for k, d in index['key'])
+        if index_keys[:len(keys)] == keys:
+            return True
+    return False
+
+
+class MongoIndexesJob(Job):
+    """Check the indexes used by the ceilometer mongodb queries"""
+
+    def __init__(self, *args, **kwargs):
+        super(MongoIndexesJob, self).__init__(
+            name=__name__, *args, **kwargs)
+
+    @staticmethod
+    def setup_parser(parser):
+        parser.add_argument(
+            '-p', '--project',
+            dest='project_id', metavar='ID',
+            required=True,
+            help='Explain the queries of project id')
+
+        parser.add_argument(
+            '-e', '--end',
+            dest='end', metavar='TS',
+            nargs='?',
+            default=utils.format_date(datetime.datetime.utcnow()),
+            help='Explain the queries of the period ending at TIMESTAMP '
+            '(default to now)')
+
+        parser.add_argument(
+            '-P', '--period',
+            dest='period', metavar='PERIOD',
+            nargs='?',
+            type=int,
+            default=3600,
+            help='Limit by period')
+
+        parser.add_argument(
+            '-r', '--ratio',
+            dest='ratio', metavar='RATIO',
+            nargs='?',
+            type=float,
+            default=10.0,
+            help='Warn when the docs examined per returned doc exceed RATIO')
+
+    def run_job(self, args):
+        # this is a diagnostic job, only ceilometer is needed
+        self.logger.info("Running job {name} with arguments: {args}"
+                         .format(name=self.name(), args=args))
+
+        if cfg.CEILOMETER_BACKEND != 'mongodb':
+            self.logger.error("Job {name} needs the mongodb backend"
+                              .format(name=self.name()))
+            return
+
+        ceilometer.initialize()
+        self._run(args)
+
+    def _run(self, args):
+        end = utils.parse_date(args.end)
+        start = end - datetime.timedelta(seconds=args.period)
+
+        indexes = {
+            'resource': ceilometer.index_information('resource'),
+            'meter': ceilometer.index_information('meter'),
+        }
+
+        recommended = []
+        for pollster_class in (MongoCPUTimePollster,
+                               MongoWallClockTimePollster,
+                               MongoWallClockTimeOcataPollster):
+            pollster = pollster_class(project_id=args.project_id,
+                                      period=args.period,
+                                      start=start,
+                                      end=end)
+
+            resources_start, resources_end = pollster.resources_range()
+            query = ceilometer.build_resources_query(
+                project_id=args.project_id,
+                meter=pollster.counter_name,
+                start=resources_start,
+                end=resources_end)
+            recommended.append(
+                self._check("resource", pollster.counter_name, query,
+                            sort=None, ratio=args.ratio))
+
+            resources = pollster.find_resources()
+            chunk = resources[:cfg.CEILOMETER_MONGODB_IN_CHUNK]
+            query = pollster.build_query(
+                chunk, timestamp_query=pollster.build_timestamp_query())
+            recommended.append(
+                self._check("meter", pollster.counter_name, query,
+                            sort=[('timestamp', ASCENDING)],
+                            ratio=args.ratio))
+
+        missing = []
+        for dbname, keys in recommended:
+            if (dbname, keys) in missing:
+                continue
+            if has_index(indexes[dbname], keys):
+                continue
+            missing.append((dbname, keys))
+
+        if not missing:
+            self.logger.info("All the recommended indexes exist")
+            return
+
+        for dbname, keys in missing:
+            keys = ", ".join("'{k}': {d}".format(k=k, d=d) for k, d in keys)
+            self.logger.info("Recommended index: "
+                             "db.{db}.createIndex({{{keys}}})"
+                             .format(db=dbname, keys=keys))
+
+    def _check(self, dbname, counter_name, query, sort, ratio):
+        explain = ceilometer.explain(dbname, query, sort=sort)
+        report = analyze_explain(explain)
+
+        self.logger.info(
+            "Query on {db} for {meter}: indexes={indexes}, "
+            "returned={n}, docs examined={docs}, keys examined={keys}"
+            .format(db=dbname,
+                    meter=counter_name,
+                    indexes=report['indexes'],
+                    n=report['n_returned'],
+                    docs=report['docs_examined'],
+                    keys=report['keys_examined']))
+
+        if report['collscan']:
+            self.logger.warn("Query on {db} for {meter} is a COLLSCAN"
+                             .format(db=dbname, meter=counter_name))
+
+        if report['blocking_sort']:
+            self.logger.warn("Query on {db} for {meter} needs a blocking SORT"
+                             .format(db=dbname, meter=counter_name))
+
+        if report['ratio'] > ratio:
+            self.logger.warn("Query on {db} for {meter} examined {r:.1f} "
+                             "docs per returned doc"
+                             .format(db=dbname,
+                                     meter=counter_name,
+                                     r=report['ratio']))
+
+        return (dbname, recommend_index(query, sort=sort))
@@ -27,13 +27,22 @@
 import datetime
 
 from job import Job
+from caos_collector.aggregates import Aggregator
 from caos_collector import cfg
 from caos_collector import metrics
 from caos_collector import openstack
+from caos_collector import sharding
 from caos_collector import tsdb
 from caos_collector import utils
 
 
+def _add_quotas(a, b):
+    # negative quotas are unlimited
+    if a < 0 or b < 0:
+        return min(a, b)
+    return a + b
+
+
 class ProjectsQuotasJob(Job):
     """The projects quotas job"""
 
@@ -57,6 +66,14 @@ class ProjectsQuotasJob(Job):
             default=None,
             help='Limit by project id')
 
+        parser.add_argument(
+            '--no-domain-totals',
+            dest='no_domain_totals',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Disable the totals of the domains')
+
     def _run(self, args):
         domain_id = args.domain_id
         project_id = args.project_id
@@ -66,14 +83,40 @@ class ProjectsQuotasJob(Job):
             # get projects from keystone
             keystone_projects = openstack.projects(domain_id=domain_id)
 
+            # only the ones of this collector, if sharded
+            keystone_projects = dict(
+                (p, keystone_projects[p])
+                for p in sharding.owned(keystone_projects.keys()))
+
+        # the totals of the domains, if all of their projects are
+        # checked
+        domain_totals = None
+        if not (args.project_id or sharding.enabled()
+                or args.no_domain_totals):
+            domain_totals = Aggregator(
+                tag_key=cfg.CAOS_DOMAIN_TAG_KEY,
+                groups=dict((p, [d['domain_id']] if d.get('domain_id')
+                             else [])
+                            for p, d in keystone_projects.items()),
+                combine=_add_quotas)
+
         for project_id, project_data in keystone_projects.items():
             project_name = project_data['name']
 
             self.logger.info("Checking quota for project {id} ({name})"
                              .format(id=project_id, name=project_name))
-            self.check_quota(project_id)
+            values = self.check_quota(project_id)
+            if domain_totals is not None:
+                domain_totals.add(member=project_id, window=None,
+                                  values=values.items())
             self.logger.info("Projects quotas updated")
 
+        if domain_totals is not None:
+            tz = datetime.datetime.utcnow()
+            for tags, _, metric_name, value in domain_totals.totals():
+                tsdb.create_gauge_sample(metric_name=metric_name, tags=tags,
+                                         timestamp=tz, value=value)
+
     def check_quota(self, project_id):
         tz = datetime.datetime.utcnow()
 
@@ -85,20 +128,15 @@ class ProjectsQuotasJob(Job):
             'value': project_id
         }
 
-        tsdb.create_sample(metric_name=metrics.METRIC_QUOTA_MEMORY,
-                           period=0,
-                           tags=[tag],
-                           timestamp=tz,
-                           value=quotas['ram'] * utils.u1_M)
-
-        tsdb.create_sample(metric_name=metrics.METRIC_QUOTA_VCPUS,
-                           period=0,
-                           tags=[tag],
-                           timestamp=tz,
-                           value=quotas['cores'])
-
-        tsdb.create_sample(metric_name=metrics.METRIC_QUOTA_INSTANCES,
-                           period=0,
-                           tags=[tag],
-                           timestamp=tz,
-                           value=quotas['instances'])
+        values = {
+            metrics.METRIC_QUOTA_MEMORY: quotas['ram'] * utils.u1_M,
+            metrics.METRIC_QUOTA_VCPUS: quotas['cores'],
+            metrics.METRIC_QUOTA_INSTANCES: quotas['instances'],
+        }
+
+        for metric_name, value in sorted(values.items()):
+            tsdb.create_gauge_sample(metric_name=metric_name,
+                                     tags=[tag],
+                                     timestamp=tz,
+                                     value=value)
+        return values
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2017 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import datetime
+
+from job import Job
+from caos_collector import cfg
+from caos_collector import metrics
+from caos_collector import openstack
+from caos_collector import rollup
+from caos_collector import sharding
+from caos_collector import tsdb
+from caos_collector import utils
+
+
+# the metrics rolled up, with the period of their samples: None for
+# the --from-period, 0 for the gauges written by
+# tsdb.create_gauge_sample()
+_PROJECT_METRICS = {
+    metrics.METRIC_VM_CPU_TIME_USAGE: None,
+    metrics.METRIC_VM_WALLCLOCK_TIME_USAGE: None,
+    metrics.METRIC_VM_VCPUS_USAGE: None,
+    metrics.METRIC_VM_DISK_USAGE: None,
+    metrics.METRIC_VM_MEMORY_USAGE: None,
+    metrics.METRIC_VM_COUNT_ACTIVE: None,
+    metrics.METRIC_VM_COUNT_DELETED: None,
+
+    metrics.METRIC_QUOTA_MEMORY: 0,
+    metrics.METRIC_QUOTA_VCPUS: 0,
+    metrics.METRIC_QUOTA_INSTANCES: 0,
+}
+
+_HYPERVISOR_METRICS = dict(
+    (m, 0) for m in metrics.METRICS if m.startswith('hypervisor.'))
+
+
+class RollupJob(Job):
+    """The rollup job"""
+
+    def __init__(self, *args, **kwargs):
+        super(RollupJob, self).__init__(
+            name=__name__, *args, **kwargs)
+
+    @staticmethod
+    def setup_parser(parser):
+        parser.add_argument(
+            '-d', '--domain',
+            dest='domain_id', metavar='ID',
+            nargs='?',
+            default=None,
+            help='Limit by domain id')
+
+        parser.add_argument(
+            '-p', '--project',
+            dest='project_id', metavar='ID',
+            nargs='?',
+            default=None,
+            help='Limit by project id')
+
+        parser.add_argument(
+            '-s', '--start',
+            dest='start', metavar='TS',
+            nargs='?',
+            default=utils.format_date(
+                datetime.datetime.utcnow() - datetime.timedelta(days=7)),
+            help='Roll up since TIMESTAMP, if the series are empty '
+            '(default to 7 days ago)')
+
+        parser.add_argument(
+            '-P', '--period',
+            dest='period', metavar='PERIOD',
+            nargs='?',
+            type=int,
+            default=86400,
+            help='Period of the rolled up samples')
+
+        parser.add_argument(
+            '-F', '--from-period',
+            dest='from_period', metavar='PERIOD',
+            nargs='?',
+            type=int,
+            default=3600,
+            help='Period of the vm usage samples which are rolled up')
+
+        parser.add_argument(
+            '-w', '--wait',
+            dest='wait', metavar='SECONDS',
+            nargs='?',
+            type=int,
+            default=86400,
+            help='Wait up to SECONDS after the end of a window for its '
+            'missing samples (default to one day)')
+
+        parser.add_argument(
+            '-g', '--gauge-function',
+            dest='gauge_function',
+            choices=rollup.GAUGE_FUNCTIONS,
+            default='avg',
+            help='How gauges are rolled up')
+
+        parser.add_argument(
+            '-M', '--metrics',
+            dest='metrics', metavar='NAMES',
+            default=None,
+            help='Comma separated metrics to roll up (default to all)')
+
+        parser.add_argument(
+            '--no-hypervisors',
+            dest='no_hypervisors',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Disable roll up of the hypervisors metrics')
+
+        parser.add_argument(
+            '-o', '--overwrite',
+            dest='overwrite',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Overwrite samples')
+
+    def _run(self, args):
+        if args.period <= args.from_period:
+            raise RuntimeError("Period must be greater than the from period")
+
+        now = datetime.datetime.utcnow()
+        start = utils.parse_date(args.start)
+
+        names = None
+        if args.metrics:
+            names = set(m.strip() for m in args.metrics.split(','))
+
+        def selected(series):
+            return dict((m, p) for m, p in series.items()
+                        if names is None or m in names)
+
+        project_metrics = selected(_PROJECT_METRICS)
+        hypervisor_metrics = selected(_HYPERVISOR_METRICS)
+
+        if args.project_id:
+            keystone_projects = openstack.project(project_id=args.project_id)
+        else:
+            keystone_projects = openstack.projects(domain_id=args.domain_id)
+
+            # only the ones of this collector, if sharded
+            keystone_projects = dict(
+                (p, keystone_projects[p])
+                for p in sharding.owned(keystone_projects.keys()))
+
+        for project_id in sorted(keystone_projects):
+            self.logger.info("Rolling up project {id}".format(id=project_id))
+            tags = [{'key': cfg.CAOS_PROJECT_TAG_KEY, 'value': project_id}]
+            for metric_name, from_period in project_metrics.items():
+                self.rollup_series(tags, metric_name, from_period,
+                                   start=start, now=now, args=args)
+
+        if args.no_hypervisors or args.project_id:
+            self.logger.info("Rollup done")
+            return
+
+        hypervisors = sharding.owned(openstack.hypervisors().keys())
+        for hypervisor in sorted(hypervisors):
+            self.logger.info("Rolling up hypervisor {name}"
+                             .format(name=hypervisor))
+            tags = [{'key': cfg.CAOS_HYPERVISOR_TAG_KEY, 'value': hypervisor}]
+            for metric_name, from_period in hypervisor_metrics.items():
+                self.rollup_series(tags, metric_name, from_period,
+                                   start=start, now=now, args=args)
+
+        self.logger.info("Rollup done")
+
+    def rollup_series(self, tags, metric_name, from_period, start, now,
+                      args):
+        """ Write the samples of the closed windows of the series, since
+        its last sample (or __start__). """
+
+        period = args.period
+        if from_period is None:
+            from_period = args.from_period
+
+        last_timestamp = tsdb.last_timestamp(tags=tags,
+                                             metric_name=metric_name,
+                                             period=period)
+        end = now
+        if from_period:
+            # only when all the samples of the window were written
+            end = min(end, tsdb.last_timestamp(tags=tags,
+                                               metric_name=metric_name,
+                                               period=from_period))
+
+        windows = rollup.windows(period, max(start, last_timestamp), end)
+        if not windows:
+            return
+
+        # the last gauge sample before the first window is kept up to
+        # the keyframe interval
+        since = windows[0][0] - datetime.timedelta(
+            seconds=max(cfg.CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL or 0,
+                        from_period))
+        samples = tsdb.samples(tags=tags, metric_name=metric_name,
+                               period=from_period, start=since,
+                               end=windows[-1][1])
+        samples.sort(key=lambda s: s['timestamp'])
+
+        is_delta = metrics.METRICS[metric_name]['type'] == 'delta'
+        for window_start, window_end in windows:
+            # the missing samples may still be written (e.g. by
+            # series_repair), or never be (e.g. no vms in that period):
+            # we wait for them, together with the following windows,
+            # so that they are rolled up on a next run.
+            missing = []
+            if from_period:
+                missing = rollup.missing(samples, from_period,
+                                         window_start, window_end)
+
+            if missing:
+                if window_end > now - datetime.timedelta(seconds=args.wait):
+                    self.logger.info(
+                        "Waiting for {n} samples of {metric} from {s} to {e}"
+                        .format(n=len(missing), metric=metric_name,
+                                s=window_start, e=window_end))
+                    break
+
+                self.logger.warn(
+                    "Rolling up {metric} from {s} to {e} without {n} "
+                    "samples".format(n=len(missing), metric=metric_name,
+                                     s=window_start, e=window_end))
+
+            if is_delta:
+                value = rollup.delta(samples, window_start, window_end)
+            else:
+                value = rollup.gauge(samples, window_start, window_end,
+                                     args.gauge_function)
+
+            if value is None:
+                continue
+
+            tsdb.create_sample(metric_name=metric_name, period=period,
+                               tags=tags, timestamp=window_end, value=value,
+                               overwrite=args.overwrite)
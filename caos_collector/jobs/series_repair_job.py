@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2017 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import argparse
+import datetime
+import os
+
+from job import Job
+from vm_usage_job import VMUsageJob
+from caos_collector import backfill
+from caos_collector import cfg
+from caos_collector import metrics
+from caos_collector import openstack
+from caos_collector import sharding
+from caos_collector import tsdb
+from caos_collector import utils
+
+
+# the meters of vm_usage, with the series checked for gaps and the
+# option disabling each of them
+_METRICS = {
+    'nova_usages': (metrics.METRIC_VM_COUNT_ACTIVE, '--no-nova-usages'),
+    'cputime': (metrics.METRIC_VM_CPU_TIME_USAGE, '--no-cputime'),
+    'wallclocktime': (metrics.METRIC_VM_WALLCLOCK_TIME_USAGE,
+                      '--no-wallclocktime'),
+}
+
+
+def ranges(timestamps, period):
+    """ Group the sorted __timestamps__ in ranges of consecutive
+    periods, as (first, last) tuples. """
+
+    ret = []
+    P = datetime.timedelta(seconds=period)
+    for ts in timestamps:
+        if ret and ts - ret[-1][1] == P:
+            ret[-1] = (ret[-1][0], ts)
+        else:
+            ret.append((ts, ts))
+    return ret
+
+
+class SeriesRepairJob(Job):
+    """The series repair job"""
+
+    def __init__(self, *args, **kwargs):
+        super(SeriesRepairJob, self).__init__(
+            name=__name__, *args, **kwargs)
+
+    @staticmethod
+    def setup_parser(parser):
+        parser.add_argument(
+            '-d', '--domain',
+            dest='domain_id', metavar='ID',
+            nargs='?',
+            default=None,
+            help='Limit by domain id')
+
+        parser.add_argument(
+            '-p', '--project',
+            dest='project_id', metavar='ID',
+            nargs='?',
+            default=None,
+            help='Limit by project id')
+
+        parser.add_argument(
+            '-s', '--start',
+            dest='start', metavar='TS',
+            nargs='?',
+            default=utils.format_date(
+                datetime.datetime.utcnow() - datetime.timedelta(days=7)),
+            help='Look for gaps since TIMESTAMP (default to 7 days ago)')
+
+        parser.add_argument(
+            '-e', '--end',
+            dest='end', metavar='TS',
+            nargs='?',
+            default=utils.format_date(datetime.datetime.utcnow()),
+            help='Look for gaps up to TIMESTAMP (default to now)')
+
+        parser.add_argument(
+            '-P', '--period',
+            dest='period', metavar='PERIOD',
+            nargs='?',
+            type=int,
+            default=3600,
+            help='Limit by period')
+
+        parser.add_argument(
+            '-M', '--metrics',
+            dest='metrics', metavar='NAMES',
+            default=','.join(sorted(_METRICS)),
+            help='Comma separated metrics to repair '
+            '(default to {m})'.format(m=','.join(sorted(_METRICS))))
+
+        parser.add_argument(
+            '-n', '--dry-run',
+            dest='dry_run',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Only report the gaps')
+
+        parser.add_argument(
+            '--ledger',
+            dest='ledger', metavar='FILE',
+            default=None,
+            help='Ledger of the repaired samples '
+            '(default to state_dir/series_repair.sqlite)')
+
+        parser.add_argument(
+            '--restart',
+            dest='restart',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Retry the samples already repaired')
+
+    def _run(self, args):
+        start = utils.parse_date(args.start)
+        end = min(utils.parse_date(args.end), datetime.datetime.utcnow())
+        period = args.period
+
+        names = list(m.strip() for m in args.metrics.split(',') if m.strip())
+        for name in names:
+            if name not in _METRICS:
+                raise RuntimeError("Unknown metric `{m}`".format(m=name))
+
+        if args.project_id:
+            keystone_projects = openstack.project(project_id=args.project_id)
+        else:
+            keystone_projects = openstack.projects(domain_id=args.domain_id)
+
+            # only the ones of this collector, if sharded
+            keystone_projects = dict(
+                (p, keystone_projects[p])
+                for p in sharding.owned(keystone_projects.keys()))
+
+        # vm_usage writes no sample when there is nothing to measure
+        # (e.g. a project without instances), so such gaps cannot be
+        # filled: the repaired ones are kept in the ledger and not
+        # tried again
+        ledger = backfill.Ledger(
+            args.ledger or os.path.join(cfg.STATE_DIR,
+                                        'series_repair.sqlite'))
+        if args.restart:
+            ledger.clear()
+
+        try:
+            repaired = 0
+            for project_id in sorted(keystone_projects):
+                for name in names:
+                    repaired += self._repair_series(
+                        ledger, project_id, name, start=start, end=end,
+                        period=period, dry_run=args.dry_run)
+        finally:
+            ledger.close()
+
+        self.logger.info("Series repaired: {n} samples".format(n=repaired))
+
+    def _repair_series(self, ledger, project_id, name, start, end, period,
+                       dry_run):
+        metric_name, _ = _METRICS[name]
+        tags = [{'key': cfg.CAOS_PROJECT_TAG_KEY, 'value': project_id}]
+
+        def key(ts):
+            return "{m}/{p}/{period}/{ts}".format(
+                m=name, p=project_id, period=period,
+                ts=utils.format_date(ts))
+
+        # a dry run doesn't create the missing series
+        samples = tsdb.samples(tags=tags, metric_name=metric_name,
+                               period=period, start=start, end=end,
+                               create=not dry_run)
+        missing = utils.missing_timestamps(
+            period, start, end, (s['timestamp'] for s in samples))
+
+        gaps = list(ts for ts in missing if not ledger.is_done(key(ts)))
+        if not gaps:
+            return 0
+
+        self.logger.info("Series {m} of project {p} misses {n} samples "
+                         "({t} already repaired)"
+                         .format(m=metric_name, p=project_id, n=len(gaps),
+                                 t=len(missing) - len(gaps)))
+        if dry_run:
+            return 0
+
+        for first, last in ranges(gaps, period):
+            self._repair(project_id, name, first, last, period)
+            ledger.done_all(key(ts) for ts in gaps if first <= ts <= last)
+        return len(gaps)
+
+    def _repair(self, project_id, name, first, last, period):
+        """ Run vm_usage for the meter __name__ of __project_id__,
+        from the sample at __first__ to the one at __last__. """
+
+        self.logger.info("Repairing {name} of project {p} from {first} "
+                         "to {last}"
+                         .format(name=name, p=project_id,
+                                 first=first, last=last))
+
+        end = last + datetime.timedelta(seconds=period)
+        cmdline = [
+            '--project', project_id,
+            '--start', utils.format_date(first),
+            '--end', utils.format_date(end),
+            '--period', str(period),
+        ]
+        cmdline.extend(o for m, (_, o) in sorted(_METRICS.items())
+                       if m != name)
+
+        parser = argparse.ArgumentParser()
+        VMUsageJob.setup_parser(parser)
+        VMUsageJob()._run(parser.parse_args(cmdline))
@@ -25,23 +25,52 @@
 ################################################################################
 
 import datetime
+import os
+import threading
+import time
 
 from job import Job
+from caos_collector import cache
 from caos_collector import cfg
+from caos_collector.accumulator import Accumulator
+from caos_collector.aggregates import Aggregator
 from caos_collector import metrics
 from caos_collector import openstack
+from caos_collector.pipeline import Pipeline
+from caos_collector.pipeline import Stage
+from caos_collector import sharding
 from caos_collector import tsdb
 from caos_collector import utils
+from caos_collector.pollsters import MongoCeilometerPollster
 from caos_collector.pollsters import MongoCPUTimePollster
 from caos_collector.pollsters import MongoWallClockTimePollster
 from caos_collector.pollsters import MongoWallClockTimeOcataPollster
+from caos_collector.pollsters import MongoMultiMeterPollster
+from caos_collector.pollsters import GnocchiCeilometerPollster
 from caos_collector.pollsters import GnocchiCPUTimePollster
 from caos_collector.pollsters import GnocchiWallClockTimeOcataPollster
+from caos_collector.pollsters import GnocchiMultiMeterPollster
+from caos_collector.pollsters import GnocchiAggregatesPollster
+from caos_collector.pollsters import GnocchiAggregatesCPUTimePollster
+from caos_collector.pollsters import GnocchiAggregatesWallClockTimeOcataPollster  # noqa: E501
+
+
+# marks a window missing from the results cache, as None is a result
+_MISSING = object()
 
 
 class VMUsageJob(Job):
     """The VM usage job"""
 
+    _project_ids = None
+    _pollster_classes = None
+    _values = None
+    _validate_aggregates = False
+    _accumulator = None
+    _lock = None
+    _window_locks = None
+    _domain_totals = None
+
     def __init__(self, *args, **kwargs):
         super(VMUsageJob, self).__init__(
             name=__name__, *args, **kwargs)
@@ -108,6 +137,14 @@ class VMUsageJob(Job):
             default=False,
             help='Only update current period')
 
+        parser.add_argument(
+            '--no-incremental',
+            dest='no_incremental',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Measure the whole current period at each run')
+
         parser.add_argument(
             '--no-cputime',
             dest='no_cputime',
@@ -132,6 +169,51 @@ class VMUsageJob(Job):
             default=False,
             help='Disable collection of Nova Usages')
 
+        parser.add_argument(
+            '--fetch-workers',
+            dest='fetch_workers', metavar='N',
+            type=int,
+            default=1,
+            help='Number of concurrent measures')
+
+        parser.add_argument(
+            '--compute-workers',
+            dest='compute_workers', metavar='N',
+            type=int,
+            default=1,
+            help='Number of concurrent sample computations')
+
+        parser.add_argument(
+            '--write-workers',
+            dest='write_workers', metavar='N',
+            type=int,
+            default=1,
+            help='Number of concurrent writes to caos-tsdb')
+
+        parser.add_argument(
+            '--queue-size',
+            dest='queue_size', metavar='N',
+            type=int,
+            default=100,
+            help='Maximum number of items waiting between stages')
+
+        parser.add_argument(
+            '--validate-aggregates',
+            dest='validate_aggregates',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Compare gnocchi server-side aggregates with client-side '
+            'values')
+
+        parser.add_argument(
+            '--no-domain-totals',
+            dest='no_domain_totals',
+            action='store_const',
+            const=True,
+            default=False,
+            help='Disable the totals of the domains')
+
     def _run(self, args):
         domain_id = args.domain_id
         project_id = args.project_id
@@ -157,6 +239,82 @@ class VMUsageJob(Job):
             # get projects from keystone
             keystone_projects = openstack.projects(domain_id=domain_id)
 
+            # only the ones of this collector, if sharded
+            keystone_projects = dict(
+                (p, keystone_projects[p])
+                for p in sharding.owned(keystone_projects.keys()))
+
+        # the meters measured at once, see _measure()
+        self._pollster_classes = []
+        if not args.no_cputime:
+            self._pollster_classes.append(self._cpu_time_pollster_class())
+        if not args.no_wallclocktime:
+            self._pollster_classes.append(
+                self._wallclock_time_pollster_class())
+
+        # values measured at once for all the projects, indexed by
+        # (counter_name, start, end, project_id or None)
+        self._project_ids = keystone_projects.keys()
+        self._values = {}
+        self._lock = threading.Lock()
+        self._window_locks = {}
+        self._validate_aggregates = args.validate_aggregates
+
+        # the current period is measured incrementally, see _measure()
+        self._accumulator = None
+        if args.current and not args.no_incremental:
+            self._accumulator = Accumulator(
+                os.path.join(cfg.STATE_DIR, 'vm_usage_current.json'))
+
+        # the totals of the domains, if all of their projects are
+        # measured
+        self._domain_totals = None
+        if not (project_id or sharding.enabled() or args.no_domain_totals):
+            self._domain_totals = Aggregator(
+                tag_key=cfg.CAOS_DOMAIN_TAG_KEY,
+                groups=dict((p, [d['domain_id']] if d.get('domain_id')
+                             else [])
+                            for p, d in keystone_projects.items()))
+
+        # the windows are measured, converted to samples and written
+        # concurrently
+        pipeline = Pipeline([
+            Stage('fetch', self._fetch, workers=args.fetch_workers),
+            Stage('compute', self._compute, workers=args.compute_workers),
+            Stage('write', self._write, workers=args.write_workers),
+        ], queue_size=args.queue_size)
+
+        pipeline.run(self._windows(keystone_projects=keystone_projects,
+                                   start=start, end=end, period=period,
+                                   overwrite=overwrite, args=args))
+
+        if self._domain_totals is not None:
+            totals = self._domain_totals.totals()
+            for tags, window, metric_name, value in totals:
+                _, period, timestamp, overwrite = window
+                tsdb.create_sample(metric_name=metric_name, period=period,
+                                   tags=tags, timestamp=timestamp,
+                                   value=value, overwrite=overwrite)
+
+        self.logger.info("VM usages updated")
+
+        if self._accumulator is not None:
+            self._accumulator.save()
+
+    def _windows(self, keystone_projects, start, end, period, overwrite,
+                 args):
+        """ The windows to be measured, see _fetch(). """
+
+        def window(kind, ts):
+            return {
+                'kind': kind,
+                'project_id': project_id,
+                'period': period,
+                'start': ts - datetime.timedelta(seconds=period),
+                'end': ts,
+                'overwrite': overwrite,
+            }
+
         for project_id, project_data in keystone_projects.items():
             project_name = project_data['name']
 
@@ -169,12 +327,7 @@ class VMUsageJob(Job):
                 grid = self._grid(start=start, end=end, period=period,
                                   current=args.current, misfire=False)
                 for ts in grid:
-                    self.check_nova_usage(
-                        project_id=project_id,
-                        period=period,
-                        end=ts,
-                        start=ts - datetime.timedelta(seconds=period),
-                        overwrite=overwrite)
+                    yield window('nova_usage', ts)
 
             if args.no_cputime:
                 self.logger.info("CpuTime collection disabled by --no-cputime")
@@ -194,12 +347,7 @@ class VMUsageJob(Job):
                     last_timestamp=last_timestamp)
 
                 for ts in grid:
-                    self.check_cpu_time(
-                        project_id=project_id,
-                        period=period,
-                        end=ts,
-                        start=ts - datetime.timedelta(seconds=period),
-                        overwrite=overwrite)
+                    yield window('cpu_time', ts)
 
             if args.no_wallclocktime:
                 self.logger.info("WallClockTime collection disabled by --no-wallclocktime")
@@ -219,14 +367,47 @@ class VMUsageJob(Job):
                     last_timestamp=last_timestamp)
 
                 for ts in grid:
-                    self.check_wallckock_time(
-                        project_id=project_id,
-                        period=period,
-                        end=ts,
-                        start=ts - datetime.timedelta(seconds=period),
-                        overwrite=overwrite)
-
-            self.logger.info("VM usages updated")
+                    yield window('wallclock_time', ts)
+
+    def _fetch(self, window):
+        fetch = getattr(self, 'fetch_' + window['kind'])
+        window['data'] = fetch(project_id=window['project_id'],
+                               period=window['period'],
+                               start=window['start'],
+                               end=window['end'])
+        return window
+
+    def _compute(self, window):
+        compute = getattr(self, 'compute_' + window['kind'])
+        tags = [{
+            'key': cfg.CAOS_PROJECT_TAG_KEY,
+            'value': window['project_id']
+        }]
+
+        samples = []
+        for metric_name, value in compute(window['data']):
+            samples.append({
+                'metric_name': metric_name,
+                'period': window['period'],
+                'tags': tags,
+                'timestamp': window['end'],
+                'value': value,
+                'overwrite': window['overwrite'],
+            })
+        window['samples'] = samples
+        return window
+
+    def _write(self, window):
+        for sample in window['samples']:
+            tsdb.create_sample(**sample)
+
+        if self._domain_totals is not None:
+            self._domain_totals.add(
+                member=window['project_id'],
+                window=(window['kind'], window['period'], window['end'],
+                        window['overwrite']),
+                values=((s['metric_name'], s['value'])
+                        for s in window['samples']))
 
     def _grid(self, start, end, period, current, misfire,
               last_timestamp=utils.EPOCH):
@@ -260,44 +441,172 @@ class VMUsageJob(Job):
 
         return grid
 
-    def check_nova_usage(self, project_id, period, start, end, overwrite):
+    @staticmethod
+    def _multi_meter_class(pollster):
+        if isinstance(pollster, GnocchiAggregatesPollster):
+            return None
+        if isinstance(pollster, GnocchiCeilometerPollster):
+            return GnocchiMultiMeterPollster
+        if isinstance(pollster, MongoCeilometerPollster):
+            return MongoMultiMeterPollster
+        return None
+
+    def _measure(self, pollster):
+        # the results are shared with the other runs until new samples
+        # can change them: a closed window is keyed by the window alone
+        # (late samples are seen once the entry expires), an open one
+        # by the polling period. No query is needed to build the key.
+        results = cache.get_cache('pollster_results',
+                                  cfg.CEILOMETER_RESULTS_CACHE_SIZE,
+                                  ttl=cfg.CEILOMETER_RESULTS_CACHE_TTL)
+        results_key = (cfg.CEILOMETER_BACKEND, pollster.counter_name,
+                       pollster.project_id, pollster.start, pollster.end,
+                       pollster.high_water_mark())
+
+        value = results.get(results_key, _MISSING)
+        if value is _MISSING:
+            value = self._measure_window(pollster)
+            results.put(results_key, value)
+        return value
+
+    def _measure_window(self, pollster):
+        # the samples of the current period are accumulated across
+        # runs, only mongodb pollsters fold raw samples
+        if (self._accumulator is not None
+                and isinstance(pollster, MongoCeilometerPollster)):
+            return self._accumulator.measure(pollster)
+
+        # gnocchi can aggregate all the projects in a single query, so
+        # we measure the whole domain the first time a window is
+        # requested and then serve the other projects from there.
+        gnocchi = isinstance(pollster, GnocchiCeilometerPollster)
+        scope = None if gnocchi else pollster.project_id
+
+        key = (pollster.counter_name, pollster.start, pollster.end, scope)
+        with self._window_lock(pollster.start, pollster.end, scope):
+            if key not in self._values:
+                self._measure_all(pollster, scope)
+
+        return self._values[key].get(pollster.project_id)
+
+    def _window_lock(self, *window):
+        # windows are measured once even by concurrent fetch workers
+        with self._lock:
+            return self._window_locks.setdefault(window, threading.Lock())
+
+    def _measure_all(self, pollster, scope):
+        # the other meters needed by the job are measured in the same
+        # backend pass, when possible
+        multi_meter_class = self._multi_meter_class(pollster)
+        pollsters = [pollster]
+        if multi_meter_class is not None:
+            for pollster_class in self._pollster_classes:
+                other = pollster_class(project_id=pollster.project_id,
+                                       period=pollster.period,
+                                       start=pollster.start,
+                                       end=pollster.end)
+                if other.counter_name == pollster.counter_name:
+                    continue
+                if self._multi_meter_class(other) is not multi_meter_class:
+                    continue
+                pollsters.append(other)
+
+        counter_names = list(p.counter_name for p in pollsters)
+        if scope is None:
+            self.logger.info(
+                "Measuring {meters} for {n} projects from {s} to {e}"
+                .format(meters=counter_names,
+                        n=len(self._project_ids),
+                        s=pollster.start, e=pollster.end))
+        t0 = time.time()
+
+        if len(pollsters) == 1:
+            if scope is None:
+                values = {
+                    pollster.counter_name:
+                    pollster.measure_projects(self._project_ids)
+                }
+            else:
+                values = {
+                    pollster.counter_name: {scope: pollster.measure()}
+                }
+        elif scope is None:
+            multi_meter = multi_meter_class(pollsters)
+            values = multi_meter.measure_projects(self._project_ids)
+        else:
+            multi_meter = multi_meter_class(pollsters)
+            values = dict((counter_name, {scope: value})
+                          for counter_name, value
+                          in multi_meter.measure().items())
+
+        elapsed = time.time() - t0
+        self.logger.debug("Measured {meters} in {t:.3f}s"
+                          .format(meters=counter_names, t=elapsed))
+
+        if (self._validate_aggregates
+                and isinstance(pollster, GnocchiAggregatesPollster)):
+            self._check_aggregates(pollster,
+                                   values[pollster.counter_name],
+                                   elapsed)
+
+        for counter_name, v in values.items():
+            key = (counter_name, pollster.start, pollster.end, scope)
+            self._values[key] = v
+
+    def _check_aggregates(self, pollster, values, elapsed):
+        reference = pollster.reference_class(project_id=None,
+                                             period=pollster.period,
+                                             start=pollster.start,
+                                             end=pollster.end)
+        t0 = time.time()
+        reference_values = reference.measure_projects(self._project_ids)
+        reference_elapsed = time.time() - t0
+
+        self.logger.info(
+            "Aggregates for {meter} from {s} to {e}: "
+            "server-side got {n} measures in {t:.3f}s, "
+            "client-side got {rn} measures in {rt:.3f}s"
+            .format(meter=pollster.counter_name,
+                    s=pollster.start, e=pollster.end,
+                    n=pollster.n_measures, t=elapsed,
+                    rn=reference.n_measures, rt=reference_elapsed))
+
+        tolerance = cfg.CEILOMETER_GNOCCHI_AGGREGATES_TOLERANCE
+        for project_id in set(values.keys() + reference_values.keys()):
+            value = values.get(project_id, 0)
+            reference_value = reference_values.get(project_id, 0)
+
+            error = abs(value - reference_value)
+            if reference_value:
+                error = error / abs(reference_value)
+
+            if error > tolerance:
+                self.logger.warn(
+                    "Aggregates for {meter} of project {id} differ: "
+                    "server-side {v}, client-side {rv} (error {err:.2%})"
+                    .format(meter=pollster.counter_name, id=project_id,
+                            v=value, rv=reference_value, err=error))
+
+    def fetch_nova_usage(self, project_id, period, start, end):
         self.logger.info(
             "Checking nova usages for project {id} from {s} to {e}"
             .format(id=project_id, name=project_id, s=start, e=end))
 
-        usage = openstack.nova_usage(start=start, end=end,
-                                     project_id=project_id)
-
-        tag = {
-            'key': cfg.CAOS_PROJECT_TAG_KEY,
-            'value': project_id
-        }
+        return openstack.nova_usage(start=start, end=end,
+                                    project_id=project_id)
 
+    def compute_nova_usage(self, usage):
         if 'total_vcpus_usage' in usage:
-            tsdb.create_sample(metric_name=metrics.METRIC_VM_VCPUS_USAGE,
-                               period=period,
-                               tags=[tag],
-                               timestamp=end,
-                               value=usage['total_vcpus_usage'] * utils.u1_hour,
-                               overwrite=overwrite)
+            yield (metrics.METRIC_VM_VCPUS_USAGE,
+                   usage['total_vcpus_usage'] * utils.u1_hour)
 
         if 'total_local_gb_usage' in usage:
-            tsdb.create_sample(
-                metric_name=metrics.METRIC_VM_DISK_USAGE,
-                period=period,
-                tags=[tag],
-                timestamp=end,
-                value=usage['total_local_gb_usage'] * utils.u1_G * utils.u1_hour,  # noqa: E501
-                overwrite=overwrite)
+            yield (metrics.METRIC_VM_DISK_USAGE,
+                   usage['total_local_gb_usage'] * utils.u1_G * utils.u1_hour)
 
         if 'total_memory_mb_usage' in usage:
-            tsdb.create_sample(
-                metric_name=metrics.METRIC_VM_MEMORY_USAGE,
-                period=period,
-                tags=[tag],
-                timestamp=end,
-                value=usage['total_memory_mb_usage'] * utils.u1_M * utils.u1_hour,  # noqa: E501
-                overwrite=overwrite)
+            yield (metrics.METRIC_VM_MEMORY_USAGE,
+                   usage['total_memory_mb_usage'] * utils.u1_M * utils.u1_hour)
 
         instances = []
         deleted_instances = []
@@ -309,83 +618,66 @@ class VMUsageJob(Job):
                     deleted_instances.append(server_usage)
                 else:
                     instances.append(server_usage)
-        tsdb.create_sample(metric_name=metrics.METRIC_VM_COUNT_ACTIVE,
-                           period=period,
-                           tags=[tag],
-                           timestamp=end,
-                           value=len(instances),
-                           overwrite=overwrite)
-
-        tsdb.create_sample(metric_name=metrics.METRIC_VM_COUNT_DELETED,
-                           period=period,
-                           tags=[tag],
-                           timestamp=end,
-                           value=len(deleted_instances),
-                           overwrite=overwrite)
-
-    def check_cpu_time(self, project_id, period, start, end, overwrite):
-        self.logger.info(
-            "Checking cpu time for project {id} from {s} to {e}"
-            .format(id=project_id, name=project_id, s=start, e=end))
 
+        yield (metrics.METRIC_VM_COUNT_ACTIVE, len(instances))
+        yield (metrics.METRIC_VM_COUNT_DELETED, len(deleted_instances))
+
+    @staticmethod
+    def _cpu_time_pollster_class():
         if cfg.CEILOMETER_BACKEND == 'gnocchi':
-            pollster_class = GnocchiCPUTimePollster
+            if cfg.CEILOMETER_GNOCCHI_SERVER_SIDE_AGGREGATES:
+                return GnocchiAggregatesCPUTimePollster
+            return GnocchiCPUTimePollster
         elif cfg.CEILOMETER_BACKEND == 'mongodb':
-            pollster_class = MongoCPUTimePollster
+            return MongoCPUTimePollster
 
+    @staticmethod
+    def _wallclock_time_pollster_class():
+        if cfg.OPENSTACK_VERSION < 'ocata':
+            return MongoWallClockTimePollster
+
+        if cfg.CEILOMETER_BACKEND == 'gnocchi':
+            if cfg.CEILOMETER_GNOCCHI_SERVER_SIDE_AGGREGATES:
+                return GnocchiAggregatesWallClockTimeOcataPollster
+            return GnocchiWallClockTimeOcataPollster
+        elif cfg.CEILOMETER_BACKEND == 'mongodb':
+            return MongoWallClockTimeOcataPollster
+
+    def fetch_cpu_time(self, project_id, period, start, end):
+        self.logger.info(
+            "Checking cpu time for project {id} from {s} to {e}"
+            .format(id=project_id, name=project_id, s=start, e=end))
+
+        pollster_class = self._cpu_time_pollster_class()
         pollster = pollster_class(
             project_id=project_id,
             period=period,
             start=start,
             end=end)
-        sample = pollster.measure()
+        return self._measure(pollster)
+
+    def compute_cpu_time(self, sample):
         if sample is None:
             self.logger.info("Skipping null cpu time sample")
             return
 
-        tag = {
-            'key': cfg.CAOS_PROJECT_TAG_KEY,
-            'value': project_id
-        }
-
-        tsdb.create_sample(metric_name=metrics.METRIC_VM_CPU_TIME_USAGE,
-                           period=period,
-                           tags=[tag],
-                           timestamp=end,
-                           overwrite=overwrite,
-                           value=sample)
+        yield (metrics.METRIC_VM_CPU_TIME_USAGE, sample)
 
-    def check_wallckock_time(self, project_id, period, start, end, overwrite):
+    def fetch_wallclock_time(self, project_id, period, start, end):
         self.logger.info(
             "Checking wallclocktime time for project {id} from {s} to {e}"
             .format(id=project_id, name=project_id, s=start, e=end))
 
-        if cfg.OPENSTACK_VERSION < 'ocata':
-            pollster_class = MongoWallClockTimePollster
-        else:
-            if cfg.CEILOMETER_BACKEND == 'gnocchi':
-                pollster_class = GnocchiWallClockTimeOcataPollster
-            elif cfg.CEILOMETER_BACKEND == 'mongodb':
-                pollster_class = MongoWallClockTimeOcataPollster
-
+        pollster_class = self._wallclock_time_pollster_class()
         pollster = pollster_class(project_id=project_id,
                                   period=period,
                                   start=start,
                                   end=end)
+        return self._measure(pollster)
 
-        sample = pollster.measure()
+    def compute_wallclock_time(self, sample):
         if sample is None:
             self.logger.info("Skipping null wallclocktime time sample")
             return
 
-        tag = {
-            'key': cfg.CAOS_PROJECT_TAG_KEY,
-            'value': project_id
-        }
-
-        tsdb.create_sample(metric_name=metrics.METRIC_VM_WALLCLOCK_TIME_USAGE,
-                           period=period,
-                           tags=[tag],
-                           timestamp=end,
-                           overwrite=overwrite,
-                           value=sample)
+        yield (metrics.METRIC_VM_WALLCLOCK_TIME_USAGE, sample)
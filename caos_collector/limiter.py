@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import contextlib
+import functools
+import threading
+import time
+
+import cfg
+import log
+
+
+logger = log.get_logger(__name__)
+
+
+# the limiters of the backends, indexed by name
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class Limiter(object):
+    """ Limits the calls to a backend.
+
+    The number of concurrent calls is adapted with AIMD: the limit
+    grows by one every __limit__ successful calls, up to
+    __max_concurrency__, and is multiplied by __backoff__ (down to
+    __min_concurrency__) when a call fails or takes longer than
+    __latency_target__ seconds.
+
+    If __rate__ is given, calls are also limited to __rate__ per
+    second, with bursts of up to __burst__ calls (token bucket).
+    """
+
+    name = None
+
+    # statistics, see stats()
+    calls = 0
+    errors = 0
+    decreases = 0
+
+    def __init__(self, name, max_concurrency, min_concurrency=1,
+                 latency_target=None, backoff=0.5, rate=None, burst=None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.rate = rate
+        self.burst = burst or max(rate or 0, 1)
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+        self._tokens = float(self.burst)
+        self._last_refill = time.time()
+        self._bucket_lock = threading.Lock()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+        if self.rate:
+            self._take_token()
+
+    def _take_token(self):
+        while True:
+            with self._bucket_lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def release(self, latency, error=False):
+        with self._condition:
+            self.in_flight -= 1
+            self.calls += 1
+            if error:
+                self.errors += 1
+
+            congested = (self.latency_target
+                         and latency > self.latency_target)
+            if error or congested:
+                limit = max(self.min_concurrency, self.limit * self.backoff)
+                if int(limit) < int(self.limit):
+                    self.decreases += 1
+                    logger.debug("Limiting {name} to {n} concurrent calls"
+                                 .format(name=self.name, n=int(limit)))
+                self.limit = limit
+            else:
+                self.limit = min(self.max_concurrency,
+                                 self.limit + 1.0 / self.limit)
+
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        t0 = time.time()
+        try:
+            yield
+        except Exception:
+            self.release(time.time() - t0, error=True)
+            raise
+        self.release(time.time() - t0)
+
+    def stats(self):
+        return {
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'calls': self.calls,
+            'errors': self.errors,
+            'decreases': self.decreases,
+        }
+
+
+def _options(name):
+    limits = cfg.LIMITS or {}
+
+    options = {
+        'max_concurrency': cfg.DEFAULT_LIMITS_MAX_CONCURRENCY,
+        'latency_target': cfg.DEFAULT_LIMITS_LATENCY_TARGET,
+        'rate': cfg.DEFAULT_LIMITS_RATE,
+        'burst': cfg.DEFAULT_LIMITS_BURST,
+    }
+
+    # the default ones, then the ones of the backend
+    for key in ('default', name):
+        options.update(limits.get(key) or {})
+    return options
+
+
+def get_limiter(name):
+    """ The Limiter of the backend __name__, configured by the
+    `limits` option. """
+
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = Limiter(name, **_options(name))
+        return _limiters[name]
+
+
+def limited(name):
+    """ Decorates a function calling the backend __name__, see
+    Limiter. """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_limiter(name).slot():
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report_stats():
+    for name, l in sorted(_limiters.items()):
+        logger.info("Limiter {name}: limit {limit}, {in_flight} in flight, "
+                    "{calls} calls, {errors} errors, {decreases} decreases"
+                    .format(name=name, **l.stats()))
@@ -34,7 +34,10 @@ from gnocchiclient import client as gnocchi_client
 from gnocchiclient import exceptions as gnocchi_client_exceptions
 
 import cfg
+import limiter
 import log
+import singleflight
+import transport
 from placement import PlacementSessionClient
 
 
@@ -66,7 +69,9 @@ def initialize():
     }
 
     auth = v3.Password(**os_envs)
-    _keystone_session = session.Session(auth=auth, verify=cfg.KEYSTONE_CACERT)
+    # the connections are shared with the other REST calls
+    _keystone_session = session.Session(auth=auth, verify=cfg.KEYSTONE_CACERT,
+                                        session=transport.session())
 
 
 def get_keystone_client():
@@ -109,6 +114,8 @@ def get_gnocchi_client():
         raise OpenstackError(e)
 
 
+@singleflight.coalesced('projects')
+@limiter.limited('keystone')
 def projects(domain_id=None):
     logger.debug("Querying projects from keystone...")
     keystone = get_keystone_client()
@@ -125,6 +132,8 @@ def projects(domain_id=None):
     return keystone_projects
 
 
+@singleflight.coalesced('project')
+@limiter.limited('keystone')
 def project(project_id):
     logger.debug("Querying project from keystone...")
     keystone = get_keystone_client()
@@ -139,6 +148,7 @@ def project(project_id):
     return ret
 
 
+@limiter.limited('keystone')
 def domains():
     logger.debug("Querying domains from keystone...")
     keystone = get_keystone_client()
@@ -147,6 +157,7 @@ def domains():
     return keystone_domains
 
 
+@limiter.limited('nova')
 def hypervisors(detailed=False):
     logger.debug("Querying hypervisors from nova...")
     nova = get_nova_client()
@@ -157,6 +168,17 @@ def hypervisors(detailed=False):
     return nova_hypervisors
 
 
+@limiter.limited('nova')
+def aggregates():
+    logger.debug("Querying aggregates from nova...")
+    nova = get_nova_client()
+
+    nova_aggregates = nova.aggregates.list()
+    nova_aggregates = dict((a.name, a.to_dict()) for a in nova_aggregates)
+    return nova_aggregates
+
+
+@limiter.limited('nova')
 def hypervisor_uptime(hypervisor):
     logger.debug("Querying hypervisor uptime from nova...")
     nova = get_nova_client()
@@ -165,6 +187,11 @@ def hypervisor_uptime(hypervisor):
     return nova_uptime.to_dict()
 
 
+def hypervisor_uptime_async(hypervisor):
+    return transport.submit(hypervisor_uptime, hypervisor=hypervisor)
+
+
+@limiter.limited('nova')
 def project_quotas(project_id):
     logger.debug("Querying quota from nova...")
     nova = get_nova_client()
@@ -173,9 +200,15 @@ def project_quotas(project_id):
     return nova_quota.to_dict()
 
 
+@limiter.limited('nova')
 def nova_usage(start, end, project_id):
     nova = get_nova_client()
     nova_usage = nova.usage.get(tenant_id=project_id,
                                 start=start,
                                 end=end)
     return nova_usage.to_dict()
+
+
+def nova_usage_async(start, end, project_id):
+    return transport.submit(nova_usage, start=start, end=end,
+                            project_id=project_id)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import Queue
+import sys
+import threading
+import time
+
+import log
+
+
+logger = log.get_logger(__name__)
+
+# tells the workers of a stage that there are no more items
+_DONE = object()
+
+
+class Stage(object):
+    """ A stage of a Pipeline, calling __func__ on each item in up to
+    __workers__ threads.
+
+    The result is passed to the next stage, unless it is None.
+    """
+
+    name = None
+    func = None
+    workers = None
+
+    # statistics, see Pipeline.report()
+    processed = 0
+    busy = 0.0
+    max_depth = 0
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+
+class Pipeline(object):
+    """ Runs the items through the __stages__ concurrently.
+
+    The stages are connected by queues of at most __queue_size__
+    items, so that a slow stage blocks the ones before it. If a stage
+    raises, the remaining items are discarded and run() raises the
+    same exception.
+    """
+
+    stages = None
+    queue_size = None
+
+    def __init__(self, stages, queue_size):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items):
+        self._queues = list(Queue.Queue(self.queue_size)
+                            for _ in self.stages)
+        self._running = list(s.workers for s in self.stages)
+        self._lock = threading.Lock()
+        self._abort = threading.Event()
+        self._error = None
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                t = threading.Thread(
+                    target=self._worker, args=(i, ),
+                    name="{stage}-{n}".format(stage=stage.name, n=n))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+        try:
+            for item in items:
+                if self._abort.is_set():
+                    break
+                self._put(0, item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                self._queues[0].put(_DONE)
+
+            for t in threads:
+                t.join()
+
+        self.report()
+
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def _put(self, i, item):
+        queue = self._queues[i]
+        queue.put(item)
+
+        stage = self.stages[i]
+        stage.max_depth = max(stage.max_depth, queue.qsize())
+
+    def _worker(self, i):
+        stage = self.stages[i]
+        queue = self._queues[i]
+        last_stage = i == len(self.stages) - 1
+
+        while True:
+            item = queue.get()
+            if item is _DONE:
+                break
+
+            # drain the queue, so that the stages before don't block
+            if self._abort.is_set():
+                continue
+
+            t0 = time.time()
+            try:
+                result = stage.func(item)
+            except Exception:
+                with self._lock:
+                    if self._error is None:
+                        self._error = sys.exc_info()
+                self._abort.set()
+                continue
+            finally:
+                with self._lock:
+                    stage.processed += 1
+                    stage.busy += time.time() - t0
+
+            if result is not None and not last_stage:
+                self._put(i + 1, result)
+
+        with self._lock:
+            self._running[i] -= 1
+            done = self._running[i] == 0
+
+        # the last worker of the stage stops the next one
+        if done and not last_stage:
+            for _ in range(self.stages[i + 1].workers):
+                self._queues[i + 1].put(_DONE)
+
+    def report(self):
+        for stage in self.stages:
+            logger.info("Stage {name}: {n} items, {w} workers, "
+                        "busy {t:.3f}s, max queue depth {d}"
+                        .format(name=stage.name, n=stage.processed,
+                                w=stage.workers, t=stage.busy,
+                                d=stage.max_depth))
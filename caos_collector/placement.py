@@ -25,7 +25,10 @@
 ################################################################################
 
 import cfg
+import limiter
 import log
+import singleflight
+import transport
 
 # Based on https://github.com/openstack/osc-placement/blob/master/osc_placement/http.py
 
@@ -76,6 +79,7 @@ class PlacementSessionClient(object):
         self.session = session
         self.version = version
 
+    @limiter.limited('placement')
     def request(self, method, url, **kwargs):
         api_version = "{service} {version}".format(
             service=PLACEMENT_NAME, version=self.version)
@@ -102,8 +106,14 @@ class PlacementSessionClient(object):
 
         return resources
 
+    @singleflight.coalesced(
+        'placement_inventory',
+        key=lambda self, uuid, resource_class: (uuid, resource_class))
     def inventory(self, uuid, resource_class):
         URL = '/resource_providers/{uuid}/inventories/{resource_class}'.format(
             uuid=uuid, resource_class=resource_class)
         data = self.get(URL).json()
         return data
+
+    def inventory_async(self, uuid, resource_class):
+        return transport.submit(self.inventory, uuid, resource_class)
@@ -27,6 +27,7 @@
 from pymongo import ASCENDING
 from bson import SON
 import datetime
+import math
 
 
 import ceilometer
@@ -37,6 +38,14 @@ import utils
 
 logger = log.get_logger(__name__)
 
+# slack added to the observed cadence, to tolerate jitter
+MARGIN_SLACK = 0.1
+
+# the cadence of the samples observed by the last measure (see
+# CeilometerPollster.learn_cadence()), indexed by (counter_name,
+# project_id)
+_cadences = {}
+
 
 class Pollster(object):
     period = None
@@ -52,6 +61,20 @@ class Pollster(object):
         raise NotImplementedError
 
 
+class Samples(list):
+    """ The time ordered samples of a resource, as folded by
+    CeilometerPollster.fold_sample(). """
+
+    # correction of a cumulative counter: the last raw value and the
+    # delta added to the following ones
+    last_value = None
+    delta = 0
+
+    # spacing of the raw samples, see CeilometerPollster.add_sample()
+    last_timestamp = None
+    max_gap = 0
+
+
 class CeilometerPollster(Pollster):
     project_id = None
     counter_name = None
@@ -64,11 +87,83 @@ class CeilometerPollster(Pollster):
         self.counter_name = self._counter_name()
         self.ceilometer_polling_period = cfg.CEILOMETER_POLLING_PERIOD
 
-    def find_resources(self):
+    def resources_range(self):
         start = (self.start
                  - datetime.timedelta(seconds=self.ceilometer_polling_period))
         end = (self.end
                + datetime.timedelta(seconds=self.ceilometer_polling_period))
+        return start, end
+
+    def cadence_key(self):
+        return (self.counter_name, self.project_id)
+
+    def high_water_mark(self, now=None):
+        """ The latest time whose samples are covered by a measure
+        taken at __now__.
+
+        Samples after end plus the polling period don't change the
+        measure, so this is constant for a closed window. For an open
+        one it is __now__ rounded down to the polling period.
+        """
+
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        limit = self.end + datetime.timedelta(
+            seconds=self.ceilometer_polling_period)
+        if now >= limit:
+            return limit
+
+        elapsed = int((now - utils.EPOCH).total_seconds())
+        elapsed -= elapsed % self.ceilometer_polling_period
+        return utils.EPOCH + datetime.timedelta(seconds=elapsed)
+
+    def margin(self):
+        """ The margin around the window where samples are searched.
+
+        If CEILOMETER_ADAPTIVE_MARGIN is set, this is the cadence
+        observed by the last measure (see learn_cadence()), otherwise
+        the polling period.
+        """
+
+        full_margin = self.ceilometer_polling_period
+        if not cfg.CEILOMETER_ADAPTIVE_MARGIN:
+            return full_margin
+
+        cadence = _cadences.get(self.cadence_key())
+        if not cadence:
+            return full_margin
+
+        margin = int(math.ceil(cadence * (1 + MARGIN_SLACK)))
+        return min(margin, full_margin)
+
+    def learn_cadence(self, grouped_samples):
+        """ Remember the cadence of the samples in __grouped_samples__,
+        a list of Samples.
+
+        The cadence is the (lower) median over the resources of the
+        largest spacing between their samples, so that a few
+        resources with missing samples don't widen the margin of all
+        the others: those are retried by the pollsters.
+        """
+
+        gaps = sorted(s.max_gap for s in grouped_samples if s.max_gap)
+        if not gaps:
+            return
+
+        _cadences[self.cadence_key()] = gaps[(len(gaps) - 1) // 2]
+
+    def unbracketed(self, resources):
+        """ The resources whose samples don't bracket the window, from
+        a dict of resource_id -> Samples. """
+
+        return list(r for r, s in resources.items()
+                    if not s
+                    or s[0]['timestamp'] > self.start
+                    or s[-1]['timestamp'] < self.end)
+
+    def find_resources(self):
+        start, end = self.resources_range()
 
         resources = ceilometer.find_resources(project_id=self.project_id,
                                               meter=self.counter_name,
@@ -112,6 +207,71 @@ class CeilometerPollster(Pollster):
         I = utils.integrate(x, y)
         return I
 
+    def add_sample(self, samples, sample, key):
+        """ Track the spacing of the samples, then fold __sample__. """
+
+        timestamp = sample['timestamp']
+        if samples.last_timestamp is not None:
+            gap = (timestamp - samples.last_timestamp).total_seconds()
+            samples.max_gap = max(samples.max_gap, gap)
+        samples.last_timestamp = timestamp
+
+        self.fold_sample(samples, sample, key)
+
+    def fold_sample(self, samples, sample, key):
+        """ Append __sample__ to the time ordered __samples__ of a
+        resource.
+
+        Pollsters can override this to drop the samples which are not
+        needed by aggregate_resource(), so that samples can be
+        streamed with bounded memory.
+        """
+        samples.append(sample)
+
+    def fold_counter_sample(self, samples, sample, key):
+        """ Fold a sample of a cumulative counter.
+
+        The monotonicity is corrected on the fly (see
+        correct_monotonicity()), after that only the samples
+        bracketing start and end are needed to interpolate the
+        counter.
+        """
+        v = sample[key]
+        if samples:
+            if v < samples.last_value:
+                logger.debug("Correcting monotonicity: %s, %d < %d",
+                             sample, v, samples.last_value)
+                samples.delta += abs(v - samples.last_value)
+            sample[key] = v + samples.delta
+        samples.last_value = v
+
+        samples.append(sample)
+        if len(samples) < 3:
+            return
+
+        t0 = samples[-3]['timestamp']
+        t2 = samples[-1]['timestamp']
+        if (t2 <= self.start or t0 >= self.end
+                or (t0 >= self.start and t2 <= self.end)):
+            del samples[-2]
+
+    def fold_gauge_sample(self, samples, sample, key):
+        """ Fold a sample of a gauge which is integrated.
+
+        A sample with the same value of its neighbours doesn't change
+        neither the integral nor the interpolated values, so it can
+        be dropped. The first two and last two samples are always
+        kept, as aggregate_resource() may replace the first and the
+        last ones.
+        """
+        samples.append(sample)
+        if len(samples) < 5:
+            return
+
+        v = samples[-3][key]
+        if samples[-4][key] == v and samples[-2][key] == v:
+            del samples[-3]
+
     @staticmethod
     def correct_monotonicity(items, key):
         # From the information we have, we just check if some value is
@@ -148,20 +308,23 @@ class MongoCeilometerPollster(CeilometerPollster):
     def _counter_value_field(self):
         return "counter_volume"
 
-    def _projection(self):
-        # by default do not project fields (i.e. return everything)
-        return None
-
-    def build_projection(self):
-        projection = self._projection()
-        if projection is not None:
-            # we want to reduce fields, so let's start with what we surely need
-            projection.update({
-                'resource_id': 1,
-                'timestamp': 1,
-                self._counter_value_field(): 1
-            })
-        return projection
+    def build_pipeline(self, query):
+        # the counter value field (possibly nested, e.g. in
+        # resource_metadata) is lifted to the top-level `value` field,
+        # together with what we surely need
+        projection = SON([
+            ('_id', 0),
+            ('resource_id', 1),
+            ('timestamp', 1),
+            ('value', '$' + self._counter_value_field()),
+        ])
+
+        pipeline = [
+            {'$match': query},
+            {'$sort': SON([('timestamp', ASCENDING)])},
+            {'$project': projection},
+        ]
+        return pipeline
 
     def _samples_query(self):
         return []
@@ -192,45 +355,64 @@ class MongoCeilometerPollster(CeilometerPollster):
         query = SON(query_list)
         return query
 
-    def measure(self):
-        resources = self.find_resources()
-
-        # compute projection
-        projection = self.build_projection()
-
+    def build_timestamp_query(self, margin=None, since=None):
         # To capture a proper value, we need to query the values
         # between time 'start' and 'end', plus a margin given by
-        # ceilometer_polling_period. Then we interpolate according to
-        # our period.
+        # ceilometer_polling_period (see margin()). Then we
+        # interpolate according to our period.
+        if margin is None:
+            margin = self.ceilometer_polling_period
+
+        start = self.start - datetime.timedelta(seconds=margin)
+        if since is not None:
+            # only the samples newer than __since__ (see
+            # accumulator.Accumulator)
+            start = max(start, since)
+
         timestamp_query = {
-            '$gte': (
-                self.start
-                - datetime.timedelta(seconds=self.ceilometer_polling_period)
-            ),
-            '$lte': (
-                self.end
-                + datetime.timedelta(seconds=self.ceilometer_polling_period)
-            )
+            '$gte': start,
+            '$lte': self.end + datetime.timedelta(seconds=margin),
         }
+        return timestamp_query
 
-        # find samples
-        query = self.build_query(resources, timestamp_query=timestamp_query)
-        cursor = (ceilometer.find("meter", query, projection)
-                  .sort('timestamp', ASCENDING))
-        allsamples = list(cursor)
+    def samples_pipeline(self, margin, since=None):
+        timestamp_query = self.build_timestamp_query(margin, since=since)
 
-        if '.' in self._counter_value_field():
-            allsamples = self.flatten_mongo_data(allsamples)
+        def pipeline(chunk):
+            query = self.build_query(chunk, timestamp_query=timestamp_query)
+            return self.build_pipeline(query)
 
+        return pipeline
+
+    def measure(self):
+        resources = self.find_resources()
+
+        # find samples
+        margin = self.margin()
+        grouped_samples = self.find_samples(resources,
+                                            self.samples_pipeline(margin))
+
+        # the margin was too narrow for some resources
+        full_margin = self.ceilometer_polling_period
+        if margin < full_margin:
+            retry = self.unbracketed(grouped_samples)
+            if retry:
+                logger.debug("Retrying {n} resources with margin {m}"
+                             .format(n=len(retry), m=full_margin))
+                grouped_samples.update(self.find_samples(
+                    retry, self.samples_pipeline(full_margin)))
+
+        self.learn_cadence(grouped_samples.values())
+        return self.aggregate_resources(resources, grouped_samples)
+
+    def aggregate_resources(self, resources, grouped_samples):
         values = []
         for resource_id in resources:
             logger.debug("Aggregating resource {id}"
                          .format(id=resource_id))
 
-            samples = list(
-                s for s in allsamples if s['resource_id'] == resource_id)
-            v = self.aggregate_resource(samples,
-                                        key=self._counter_value_field())
+            samples = grouped_samples[resource_id]
+            v = self.aggregate_resource(samples, key='value')
             if v is None:
                 logger.debug("Missing data for resource {id}"
                              .format(id=resource_id))
@@ -244,16 +426,44 @@ class MongoCeilometerPollster(CeilometerPollster):
         value = self.aggregate_values(values)
         return value
 
-    @staticmethod
-    def flatten_mongo_data(d):
-        if type(d) is dict:
-            return dict(utils.flattenDict(d, join=lambda a, b: a + '.' + b))
-        elif type(d) is list:
-            return list(
-                dict(utils.flattenDict(x, join=lambda a, b: a + '.' + b))
-                for x in d)
-        else:
-            raise RuntimeError("Don't know how to handle %s" % type(d))
+    def find_samples(self, resources, pipeline, grouped_samples=None):
+        """ Find the samples of the given resources.
+
+        The aggregation pipelines built by __pipeline__ for chunks of
+        resources are merged by timestamp. Documents are read as
+        RawBSONDocument and decoded straight into the folded samples
+        of each resource. Returns a dict mapping each resource_id to
+        its samples.
+
+        If __grouped_samples__ is given, the samples are folded into
+        it, skipping the ones not newer than the last sample already
+        folded for the resource.
+        """
+
+        incremental = grouped_samples is not None
+        if not incremental:
+            grouped_samples = {}
+        for r in resources:
+            grouped_samples.setdefault(r, Samples())
+
+        cursor = ceilometer.aggregate_chunks("meter", pipeline, resources,
+                                             sort_key='timestamp', raw=True)
+        for doc in cursor:
+            samples = grouped_samples.get(doc['resource_id'])
+            if samples is None:
+                continue
+
+            timestamp = doc['timestamp']
+            if (incremental and samples.last_timestamp is not None
+                    and timestamp <= samples.last_timestamp):
+                continue
+
+            self.add_sample(samples, {
+                'timestamp': timestamp,
+                'value': doc['value'],
+            }, key='value')
+
+        return grouped_samples
 
 
 class MongoCPUTimePollster(MongoCeilometerPollster):
@@ -263,6 +473,9 @@ class MongoCPUTimePollster(MongoCeilometerPollster):
     def _counter_name(self):
         return "cpu"
 
+    def fold_sample(self, samples, sample, key):
+        self.fold_counter_sample(samples, sample, key)
+
     def aggregate_resource(self, samples, key):
         # At this point, due to the way ceilometer stores information
         # about resources (even after find_resources()), data could be
@@ -300,17 +513,6 @@ class MongoWallClockTimePollster(MongoCeilometerPollster):
     def _counter_value_field(self):
         return "resource_metadata.vcpus"
 
-    def _projection(self):
-        projection = {
-            # 'resource_metadata.flavor.disk': 1,
-            # 'resource_metadata.flavor.ephemeral': 1,
-            # 'resource_metadata.flavor.ram': 1,
-            # 'resource_metadata.flavor.vcpus': 1,
-            'resource_metadata.status': 1,
-            'resource_metadata.vcpus': 1
-        }
-        return projection
-
     def _samples_query(self):
         # instance samples are mixed with audit notification but we
         # can filter over resource_metadata.status == active (audit
@@ -321,6 +523,9 @@ class MongoWallClockTimePollster(MongoCeilometerPollster):
             ('resource_metadata.status', 'active')
         ]
 
+    def fold_sample(self, samples, sample, key):
+        self.fold_gauge_sample(samples, sample, key)
+
     def aggregate_resource(self, samples, key):
         if len(samples) < 2:
             return None
@@ -348,6 +553,9 @@ class MongoWallClockTimeOcataPollster(MongoCeilometerPollster):
     def _counter_name(self):
         return "vcpus"
 
+    def fold_sample(self, samples, sample, key):
+        self.fold_gauge_sample(samples, sample, key)
+
     def aggregate_resource(self, samples, key):
         # see comments in CPUTimePollster.aggregate_resource()
         if len(samples) < 2:
@@ -374,16 +582,177 @@ class MongoWallClockTimeOcataPollster(MongoCeilometerPollster):
         return ret
 
 
+class MongoMultiMeterPollster(Pollster):
+    """ Measure the meters of several pollsters with a single query.
+
+    The pollsters must share the project and the window. Resources
+    and samples of all the meters are fetched at once, then the
+    samples of each meter are folded and aggregated by its own
+    pollster.
+    """
+
+    project_id = None
+    pollsters = None
+
+    def __init__(self, pollsters):
+        pollster = pollsters[0]
+        super(MongoMultiMeterPollster, self).__init__(period=pollster.period,
+                                                      start=pollster.start,
+                                                      end=pollster.end)
+
+        self.project_id = pollster.project_id
+        self.pollsters = pollsters
+
+    def counter_names(self):
+        return list(p.counter_name for p in self.pollsters)
+
+    def find_resources(self):
+        start, end = self.pollsters[0].resources_range()
+
+        resources = ceilometer.find_resources(project_id=self.project_id,
+                                              meter=self.counter_names(),
+                                              start=start, end=end)
+        logger.debug("Project {id} has {n} resources of types {types} "
+                     "in the range from {start} to {end}"
+                     .format(id=self.project_id,
+                             n=len(resources),
+                             types=self.counter_names(),
+                             start=start,
+                             end=end))
+        return resources
+
+    def build_query(self, resources, timestamp_query):
+        query_list = [
+            ('resource_id', {
+                '$in': resources
+            }),
+            ('project_id', self.project_id),
+            ('counter_name', {
+                '$in': self.counter_names()
+            }),
+            ('timestamp', timestamp_query),
+            ('source', 'openstack')
+        ]
+
+        # some meters need additional filters
+        samples_queries = list(p._samples_query() for p in self.pollsters)
+        if any(samples_queries):
+            query_list.append(('$or', list(
+                SON([('counter_name', p.counter_name)] + q)
+                for p, q in zip(self.pollsters, samples_queries))))
+
+        query = SON(query_list)
+        return query
+
+    def build_pipeline(self, query):
+        # each meter has its own value field
+        fields = list('$' + p._counter_value_field() for p in self.pollsters)
+        value = fields[-1]
+        if len(set(fields)) > 1:
+            for p, field in reversed(zip(self.pollsters[:-1], fields[:-1])):
+                value = {
+                    '$cond': [{'$eq': ['$counter_name', p.counter_name]},
+                              field,
+                              value]
+                }
+
+        projection = SON([
+            ('_id', 0),
+            ('resource_id', 1),
+            ('counter_name', 1),
+            ('timestamp', 1),
+            ('value', value),
+        ])
+
+        pipeline = [
+            {'$match': query},
+            {'$sort': SON([('timestamp', ASCENDING)])},
+            {'$project': projection},
+        ]
+        return pipeline
+
+    def find_samples(self, resources, margin):
+        """ Find the samples of all the meters of the given resources.
+
+        Returns a dict mapping each counter_name to a dict of
+        resource_id -> samples.
+        """
+
+        timestamp_query = self.pollsters[0].build_timestamp_query(margin)
+
+        def pipeline(chunk):
+            query = self.build_query(chunk, timestamp_query=timestamp_query)
+            return self.build_pipeline(query)
+
+        pollsters = dict((p.counter_name, p) for p in self.pollsters)
+        grouped_samples = dict(
+            (counter_name, dict((r, Samples()) for r in resources))
+            for counter_name in pollsters)
+
+        cursor = ceilometer.aggregate_chunks("meter", pipeline, resources,
+                                             sort_key='timestamp', raw=True)
+        for doc in cursor:
+            counter_name = doc['counter_name']
+            samples = grouped_samples[counter_name].get(doc['resource_id'])
+            if samples is None:
+                continue
+
+            pollsters[counter_name].add_sample(samples, {
+                'timestamp': doc['timestamp'],
+                'value': doc['value'],
+            }, key='value')
+
+        return grouped_samples
+
+    def measure(self):
+        """ Returns a dict mapping each counter_name to its value. """
+
+        resources = self.find_resources()
+
+        margin = max(p.margin() for p in self.pollsters)
+        grouped_samples = self.find_samples(resources, margin)
+
+        # see MongoCeilometerPollster.measure()
+        full_margin = self.pollsters[0].ceilometer_polling_period
+        if margin < full_margin:
+            retry = set()
+            for pollster in self.pollsters:
+                retry.update(pollster.unbracketed(
+                    grouped_samples[pollster.counter_name]))
+
+            if retry:
+                logger.debug("Retrying {n} resources with margin {m}"
+                             .format(n=len(retry), m=full_margin))
+                retried = self.find_samples(sorted(retry), full_margin)
+                for counter_name, resources_samples in retried.items():
+                    grouped_samples[counter_name].update(resources_samples)
+
+        ret = {}
+        for pollster in self.pollsters:
+            samples = grouped_samples[pollster.counter_name]
+            pollster.learn_cadence(samples.values())
+            ret[pollster.counter_name] = pollster.aggregate_resources(
+                resources, samples)
+        return ret
+
+
 class GnocchiCeilometerPollster(CeilometerPollster):
+    # granularity used by the last query
+    granularity = None
+
+    # number of measures received by the last query
+    n_measures = None
+
     def __init__(self, *args, **kwargs):
         super(GnocchiCeilometerPollster, self).__init__(*args, **kwargs)
 
-    def measure(self):
-        start = self.start - datetime.timedelta(seconds=self.ceilometer_polling_period)
-        stop = self.end + datetime.timedelta(seconds=self.ceilometer_polling_period)
+    def cadence_key(self):
+        # all the projects are measured at once
+        return (self.counter_name, None)
 
+    def build_query(self, project_ids, start, stop, resource_ids=None):
         query = {"and": [
-            {"=": {"project_id": self.project_id}},
+            {"in": {"project_id": project_ids}},
             {"or": [
                 {"==": {"ended_at": None}},
                 {">=": {"ended_at": start}},
@@ -394,41 +763,151 @@ class GnocchiCeilometerPollster(CeilometerPollster):
             ]},
         ]}
 
+        if resource_ids is not None:
+            query["and"].append({"in": {"id": resource_ids}})
+        return query
+
+    def select_granularity(self):
+        """ Select the granularity to query.
+
+        When configured as `auto`, this is the coarsest granularity of
+        the archive policy of the meter that:
+        - divides the period, so that the period boundaries fall on
+          the points
+        - gives at least CEILOMETER_GNOCCHI_MIN_POINTS_PER_PERIOD
+          points per period, so that the boundaries can be properly
+          interpolated
+        - still covers the queried window
+        """
+
+        granularity = cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY
+        if granularity != 'auto':
+            return int(granularity)
+
+        definition = ceilometer.archive_policy(self.counter_name) or []
+
+        start = (self.start
+                 - datetime.timedelta(seconds=self.ceilometer_polling_period))
+        age = (datetime.datetime.utcnow() - start).total_seconds()
+        definition = list((g, timespan) for g, timespan in definition
+                          if timespan is None or timespan >= age)
+
+        max_granularity = (float(self.period)
+                           / cfg.CEILOMETER_GNOCCHI_MIN_POINTS_PER_PERIOD)
+
+        candidates = list(g for g, _ in definition
+                          if self.period % g == 0 and g <= max_granularity)
+        if candidates:
+            return int(max(candidates))
+
+        # fallback to the finest one
+        if definition:
+            return int(min(g for g, _ in definition))
+
+        return cfg.DEFAULT_CEILOMETER_GNOCCHI_FALLBACK_GRANULARITY
+
+    def find_samples(self, project_ids):
+        """ Find the samples of all the resources of the given projects.
+
+        A single aggregation query, grouped by project and resource,
+        is issued for all the projects. Returns a dict mapping each
+        project_id to a dict of resource_id -> samples.
+        """
+
+        self.granularity = self.select_granularity()
+        logger.debug("Using granularity {g} for {meter} with period {p}"
+                     .format(g=self.granularity,
+                             meter=self.counter_name,
+                             p=self.period))
+
+        self.n_measures = 0
+
+        # we need at least one point outside each boundary
+        margin = max(self.margin(), self.granularity)
+        grouped_samples = self.fetch_samples(project_ids, margin)
+
+        # the margin was too narrow for some resources
+        full_margin = max(self.ceilometer_polling_period, self.granularity)
+        if margin < full_margin:
+            retry = []
+            for resources in grouped_samples.values():
+                retry.extend(self.unbracketed(resources))
+
+            if retry:
+                logger.debug("Retrying {n} resources with margin {m}"
+                             .format(n=len(retry), m=full_margin))
+                retried = self.fetch_samples(project_ids, full_margin,
+                                             resource_ids=retry)
+                for project_id, resources in retried.items():
+                    grouped_samples.setdefault(project_id, {}).update(
+                        resources)
+
+        self.learn_cadence(list(
+            samples
+            for resources in grouped_samples.values()
+            for samples in resources.values()))
+        return grouped_samples
+
+    def fetch_samples(self, project_ids, margin, resource_ids=None):
+        start = self.start - datetime.timedelta(seconds=margin)
+        stop = self.end + datetime.timedelta(seconds=margin)
+
+        query = self.build_query(project_ids, start=start, stop=stop,
+                                 resource_ids=resource_ids)
+
         # To capture a proper value, we need to query the values
-        # between time 'start' and 'end', plus a margin given by
-        # ceilometer_polling_period. Then we interpolate according to
-        # our period.
-        raw_grouped_samples = ceilometer.find(
+        # between time 'start' and 'end', plus a margin (see
+        # margin(), but at least the granularity). Then we
+        # interpolate according to our period.
+        #
+        # Long windows are fetched in chunks, which are folded one at
+        # a time.
+        chunks = ceilometer.find_chunks(
             resource_type="instance",
             metrics=self.counter_name,
             start=start,
             stop=stop,
-            granularity=cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY,
-            groupby="id",
+            granularity=self.granularity,
+            groupby=["project_id", "id"],
             query=query,
         )
 
         grouped_samples = {}
-        for g in raw_grouped_samples:
-            resource_id = g['group']['id']
-            if not resource_id in grouped_samples:
-                grouped_samples[resource_id] = []
-
-            for s in g['measures']:
-                grouped_samples[resource_id].append({
-                    'timestamp': s[0].replace(tzinfo=None),
-                    'value': s[2],
-                })
+        for chunk_start, chunk_stop, raw_grouped_samples in chunks:
+            for g in raw_grouped_samples:
+                project_id = g['group']['project_id']
+                resource_id = g['group']['id']
+
+                resources = grouped_samples.setdefault(project_id, {})
+                samples = resources.setdefault(resource_id, Samples())
+                self.fold_measures(samples, g['measures'],
+                                   chunk_start, chunk_stop)
+
+        return grouped_samples
+
+    def fold_measures(self, samples, measures, chunk_start, chunk_stop):
+        self.n_measures += len(measures)
+        for s in measures:
+            timestamp = s[0].replace(tzinfo=None)
+
+            # measures in the margins of the chunk are folded with the
+            # neighbouring chunks
+            if chunk_start is not None and timestamp < chunk_start:
+                continue
+            if chunk_stop is not None and timestamp >= chunk_stop:
+                continue
 
-        resources = grouped_samples.keys()
-        logger.debug("Got %d resources" % len(resources))
+            self.add_sample(samples, {
+                'timestamp': timestamp,
+                'value': s[2],
+            }, key='value')
 
+    def aggregate_resources(self, grouped_samples):
         values = []
-        for resource_id in resources:
+        for resource_id, samples in grouped_samples.items():
             logger.debug("Aggregating resource {id}"
                          .format(id=resource_id))
 
-            samples = grouped_samples[resource_id]
             v = self.aggregate_resource(samples, key='value')
             if v is None:
                 logger.debug("Missing data for resource {id}"
@@ -443,6 +922,38 @@ class GnocchiCeilometerPollster(CeilometerPollster):
         value = self.aggregate_values(values)
         return value
 
+    def measure_projects(self, project_ids):
+        """ Measure all the given projects at once.
+
+        Returns a dict mapping project_id to the measured value;
+        projects without data are not included.
+        """
+
+        grouped_samples = self.find_samples(project_ids)
+        return self.aggregate_projects(grouped_samples)
+
+    def aggregate_projects(self, grouped_samples):
+        logger.debug("Got resources for %d projects" % len(grouped_samples))
+
+        ret = {}
+        for project_id, resources in grouped_samples.items():
+            logger.debug("Project {id} has {n} resources"
+                         .format(id=project_id, n=len(resources)))
+
+            value = self.aggregate_resources(resources)
+            if value is None:
+                continue
+
+            ret[project_id] = value
+        return ret
+
+    def measure(self):
+        values = self.measure_projects([self.project_id])
+        return values.get(self.project_id)
+
+    def fold_sample(self, samples, sample, key):
+        self.fold_gauge_sample(samples, sample, key)
+
     def aggregate_resource(self, samples, key):
         if len(samples) < 2:
             return None
@@ -475,6 +986,9 @@ class GnocchiCPUTimePollster(GnocchiCeilometerPollster):
     def _counter_name(self):
         return "cpu"
 
+    def fold_sample(self, samples, sample, key):
+        self.fold_counter_sample(samples, sample, key)
+
     def aggregate_resource(self, samples, key):
         if len(samples) < 2:
             return None
@@ -493,3 +1007,242 @@ class GnocchiWallClockTimeOcataPollster(GnocchiCeilometerPollster):
 
     def _counter_name(self):
         return "vcpus"
+
+
+class GnocchiMultiMeterPollster(Pollster):
+    """ Measure the meters of several pollsters with a single query.
+
+    The pollsters must share the window. The measures of all the
+    meters are fetched at once with the aggregates API, then the
+    measures of each meter are folded and aggregated by its own
+    pollster.
+    """
+
+    pollsters = None
+
+    def __init__(self, pollsters):
+        pollster = pollsters[0]
+        super(GnocchiMultiMeterPollster, self).__init__(
+            period=pollster.period,
+            start=pollster.start,
+            end=pollster.end)
+
+        self.pollsters = pollsters
+
+    def _operations(self):
+        return "(metric {metrics})".format(
+            metrics=" ".join("({meter} mean)".format(meter=p.counter_name)
+                             for p in self.pollsters))
+
+    def measure_projects(self, project_ids):
+        """ Returns a dict mapping each counter_name to a dict mapping
+        project_id to the measured value. """
+
+        granularities = set(p.select_granularity() for p in self.pollsters)
+        if len(granularities) > 1:
+            # measures can only be fetched at once with the same
+            # granularity
+            logger.debug("Meters have different granularities: {g}"
+                         .format(g=sorted(granularities)))
+            return dict((p.counter_name, p.measure_projects(project_ids))
+                        for p in self.pollsters)
+
+        granularity = granularities.pop()
+        for pollster in self.pollsters:
+            pollster.granularity = granularity
+            pollster.n_measures = 0
+
+        # see GnocchiCeilometerPollster.find_samples()
+        margin = max(max(p.margin() for p in self.pollsters), granularity)
+        grouped_samples = self.fetch_samples(project_ids, granularity, margin)
+
+        full_margin = max(self.pollsters[0].ceilometer_polling_period,
+                          granularity)
+        if margin < full_margin:
+            retry = set()
+            for pollster in self.pollsters:
+                projects = grouped_samples[pollster.counter_name]
+                for resources in projects.values():
+                    retry.update(pollster.unbracketed(resources))
+
+            if retry:
+                logger.debug("Retrying {n} resources with margin {m}"
+                             .format(n=len(retry), m=full_margin))
+                retried = self.fetch_samples(project_ids, granularity,
+                                             full_margin,
+                                             resource_ids=sorted(retry))
+                for counter_name, projects in retried.items():
+                    for project_id, resources in projects.items():
+                        (grouped_samples[counter_name]
+                         .setdefault(project_id, {})
+                         .update(resources))
+
+        ret = {}
+        for pollster in self.pollsters:
+            projects = grouped_samples[pollster.counter_name]
+            pollster.learn_cadence(list(
+                samples
+                for resources in projects.values()
+                for samples in resources.values()))
+            ret[pollster.counter_name] = pollster.aggregate_projects(projects)
+        return ret
+
+    def fetch_samples(self, project_ids, granularity, margin,
+                      resource_ids=None):
+        start = self.start - datetime.timedelta(seconds=margin)
+        stop = self.end + datetime.timedelta(seconds=margin)
+
+        query = self.pollsters[0].build_query(project_ids,
+                                              start=start, stop=stop,
+                                              resource_ids=resource_ids)
+        pollsters = dict((p.counter_name, p) for p in self.pollsters)
+
+        chunks = ceilometer.find_chunks(
+            aggregates=True,
+            operations=self._operations(),
+            search=query,
+            resource_type="instance",
+            start=start,
+            stop=stop,
+            granularity=granularity,
+            needed_overlap=0,
+            groupby=["project_id"],
+        )
+
+        grouped_samples = dict((c, {}) for c in pollsters)
+        for chunk_start, chunk_stop, groups in chunks:
+            for g in groups:
+                project_id = g['group']['project_id']
+                resources = g['measures']['measures']
+                for resource_id, metrics in resources.items():
+                    for counter_name, aggregations in metrics.items():
+                        pollster = pollsters[counter_name]
+                        samples = (grouped_samples[counter_name]
+                                   .setdefault(project_id, {})
+                                   .setdefault(resource_id, Samples()))
+                        pollster.fold_measures(samples,
+                                               aggregations['mean'],
+                                               chunk_start, chunk_stop)
+
+        return grouped_samples
+
+
+class GnocchiAggregatesPollster(GnocchiCeilometerPollster):
+    """ Let gnocchi do the math.
+
+    The measures are aggregated server-side with the aggregates API,
+    so that for each project we only receive the time series of the
+    project total instead of the measures of each resource.
+    """
+
+    # the client-side pollster computing the same value
+    reference_class = None
+
+    def __init__(self, *args, **kwargs):
+        super(GnocchiAggregatesPollster, self).__init__(*args, **kwargs)
+
+    def _operations(self):
+        raise NotImplementedError
+
+    def aggregate_measures(self, samples, granularity):
+        raise NotImplementedError
+
+    def measure_projects(self, project_ids):
+        self.granularity = granularity = self.select_granularity()
+        logger.debug("Using granularity {g} for {meter} with period {p}"
+                     .format(g=granularity,
+                             meter=self.counter_name,
+                             p=self.period))
+
+        # one more point on both sides is needed to compute the values
+        # at the boundaries of the period
+        start = self.start - datetime.timedelta(seconds=granularity)
+        stop = self.end + datetime.timedelta(seconds=granularity)
+
+        query = self.build_query(project_ids, start=start, stop=stop)
+
+        groups = ceilometer.aggregates(
+            operations=self._operations(),
+            search=query,
+            resource_type="instance",
+            start=start,
+            stop=stop,
+            granularity=granularity,
+            needed_overlap=0,
+            groupby=["project_id"],
+        )
+
+        self.n_measures = 0
+        ret = {}
+        for g in groups:
+            project_id = g['group']['project_id']
+            measures = g['measures']['measures'].get('aggregated', [])
+            self.n_measures += len(measures)
+
+            samples = list({
+                'timestamp': s[0].replace(tzinfo=None),
+                'value': s[2],
+            } for s in measures)
+
+            value = self.aggregate_measures(samples, granularity=granularity)
+            if value is None:
+                logger.debug("Missing data for project {id}"
+                             .format(id=project_id))
+                continue
+
+            ret[project_id] = value
+        return ret
+
+
+class GnocchiAggregatesCPUTimePollster(GnocchiAggregatesPollster):
+    reference_class = GnocchiCPUTimePollster
+
+    def __init__(self, *args, **kwargs):
+        super(GnocchiAggregatesCPUTimePollster, self).__init__(*args, **kwargs)
+
+    def _counter_name(self):
+        return "cpu"
+
+    def _operations(self):
+        # cpu is a cumulative counter: the increments of each instance
+        # are summed over the project. Negative increments are due to
+        # the cputime being reset (see MongoCPUTimePollster) and are
+        # dropped, as correct_monotonicity() does.
+        return ("(aggregate sum"
+                " (clip_min (rateofchange (metric {meter} mean)) 0))"
+                .format(meter=self.counter_name))
+
+    def aggregate_measures(self, samples, granularity):
+        # the increment at timestamp t is the one from t - granularity
+        # to t, so we take the ones in (start, end]
+        values = list(s['value'] for s in samples
+                      if self.start < s['timestamp'] <= self.end)
+        if not len(values):
+            return None
+
+        return sum(values) / 1e9
+
+
+class GnocchiAggregatesWallClockTimeOcataPollster(GnocchiAggregatesPollster):
+    reference_class = GnocchiWallClockTimeOcataPollster
+
+    def __init__(self, *args, **kwargs):
+        super(GnocchiAggregatesWallClockTimeOcataPollster, self).__init__(
+            *args, **kwargs)
+
+    def _counter_name(self):
+        return "vcpus"
+
+    def _operations(self):
+        return ("(aggregate sum (metric {meter} mean))"
+                .format(meter=self.counter_name))
+
+    def aggregate_measures(self, samples, granularity):
+        # each point is the mean number of vcpus from t to t +
+        # granularity, so we take the ones in [start, end)
+        values = list(s['value'] for s in samples
+                      if self.start <= s['timestamp'] < self.end)
+        if not len(values):
+            return None
+
+        return sum(values) * granularity
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import datetime
+
+import utils
+
+
+GAUGE_FUNCTIONS = ('avg', 'min', 'max', 'last')
+
+
+def windows(period, start, end):
+    """ The windows (start, end] of __period__ seconds which end after
+    __start__ and not later than __end__, as (start, end) tuples. """
+
+    P = datetime.timedelta(seconds=period)
+    grid = utils.timeline(period=period, start=start,
+                          end=end + datetime.timedelta(microseconds=1))
+    return list((ts - P, ts) for ts in grid)
+
+
+def missing(samples, period, start, end):
+    """ The timestamps of the samples of __period__ seconds in
+    (start, end] which are not in __samples__. """
+
+    return utils.missing_timestamps(
+        period=period, start=start,
+        end=end + datetime.timedelta(microseconds=1),
+        timestamps=set(s['timestamp'] for s in samples
+                       if start < s['timestamp'] <= end))
+
+
+def delta(samples, start, end):
+    """ The sum of the __samples__ of a delta metric in (start, end],
+    None if there are none. """
+
+    values = list(s['value'] for s in samples
+                  if start < s['timestamp'] <= end)
+    if not values:
+        return None
+    return sum(values)
+
+
+def gauge(samples, start, end, function):
+    """ Aggregate the sorted __samples__ of a gauge in (start, end]
+    with __function__ (see GAUGE_FUNCTIONS).
+
+    A gauge keeps the value of its last sample, so that the last one
+    before the window is also taken into account. avg is weighted by
+    the time each value was kept. None if there are no samples.
+    """
+
+    if function not in GAUGE_FUNCTIONS:
+        raise RuntimeError("Unknown gauge function `{f}`"
+                           .format(f=function))
+
+    points = []
+    for s in samples:
+        if s['timestamp'] <= start:
+            points = [(start, s['value'])]
+        elif s['timestamp'] <= end:
+            points.append((s['timestamp'], s['value']))
+
+    if not points:
+        return None
+
+    values = list(v for _, v in points)
+    if function == 'min':
+        return min(values)
+    if function == 'max':
+        return max(values)
+    if function == 'last':
+        return values[-1]
+
+    t0 = points[0][0]
+    total = (end - t0).total_seconds()
+    if total <= 0:
+        return values[-1]
+
+    area = 0.0
+    for (t, v), (t_next, _) in zip(points, points[1:] + [(end, None)]):
+        area += v * (t_next - t).total_seconds()
+    return area / total
@@ -32,7 +32,10 @@ from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.events import EVENT_JOB_ERROR
 
+import cache
+import limiter
 import log
+import singleflight
 
 
 logger = log.get_logger(__name__)
@@ -40,6 +43,9 @@ logger = log.get_logger(__name__)
 
 _scheduler = None
 
+# called when the main loop terminates
+_shutdown_hooks = []
+
 
 def initialize():
     logger.info("Initializing scheduler...")
@@ -60,11 +66,19 @@ def report_alive():
     logger.info(output.getvalue())
     output.close()
 
+    cache.report_stats()
+    limiter.report_stats()
+    singleflight.report_stats()
+
 
 def add_job(*args, **kwargs):
     _scheduler.add_job(*args, **kwargs)
 
 
+def add_shutdown_hook(func):
+    _shutdown_hooks.append(func)
+
+
 def error_listener(event):
     if event.exception:
         logger.error("Job ERROR: {exception} -- {trace}".format(
@@ -87,3 +101,6 @@ def main_loop():
     except (KeyboardInterrupt, SystemExit):
         logger.info('Got SIGTERM! Terminating...')
         _scheduler.shutdown(wait=False)
+
+    for func in _shutdown_hooks:
+        func()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import bisect
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import cfg
+import log
+
+
+logger = log.get_logger(__name__)
+
+
+def _hash(value):
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """ A consistent-hash ring of __members__, each one placed at
+    __replicas__ points, so that adding or removing a member only
+    moves the keys of its neighbours. """
+
+    def __init__(self, members, replicas=100):
+        self.members = sorted(set(members))
+
+        points = []
+        for member in self.members:
+            for i in range(replicas):
+                points.append(
+                    (_hash("{m}-{i}".format(m=member, i=i)), member))
+        points.sort()
+
+        self._hashes = list(h for h, _ in points)
+        self._owners = list(m for _, m in points)
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+
+class MembershipStore(object):
+    """ Where the collectors keep their leases. """
+
+    def heartbeat(self, member_id, ttl):
+        """ Renew the lease of __member_id__ for __ttl__ seconds. """
+        raise NotImplementedError
+
+    def leave(self, member_id):
+        raise NotImplementedError
+
+    def members(self):
+        """ The members with a valid lease. """
+        raise NotImplementedError
+
+
+class SQLiteMembershipStore(MembershipStore):
+    """ A MembershipStore in a SQLite database, shared by the
+    collectors on the same host (or filesystem). """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None,
+                                           timeout=30)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS members ("
+            "id TEXT PRIMARY KEY, "
+            "expires REAL NOT NULL)")
+
+    def heartbeat(self, member_id, ttl):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO members (id, expires) VALUES (?, ?)",
+                (member_id, time.time() + ttl))
+
+    def leave(self, member_id):
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM members WHERE id = ?", (member_id, ))
+
+    def members(self):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id FROM members WHERE expires > ?",
+                (time.time(), )).fetchall()
+        return list(r[0] for r in rows)
+
+
+_STORES = {
+    'sqlite': SQLiteMembershipStore,
+}
+
+_store = None
+_last_heartbeat = None
+_joined = False
+
+
+def enabled():
+    """ Whether the keys are sharded, i.e. this collector joined the
+    ring (see join()). One-off jobs process all the keys they are
+    asked for. """
+
+    return bool(cfg.SHARDING_ENABLED) and _joined
+
+
+def _get_store():
+    global _store
+
+    if _store is None:
+        store_class = _STORES[cfg.SHARDING_STORE]
+
+        path = cfg.SHARDING_STORE_PATH
+        if not path:
+            path = os.path.join(cfg.STATE_DIR, 'sharding.sqlite')
+        _store = store_class(path)
+    return _store
+
+
+def join():
+    """ Join the ring, if SHARDING_ENABLED. Only the daemon joins, as
+    it renews the lease and leaves at shutdown. """
+
+    global _joined
+
+    if not cfg.SHARDING_ENABLED:
+        return False
+
+    logger.info("Joining shard ring as {id}"
+                .format(id=cfg.SHARDING_MEMBER_ID))
+    _joined = True
+    heartbeat(force=True)
+    return True
+
+
+def heartbeat(force=False):
+    """ Renew the lease of this collector, at most every third of
+    SHARDING_LEASE_TTL seconds. """
+
+    global _last_heartbeat
+
+    if not enabled():
+        return
+
+    ttl = cfg.SHARDING_LEASE_TTL
+    now = time.time()
+    if (not force and _last_heartbeat is not None
+            and now - _last_heartbeat < ttl / 3.0):
+        return
+
+    _get_store().heartbeat(cfg.SHARDING_MEMBER_ID, ttl)
+    _last_heartbeat = now
+
+
+def leave():
+    global _last_heartbeat, _joined
+
+    if not enabled():
+        return
+
+    logger.info("Leaving shard ring as {id}"
+                .format(id=cfg.SHARDING_MEMBER_ID))
+    _get_store().leave(cfg.SHARDING_MEMBER_ID)
+    _last_heartbeat = None
+    _joined = False
+
+
+def owned(keys):
+    """ The __keys__ (e.g. project ids or hypervisor names) owned by
+    this collector. All of them if sharding is disabled or this
+    collector didn't join the ring. """
+
+    keys = list(keys)
+    if not enabled():
+        return keys
+
+    heartbeat()
+    members = _get_store().members()
+    member_id = cfg.SHARDING_MEMBER_ID
+    if member_id not in members:
+        # e.g. the lease expired in the meanwhile
+        heartbeat(force=True)
+        members.append(member_id)
+
+    ring = HashRing(members, replicas=cfg.SHARDING_REPLICAS)
+    ret = list(k for k in keys if ring.owner(k) == member_id)
+
+    logger.info("Member {id} of {n} owns {o} of {k} keys"
+                .format(id=member_id, n=len(ring.members),
+                        o=len(ret), k=len(keys)))
+    return ret
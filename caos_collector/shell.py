@@ -33,13 +33,19 @@ from . import __version__, __description__
 import cfg
 import log
 import scheduler
+import sharding
+import spool
 
+from jobs.backfill_job import BackfillJob
 from jobs.domains_metadata_job import DomainsMetadataJob
 from jobs.hypervisors_metadata_job import HypervisorsMetadataJob
 from jobs.hypervisors_state_job import HypervisorsStateJob
+from jobs.mongo_indexes_job import MongoIndexesJob
 from jobs.projects_metadata_job import ProjectsMetadataJob
 from jobs.projects_quotas_job import ProjectsQuotasJob
 from jobs.report_alive_job import ReportAliveJob
+from jobs.rollup_job import RollupJob
+from jobs.series_repair_job import SeriesRepairJob
 from jobs.vm_usage_job import VMUsageJob
 
 
@@ -58,6 +64,12 @@ _JOBS = {
     'projects_quotas': ProjectsQuotasJob,
     'vm_usage': VMUsageJob,
     'hypervisors_state': HypervisorsStateJob,
+
+    'mongo_indexes': MongoIndexesJob,
+
+    'backfill': BackfillJob,
+    'series_repair': SeriesRepairJob,
+    'rollup': RollupJob,
 }
 
 for _job_name, _job_class in _JOBS.items():
@@ -185,11 +197,27 @@ def main():
     if job_name == 'daemon':
         setup_scheduler()
 
+        spool.initialize()
+        scheduler.add_shutdown_hook(spool.shutdown)
+
+        # join the shard ring and keep the lease, see sharding.owned()
+        if sharding.join():
+            scheduler.add_job(sharding.heartbeat, 'interval',
+                              seconds=max(cfg.SHARDING_LEASE_TTL // 3, 1),
+                              kwargs={'force': True},
+                              name='sharding_heartbeat')
+            scheduler.add_shutdown_hook(sharding.leave)
+
         # this is blocking!!!
         scheduler.main_loop()
 
+    # otherwise the spooled samples are written at the end of the jobs
     if job_name == 'run':
-        run_scheduler(args.scheduler_name)
+        spool.initialize(background=False)
+        try:
+            run_scheduler(args.scheduler_name)
+        finally:
+            spool.shutdown()
         sys.exit(0)
 
     if job_name not in _JOBS:
@@ -197,4 +225,8 @@ def main():
         sys.exit(1)
 
     job_instance = get_job_instance(job_name)
-    job_instance.run_job(args)
+    spool.initialize(background=False)
+    try:
+        job_instance.run_job(args)
+    finally:
+        spool.shutdown()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import functools
+import sys
+import threading
+
+import log
+
+
+logger = log.get_logger(__name__)
+
+
+# the groups, indexed by name
+_groups = {}
+_groups_lock = threading.Lock()
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class Group(object):
+    """ Coalesces the concurrent calls with the same key: only the
+    first one is run, the others wait for it and share its result (or
+    its exception). """
+
+    name = None
+
+    # statistics, see stats()
+    calls = 0
+    coalesced = 0
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = func(*args, **kwargs)
+            except Exception:
+                call.exc_info = sys.exc_info()
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.exc_info is not None:
+            raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+        return call.result
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'coalesced': self.coalesced,
+        }
+
+
+def get_group(name):
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = Group(name)
+        return _groups[name]
+
+
+def freeze(value):
+    """ A hashable version of __value__, made of nested lists and
+    dicts. """
+
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def coalesced(name, key=None):
+    """ Decorates an idempotent function, coalescing its concurrent
+    calls with the same arguments (see Group).
+
+    __key__ builds the key from the arguments, by default all of
+    them.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if key is not None:
+                k = key(*args, **kwargs)
+            else:
+                k = freeze((args, kwargs))
+            return get_group(name).do(k, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report_stats():
+    for name, g in sorted(_groups.items()):
+        logger.info("Single-flight {name}: {calls} calls, "
+                    "{coalesced} coalesced"
+                    .format(name=name, **g.stats()))
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import json
+import os
+import sqlite3
+import threading
+
+import cfg
+import log
+import tsdb
+import utils
+
+
+logger = log.get_logger(__name__)
+
+# values of PRAGMA synchronous, i.e. when sqlite calls fsync
+SYNCHRONOUS = ('off', 'normal', 'full')
+
+
+class Spool(object):
+    """ A write-ahead spool of the samples to be written to caos-tsdb.
+
+    Samples are appended to a SQLite database at __path__, and
+    removed once written (see Drainer). At most __max_samples__ are
+    kept.
+    """
+
+    path = None
+    max_samples = None
+
+    def __init__(self, path, max_samples, synchronous='normal'):
+        if synchronous not in SYNCHRONOUS:
+            raise RuntimeError("Wrong spool synchronous `{s}`, expected one "
+                               "of {choices}"
+                               .format(s=synchronous, choices=SYNCHRONOUS))
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+
+        # enqueue() and the drainer run in different threads, the
+        # connection is serialized by _lock
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "PRAGMA synchronous={s}".format(s=synchronous.upper()))
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS samples ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "sample TEXT NOT NULL)")
+
+        self._count = self._connection.execute(
+            "SELECT COUNT(*) FROM samples").fetchone()[0]
+        if self._count:
+            logger.info("Spool {path} has {n} pending samples"
+                        .format(path=path, n=self._count))
+
+    def __len__(self):
+        return self._count
+
+    def enqueue(self, metric_name, period, tags, timestamp, value,
+                overwrite=False):
+        """ Append a sample. Returns False if the spool is full. """
+
+        sample = json.dumps({
+            'metric_name': metric_name,
+            'period': period,
+            'tags': tags,
+            'timestamp': utils.format_date(timestamp),
+            'value': value,
+            'overwrite': overwrite,
+        })
+
+        with self._lock:
+            if self.max_samples and self._count >= self.max_samples:
+                logger.error("Spool {path} is full ({n} samples)"
+                             .format(path=self.path, n=self._count))
+                return False
+
+            self._connection.execute(
+                "INSERT INTO samples (sample) VALUES (?)", (sample,))
+            self._count += 1
+        return True
+
+    def peek(self, n):
+        """ The oldest __n__ samples, as a list of (id, sample). """
+
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, sample FROM samples ORDER BY id LIMIT ?",
+                (n,)).fetchall()
+
+        ret = []
+        for id, sample in rows:
+            sample = json.loads(sample)
+            sample['timestamp'] = utils.parse_date(sample['timestamp'])
+            ret.append((id, sample))
+        return ret
+
+    def ack(self, ids):
+        """ Remove the samples with the given __ids__. """
+
+        if not ids:
+            return
+
+        with self._lock:
+            self._connection.execute("BEGIN")
+            self._connection.executemany(
+                "DELETE FROM samples WHERE id = ?",
+                list((id,) for id in ids))
+            self._connection.execute("COMMIT")
+            self._count -= len(ids)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def flush(spool, batch_size):
+    """ Write the samples of __spool__ to caos-tsdb, in batches of
+    __batch_size__, until it is empty. Returns the number of samples
+    written.
+
+    Samples rejected by caos-tsdb with an error of their own are
+    logged and dropped. Errors of the whole request are raised and the
+    batch is kept.
+    """
+
+    n = 0
+    while True:
+        batch = spool.peek(batch_size)
+        if not batch:
+            return n
+
+        ids = list(id for id, _ in batch)
+        samples = list(sample for _, sample in batch)
+        results = tsdb.create_samples(samples)
+
+        for sample, result in zip(samples, results):
+            if result is None:
+                logger.error("Dropping sample rejected by caos-tsdb: {s}"
+                             .format(s=sample))
+
+        spool.ack(ids)
+        n += len(batch)
+
+
+class Drainer(threading.Thread):
+    """ Flushes a Spool in the background every __interval__ seconds.
+
+    After an error the interval is doubled, up to __max_backoff__
+    seconds, and the token is refreshed.
+    """
+
+    def __init__(self, spool, batch_size, interval, max_backoff):
+        super(Drainer, self).__init__(name='spool-drainer')
+        self.daemon = True
+
+        self.spool = spool
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._stop_event = threading.Event()
+        self._authenticated = False
+
+    def drain(self):
+        if not self._authenticated:
+            tsdb.initialize()
+            if not tsdb.refresh_token():
+                raise RuntimeError("TSDB API auth problems.")
+            self._authenticated = True
+
+        n = flush(self.spool, self.batch_size)
+        if n:
+            logger.info("Drained {n} samples, {left} left"
+                        .format(n=n, left=len(self.spool)))
+
+    def run(self):
+        backoff = self.interval
+        while not self._stop_event.is_set():
+            if len(self.spool):
+                try:
+                    self.drain()
+                    backoff = self.interval
+                except Exception as e:
+                    self._authenticated = False
+                    backoff = min(backoff * 2, self.max_backoff)
+                    logger.warn("Cannot drain spool: {e}. Retrying in "
+                                "{b} seconds".format(e=e, b=backoff))
+
+            self._stop_event.wait(backoff)
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        self.join(timeout)
+
+
+_spool = None
+_drainer = None
+
+
+def initialize(background=True):
+    """ Spool the samples, if enabled. With __background__ they are
+    written by a Drainer, otherwise by shutdown(). """
+
+    global _spool
+    global _drainer
+
+    if not cfg.CAOS_TSDB_SPOOL_ENABLED:
+        return
+
+    path = cfg.CAOS_TSDB_SPOOL_PATH
+    if not path:
+        path = os.path.join(cfg.STATE_DIR, 'spool.sqlite')
+
+    logger.info("Spooling samples to {path}".format(path=path))
+    _spool = Spool(path,
+                   max_samples=cfg.CAOS_TSDB_SPOOL_MAX_SAMPLES,
+                   synchronous=cfg.CAOS_TSDB_SPOOL_SYNCHRONOUS)
+    tsdb.set_spool(_spool)
+
+    if background:
+        _drainer = Drainer(_spool,
+                           batch_size=cfg.CAOS_TSDB_SPOOL_BATCH_SIZE,
+                           interval=cfg.CAOS_TSDB_SPOOL_DRAIN_INTERVAL,
+                           max_backoff=cfg.CAOS_TSDB_SPOOL_MAX_BACKOFF)
+        _drainer.start()
+
+
+def shutdown():
+    """ Stop the Drainer and write the pending samples. Samples which
+    cannot be written are kept for the next run. """
+
+    global _spool
+    global _drainer
+
+    if _spool is None:
+        return
+
+    tsdb.set_spool(None)
+
+    if _drainer is not None:
+        _drainer.stop(timeout=cfg.CAOS_TSDB_SPOOL_SHUTDOWN_TIMEOUT)
+        if _drainer.is_alive():
+            logger.warn("Spool drainer is still running. Keeping {n} "
+                        "samples in {path}"
+                        .format(n=len(_spool), path=_spool.path))
+            return
+        _drainer = None
+
+    try:
+        n = flush(_spool, cfg.CAOS_TSDB_SPOOL_BATCH_SIZE)
+        logger.info("Drained {n} samples".format(n=n))
+    except Exception as e:
+        logger.error("Cannot drain spool: {e}. Keeping {n} samples in {path}"
+                     .format(e=e, n=len(_spool), path=_spool.path))
+
+    _spool.close()
+    _spool = None
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import bson
+import datetime
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from bson.raw_bson import RawBSONDocument
+
+from caos_collector import ceilometer
+from caos_collector import cfg
+from caos_collector import pollsters
+from caos_collector.accumulator import Accumulator
+
+
+START = datetime.datetime(2018, 1, 1, 10, 0, 0)
+END = datetime.datetime(2018, 1, 1, 11, 0, 0)
+
+
+def _ts(seconds):
+    return START + datetime.timedelta(seconds=seconds)
+
+
+class TestAccumulator(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        cfg.CEILOMETER_ADAPTIVE_MARGIN = False
+        cfg.CEILOMETER_MONGODB_IN_CHUNK = 1000
+        cfg.CEILOMETER_MONGODB_QUERY_WORKERS = 1
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'state', 'current.json')
+
+        # (resource_id, timestamp, value, stored at)
+        self.docs = []
+        for t in range(-600, 3600 + 1, 300):
+            self.docs.append(('r1', _ts(t), (t + 600) * 1e9, _ts(t)))
+        # r2 resets its counter, r3 starts later
+        for t in range(-600, 3600 + 1, 300):
+            v = (t + 600) * 1e9 if t < 1500 else (t - 1500) * 1e9
+            self.docs.append(('r2', _ts(t), v, _ts(t)))
+        for t in range(1200, 3600 + 1, 300):
+            self.docs.append(('r3', _ts(t), (t - 1200) * 2e9, _ts(t)))
+        # a sample stored late
+        self.docs.append(('r1', _ts(1650), 2250e9, _ts(2000)))
+        self.docs.sort(key=lambda d: d[1])
+        self.now = None
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_ADAPTIVE_MARGIN = None
+        cfg.CEILOMETER_MONGODB_IN_CHUNK = None
+        cfg.CEILOMETER_MONGODB_QUERY_WORKERS = None
+        shutil.rmtree(self.tmp_dir)
+
+    def _aggregate(self, dbname, pipeline, raw):
+        query = pipeline[0]['$match']
+        resources = query['resource_id']['$in']
+        timestamps = query['timestamp']
+        return iter(list(
+            RawBSONDocument(bson.BSON.encode({
+                'resource_id': r,
+                'timestamp': t,
+                'value': v,
+            })) for r, t, v, stored in self.docs
+            if stored <= self.now and r in resources
+            and timestamps['$gte'] <= t <= timestamps['$lte']))
+
+    def _find_resources(self, **kwargs):
+        return sorted(set(r for r, t, v, stored in self.docs
+                          if stored <= self.now))
+
+    def _measure(self, accumulator=None):
+        backend = ceilometer.MongoCeilometerBackend()
+        backend.aggregate = mock.Mock(side_effect=self._aggregate)
+
+        pollster = pollsters.MongoCPUTimePollster(project_id='p1',
+                                                  period=3600,
+                                                  start=START,
+                                                  end=END)
+        with mock.patch('caos_collector.ceilometer._ceilometer_backend',
+                        backend), \
+                mock.patch('caos_collector.ceilometer.find_resources',
+                           side_effect=self._find_resources):
+            if accumulator is None:
+                value = pollster.measure()
+            else:
+                value = accumulator.measure(pollster)
+        return value, backend.aggregate.call_args_list
+
+    def test_incremental(self):
+        accumulator = Accumulator(self.path)
+        for now in (1200, 1800, 2400, 3000, 3600, 4200):
+            self.now = _ts(now)
+
+            value, calls = self._measure(accumulator)
+            expected, _ = self._measure()
+            self.assertAlmostEqual(value, expected)
+
+            # the state survives a restart
+            accumulator.save()
+            accumulator = Accumulator(self.path)
+
+        # the last measure only fetched the new samples
+        timestamps = calls[-1][0][1][0]['$match']['timestamp']
+        self.assertEqual(timestamps['$gte'], _ts(3600 - 600))
+
+    def test_new_period(self):
+        self.now = _ts(4200)
+        accumulator = Accumulator(self.path)
+        self._measure(accumulator)
+
+        pollster = pollsters.MongoCPUTimePollster(
+            project_id='p1', period=3600,
+            start=END, end=END + datetime.timedelta(seconds=3600))
+        with mock.patch('caos_collector.ceilometer.find_resources',
+                        return_value=[]):
+            self.assertIsNone(accumulator.measure(pollster))
+
+        self.assertEqual(accumulator._state, {})
+
+    def test_lagging_resource(self):
+        # the samples of r2 are stored only at 3000
+        self.docs = list(
+            (r, t, v, _ts(3000)) if r == 'r2' and _ts(1500) <= t < _ts(3000)
+            else (r, t, v, stored)
+            for r, t, v, stored in self.docs)
+
+        accumulator = Accumulator(self.path)
+        for now in (1800, 2400, 3000, 3600):
+            self.now = _ts(now)
+
+            value, calls = self._measure(accumulator)
+            expected, _ = self._measure()
+            self.assertAlmostEqual(value, expected)
+
+        # the last measure looked back from r2
+        timestamps = calls[-1][0][1][0]['$match']['timestamp']
+        self.assertEqual(timestamps['$gte'], _ts(3000 - 600))
+
+    def test_prune(self):
+        self.now = _ts(4200)
+        accumulator = Accumulator(self.path)
+        self._measure(accumulator)
+        self.assertEqual(list(accumulator._state), ['cpu/p1'])
+
+        # another project, in the next period
+        pollster = pollsters.MongoCPUTimePollster(
+            project_id='p2', period=3600,
+            start=END, end=END + datetime.timedelta(seconds=3600))
+        with mock.patch('caos_collector.ceilometer.find_resources',
+                        return_value=[]):
+            accumulator.measure(pollster)
+
+        self.assertEqual(accumulator._state, {})
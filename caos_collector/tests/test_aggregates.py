@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import mock
+import unittest
+
+from caos_collector.aggregates import Aggregator
+from caos_collector.jobs import hypervisors_state_job
+
+
+class TestAggregator(unittest.TestCase):
+    def test_totals(self):
+        a = Aggregator(tag_key='domain', groups={
+            'p1': ['d1'],
+            'p2': ['d1'],
+            'p3': ['d2'],
+            'p4': [],
+        })
+
+        a.add('p1', 't1', [('cpu', 1.0), ('vms', 2)])
+        a.add('p2', 't1', [('cpu', 3.0)])
+        a.add('p3', 't1', [('cpu', 5.0)])
+        a.add('p4', 't1', [('cpu', 7.0)])
+        # p2 is missing
+        a.add('p1', 't2', [('cpu', 1.0)])
+        # no samples at all
+        a.add('p3', 't2', [])
+
+        self.assertEqual(a.totals(), [
+            ([{'key': 'domain', 'value': 'd1'}], 't1', 'cpu', 4.0),
+            ([{'key': 'domain', 'value': 'd1'}], 't1', 'vms', 2),
+            ([{'key': 'domain', 'value': 'd2'}], 't1', 'cpu', 5.0),
+        ])
+
+    def test_combine(self):
+        a = Aggregator(tag_key='cluster', groups={'h1': ['c'], 'h2': ['c']},
+                       combine=max)
+        a.add('h1', None, [('load', 1.0)])
+        a.add('h2', None, [('load', 3.0)])
+        self.assertEqual(a.totals(), [
+            ([{'key': 'cluster', 'value': 'c'}], None, 'load', 3.0),
+        ])
+
+
+class TestClusters(unittest.TestCase):
+    @mock.patch.object(hypervisors_state_job.openstack, 'aggregates')
+    def test_clusters(self, aggregates):
+        aggregates.return_value = {
+            'gpu': {'hosts': ['compute1'], 'availability_zone': 'az1'},
+            'ssd': {'hosts': ['compute1', 'compute2'],
+                    'availability_zone': None},
+        }
+        hypervisors = {
+            'compute1.domain': {'service': {'host': 'compute1'}},
+            'compute2.domain': {'service': {'host': 'compute2'}},
+            'compute3.domain': {'service': {'host': 'compute3'}},
+        }
+
+        clusters = hypervisors_state_job.HypervisorsStateJob()._clusters(
+            hypervisors)
+        self.assertEqual(sorted(clusters['compute1.domain']),
+                         ['aggregate/gpu', 'aggregate/ssd', 'az/az1',
+                          'cloud'])
+        self.assertEqual(clusters['compute2.domain'],
+                         ['cloud', 'aggregate/ssd'])
+        self.assertEqual(clusters['compute3.domain'], ['cloud'])
+
+        aggregates.side_effect = RuntimeError()
+        clusters = hypervisors_state_job.HypervisorsStateJob()._clusters(
+            hypervisors)
+        self.assertEqual(clusters['compute1.domain'], ['cloud'])
+
+    @mock.patch.object(hypervisors_state_job.tsdb, 'create_gauge_sample')
+    @mock.patch.object(hypervisors_state_job.openstack, 'hypervisor_uptime')
+    def test_cluster_metrics(self, hypervisor_uptime, create_gauge_sample):
+        hypervisor_uptime.return_value = {
+            'uptime': " 17:37:14 up  2:33,  3 users, "
+                      "load average: 0.33, 0.36, 0.34",
+        }
+
+        job = hypervisors_state_job.HypervisorsStateJob()
+        a = Aggregator(tag_key='cluster',
+                       groups={'h1': ['cloud'], 'h2': ['cloud']})
+        for h in ('h1', 'h2'):
+            values = job.check_hypervisor(
+                tz=None, hypervisor_host=h, cpu_ar=4, ram_ar=1.5,
+                hypervisor_data={
+                    'id': h,
+                    'status': 'enabled',
+                    'state': 'up',
+                    'vcpus': 8,
+                    'vcpus_used': 2,
+                    'running_vms': 1,
+                    'memory_mb': 1024,
+                    'memory_mb_used': 512,
+                    'local_gb': 100,
+                    'local_gb_used': 10,
+                    'free_disk_gb': 90,
+                    'disk_available_least': 80,
+                    'current_workload': 0,
+                })
+            a.add(h, None, values.items())
+
+        totals = dict((metric_name, value)
+                      for _, _, metric_name, value in a.totals())
+        self.assertEqual(sorted(totals), [
+            'hypervisor.cpus.total',
+            'hypervisor.disk.free',
+            'hypervisor.disk.total',
+            'hypervisor.disk.used',
+            'hypervisor.memory.total',
+            'hypervisor.memory.used',
+            'hypervisor.ram.total',
+            'hypervisor.vcpus.total',
+            'hypervisor.vcpus.used',
+            'hypervisor.vms.running',
+        ])
+        self.assertEqual(totals['hypervisor.vcpus.total'], 64)
+        self.assertEqual(totals['hypervisor.vms.running'], 2)
+
+        # the other metrics are still written for each hypervisor
+        self.assertEqual(create_gauge_sample.call_count, 2 * 17)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import argparse
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from caos_collector import backfill
+from caos_collector.jobs.backfill_job import BackfillJob
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_split(self):
+        start = datetime.datetime(2018, 1, 1, 10, 30)
+        end = datetime.datetime(2018, 1, 2, 0, 0)
+
+        chunks = backfill.split(start, end, period=3600, chunk=5*3600 + 10)
+        self.assertEqual(chunks, [
+            (datetime.datetime(2018, 1, 1, 10, 0),
+             datetime.datetime(2018, 1, 1, 15, 0)),
+            (datetime.datetime(2018, 1, 1, 15, 0),
+             datetime.datetime(2018, 1, 1, 20, 0)),
+            (datetime.datetime(2018, 1, 1, 20, 0),
+             datetime.datetime(2018, 1, 2, 0, 0)),
+        ])
+
+        self.assertEqual(backfill.split(end, end, 3600, 86400), [])
+
+    def test_ledger(self):
+        path = os.path.join(self.tmp_dir, 'state', 'backfill.sqlite')
+
+        ledger = backfill.Ledger(path)
+        ledger.done('unit-1')
+        self.assertTrue(ledger.is_done('unit-1'))
+        self.assertFalse(ledger.is_done('unit-2'))
+        ledger.close()
+
+        # resumed
+        ledger = backfill.Ledger(path)
+        self.assertTrue(ledger.is_done('unit-1'))
+        ledger.clear()
+        self.assertFalse(ledger.is_done('unit-1'))
+        ledger.close()
+
+    def test_progress(self):
+        progress = backfill.Progress(total=10, now=0)
+        progress.update(now=1)
+        progress.update(failed=True, now=2)
+        rate, eta = progress.update(now=4)
+
+        self.assertEqual(progress.done, 2)
+        self.assertEqual(progress.failed, 1)
+        self.assertEqual(rate, 0.75)
+        self.assertAlmostEqual(eta, 7 / 0.75)
+
+    def test_units(self):
+        parser = argparse.ArgumentParser()
+        BackfillJob.setup_parser(parser)
+        args = parser.parse_args(['-s', '2018-01-01T00:00:00Z',
+                                  '-M', 'cputime,nova_usages',
+                                  '--chunk', '86400', '-o'])
+
+        start = datetime.datetime(2018, 1, 1)
+        end = datetime.datetime(2018, 1, 3)
+        units = list(BackfillJob()._units({'p1': {}, 'p2': {}},
+                                          start, end, args))
+
+        # projects x chunks x metrics
+        self.assertEqual(len(units), 2 * 2 * 2)
+        self.assertEqual(len(set(k for k, _ in units)), 8)
+
+        key, cmdline = units[0]
+        self.assertEqual(key, "cputime/p1/3600/"
+                         "2018-01-01T00:00:00Z/2018-01-02T00:00:00Z")
+        self.assertEqual(cmdline, [
+            '--project', 'p1',
+            '--start', '2018-01-01T00:00:00Z',
+            '--end', '2018-01-02T00:00:00Z',
+            '--period', '3600',
+            '--no-nova-usages', '--no-wallclocktime',
+            '--overwrite',
+        ])
+
+    def test_unknown_metric(self):
+        parser = argparse.ArgumentParser()
+        BackfillJob.setup_parser(parser)
+        args = parser.parse_args(['-s', '2018-01-01T00:00:00Z',
+                                  '-M', 'foo'])
+
+        with self.assertRaises(RuntimeError):
+            list(BackfillJob()._units({'p1': {}}, None, None, args))
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import datetime
+import mock
+import unittest
+
+from caos_collector import cache
+from caos_collector import cfg
+from caos_collector import pollsters
+from caos_collector.jobs import vm_usage_job
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        c = cache.LRUCache('test', 2)
+        c.put('a', 1)
+        c.put('b', None)
+        self.assertEqual(c.get('a'), 1)
+
+        # b is the least recently used
+        c.put('c', 3)
+        self.assertEqual(c.get('b', 'missing'), 'missing')
+        self.assertIsNone(c.get('missing'))
+        self.assertEqual(c.get('c'), 3)
+
+        self.assertEqual(c.stats(), {
+            'size': 2,
+            'maxsize': 2,
+            'hits': 2,
+            'misses': 2,
+            'evictions': 1,
+        })
+
+    def test_disabled(self):
+        c = cache.LRUCache('test', 0)
+        c.put('a', 1)
+        self.assertEqual(len(c), 0)
+        self.assertIsNone(c.get('a'))
+
+    def test_get_cache(self):
+        c = cache.get_cache('test_get_cache', 10)
+        self.assertIs(cache.get_cache('test_get_cache', 20), c)
+        self.assertEqual(c.maxsize, 10)
+
+
+class TestHighWaterMark(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+
+    def test_high_water_mark(self):
+        start = datetime.datetime(2018, 1, 1, 10, 0, 0)
+        end = datetime.datetime(2018, 1, 1, 11, 0, 0)
+        pollster = pollsters.MongoCPUTimePollster(project_id='p1',
+                                                  period=3600,
+                                                  start=start,
+                                                  end=end)
+
+        def hwm(minutes):
+            now = start + datetime.timedelta(minutes=minutes)
+            return pollster.high_water_mark(now=now)
+
+        # an open window
+        self.assertEqual(hwm(25), start + datetime.timedelta(minutes=20))
+        self.assertEqual(hwm(29), hwm(20))
+        self.assertNotEqual(hwm(30), hwm(29))
+
+        # a closed one
+        closed = end + datetime.timedelta(minutes=10)
+        self.assertEqual(hwm(70), closed)
+        self.assertEqual(hwm(600), closed)
+
+
+class TestResultsCache(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_BACKEND = 'mongodb'
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        cfg.CEILOMETER_RESULTS_CACHE_SIZE = 10
+        cfg.CEILOMETER_RESULTS_CACHE_TTL = 0
+        cache._caches.pop('pollster_results', None)
+
+    def tearDown(self):
+        cfg.CEILOMETER_BACKEND = None
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_RESULTS_CACHE_SIZE = None
+        cfg.CEILOMETER_RESULTS_CACHE_TTL = None
+        cache._caches.pop('pollster_results', None)
+
+    def test_closed_window(self):
+        end = datetime.datetime.utcnow() - datetime.timedelta(hours=2)
+        start = end - datetime.timedelta(hours=1)
+
+        job = vm_usage_job.VMUsageJob()
+        job._measure_window = mock.Mock(return_value=3600.0)
+
+        def measure():
+            pollster = pollsters.MongoCPUTimePollster(project_id='p1',
+                                                      period=3600,
+                                                      start=start,
+                                                      end=end)
+            return job._measure(pollster)
+
+        with mock.patch('caos_collector.ceilometer.aggregate') as aggregate:
+            # e.g. the hourly usages, then series_repair
+            self.assertEqual(measure(), 3600.0)
+            self.assertEqual(measure(), 3600.0)
+
+            # the key doesn't need any query
+            self.assertFalse(aggregate.called)
+
+        self.assertEqual(job._measure_window.call_count, 1)
+        stats = cache.get_cache('pollster_results', 10).stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    @mock.patch('time.time')
+    def test_ttl(self, time):
+        time.return_value = 1000.0
+        c = cache.LRUCache('test', 2, ttl=60)
+        c.put('a', 1)
+
+        time.return_value = 1059.0
+        self.assertEqual(c.get('a'), 1)
+
+        time.return_value = 1060.0
+        self.assertIsNone(c.get('a'))
+        self.assertEqual(len(c), 0)
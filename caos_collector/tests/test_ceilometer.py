@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+
+import datetime
+import json
+import mock
+import unittest
+
+from caos_collector import ceilometer
+from caos_collector import cfg
+from caos_collector import limiter
+
+
+START = datetime.datetime(2018, 1, 1, 10, 0, 0)
+END = datetime.datetime(2018, 1, 1, 11, 0, 0)
+
+
+class FakeGnocchiApi(object):
+    def __init__(self, resources):
+        self.resources = resources
+        self.calls = []
+
+    def post(self, url, headers, data):
+        self.calls.append((url, json.loads(data)))
+
+        params = url.split('?', 1)[1].split('&')
+        limit = int(dict(p.split('=') for p in params)['limit'])
+        marker = dict(p.split('=') for p in params).get('marker')
+
+        resources = sorted(self.resources, key=lambda r: r['id'])
+        if marker is not None:
+            resources = [r for r in resources if r['id'] > marker]
+
+        response = mock.Mock()
+        response.json.return_value = resources[:limit]
+        return response
+
+
+class TestGnocchiResources(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_GNOCCHI_RESOURCES_PAGE_SIZE = 2
+
+        resources = [
+            {'id': "r{0}".format(i), 'metrics': {'cpu': "m{0}".format(i)}}
+            for i in range(5)
+        ]
+        resources.append({'id': "r5", 'metrics': {'vcpus': "m5"}})
+
+        self.backend = ceilometer.GnocchiCeilometerBackend()
+        self.backend._gnocchi = mock.Mock()
+        self.backend._gnocchi.api = FakeGnocchiApi(resources)
+
+    def tearDown(self):
+        cfg.CEILOMETER_GNOCCHI_RESOURCES_PAGE_SIZE = None
+
+    def test_find_resources(self):
+        ret = self.backend.find_resources('p1', 'cpu', START, END)
+        self.assertEqual(ret, ["r0", "r1", "r2", "r3", "r4"])
+
+        calls = self.backend._gnocchi.api.calls
+        self.assertEqual(len(calls), 4)
+        for url, query in calls:
+            self.assertIn('attrs=id', url)
+            self.assertIn('attrs=metrics', url)
+            self.assertNotIn('history', url)
+            self.assertNotIn('details', url)
+        self.assertNotIn('marker', calls[0][0])
+        self.assertIn('marker=r1', calls[1][0])
+        self.assertIn('marker=r3', calls[2][0])
+        self.assertIn('marker=r5', calls[3][0])
+
+        query = calls[0][1]
+        self.assertEqual(query['and'][0], {"=": {"project_id": "p1"}})
+        self.assertEqual(len(query['and']), 3)
+
+
+class TestMongoChunks(unittest.TestCase):
+    def test_merge_sorted(self):
+        cursors = [
+            iter([{'t': 1, 'r': 'a'}, {'t': 4, 'r': 'a'}]),
+            iter([{'t': 1, 'r': 'b'}, {'t': 2, 'r': 'b'}, {'t': 5, 'r': 'b'}]),
+            iter([]),
+            iter([{'t': 3, 'r': 'c'}]),
+        ]
+        merged = list(ceilometer.MongoCeilometerBackend.merge_sorted(
+            cursors, key='t'))
+        self.assertEqual(list((d['t'], d['r']) for d in merged),
+                         [(1, 'a'), (1, 'b'), (2, 'b'), (3, 'c'),
+                          (4, 'a'), (5, 'b')])
+
+
+class TestMongoLimits(unittest.TestCase):
+    def setUp(self):
+        cfg.LIMITS = {'mongodb': {'max_concurrency': 2}}
+        limiter._limiters.pop('mongodb', None)
+
+    def tearDown(self):
+        cfg.LIMITS = None
+        limiter._limiters.pop('mongodb', None)
+
+    def test_lazy_cursor(self):
+        l = limiter.get_limiter('mongodb')
+        in_flight = []
+
+        def cursor(*args, **kwargs):
+            # the query runs when the cursor is iterated
+            for i in range(3):
+                in_flight.append(l.in_flight)
+                yield {'_id': i}
+
+        backend = ceilometer.MongoCeilometerBackend()
+        backend._db = mock.Mock()
+        backend._db.meter.find.side_effect = cursor
+        backend._db.meter.aggregate.side_effect = cursor
+
+        self.assertEqual(len(backend.find("meter", {})), 3)
+        self.assertEqual(len(backend.aggregate("meter", [])), 3)
+
+        self.assertEqual(in_flight, [1] * 6)
+        self.assertEqual(l.stats()['in_flight'], 0)
+        self.assertEqual(l.stats()['calls'], 2)
+
+    def test_cursor_error(self):
+        def cursor(*args, **kwargs):
+            yield {'_id': 0}
+            raise RuntimeError("timeout")
+
+        backend = ceilometer.MongoCeilometerBackend()
+        backend._db = mock.Mock()
+        backend._db.meter.aggregate.side_effect = cursor
+
+        with self.assertRaises(RuntimeError):
+            backend.aggregate("meter", [])
+        self.assertEqual(limiter.get_limiter('mongodb').stats()['errors'], 1)
+
+
+class TestMongoOptions(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_MONGODB = "mongodb://localhost"
+        cfg.CEILOMETER_MONGODB_CONNECTION_TIMEOUT = 1
+        cfg.CEILOMETER_MONGODB_MAX_POOL_SIZE = 10
+        cfg.CEILOMETER_MONGODB_COMPRESSORS = "snappy,zlib"
+        cfg.CEILOMETER_MONGODB_READ_PREFERENCE = "secondaryPreferred"
+        cfg.CEILOMETER_MONGODB_BATCH_SIZE = 500
+        cfg.CEILOMETER_MONGODB_MAX_TIME_MS = 60000
+
+    def tearDown(self):
+        cfg.CEILOMETER_MONGODB = None
+        cfg.CEILOMETER_MONGODB_CONNECTION_TIMEOUT = None
+        cfg.CEILOMETER_MONGODB_MAX_POOL_SIZE = None
+        cfg.CEILOMETER_MONGODB_COMPRESSORS = None
+        cfg.CEILOMETER_MONGODB_READ_PREFERENCE = None
+        cfg.CEILOMETER_MONGODB_BATCH_SIZE = None
+        cfg.CEILOMETER_MONGODB_MAX_TIME_MS = None
+
+    @mock.patch('pymongo.MongoClient')
+    def test_options(self, client):
+        backend = ceilometer.MongoCeilometerBackend()
+        backend.initialize()
+
+        self.assertEqual(client.call_args[0], ("mongodb://localhost", ))
+        self.assertEqual(client.call_args[1], {
+            'connectTimeoutMS': 1000,
+            'serverSelectionTimeoutMS': 1000,
+            'maxPoolSize': 10,
+            'readPreference': "secondaryPreferred",
+            'compressors': "snappy,zlib",
+        })
+
+        collection = client.return_value.ceilometer.meter
+        backend.find("meter", {})
+        self.assertEqual(collection.find.call_args[1],
+                         {'batch_size': 500, 'max_time_ms': 60000})
+
+        backend.aggregate("meter", [])
+        self.assertEqual(collection.aggregate.call_args[1],
+                         {'allowDiskUse': True,
+                          'batchSize': 500,
+                          'maxTimeMS': 60000})
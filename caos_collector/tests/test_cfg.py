@@ -134,3 +134,19 @@ class TestCfg(unittest.TestCase):
 
         value = cfg._get_int("my_other_other_var", default=56, required=True, env_var='MY_OTHER_OTHER_VAR')
         self.assertEqual(value, 56)
+
+    @mock.patch('caos_collector.cfg._config', {'t': True, 'f': False, 's': 'yes', 'x': 'maybe'})
+    @mock.patch.dict('os.environ', {'MY_VAR': 'off'})
+    def test_get_bool(self):
+        self.assertIs(cfg._get_bool("t", default=False), True)
+        self.assertIs(cfg._get_bool("f", default=True), False)
+        self.assertIs(cfg._get_bool("s"), True)
+        self.assertIs(cfg._get_bool("my_var", default=True, env_var='MY_VAR'), False)
+        self.assertIs(cfg._get_bool("my_other_var", default=True, required=False), True)
+        self.assertIsNone(cfg._get_bool("my_other_var", required=False))
+
+        with self.assertRaisesRegexp(RuntimeError, "Cannot convert option `x` to `bool`"):
+            cfg._get_bool("x")
+
+        with self.assertRaisesRegexp(RuntimeError, "Required option `.*` not found"):
+            cfg._get_bool("my_other_var")
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import mock
+import threading
+import time
+import unittest
+
+from caos_collector import cfg
+from caos_collector import limiter
+
+
+class TestLimiter(unittest.TestCase):
+    def test_aimd(self):
+        l = limiter.Limiter('test', max_concurrency=8, latency_target=1.0)
+        self.assertEqual(l.stats()['limit'], 8)
+
+        l.acquire()
+        l.release(latency=0.1, error=True)
+        self.assertEqual(l.stats()['limit'], 4)
+
+        # slow calls
+        l.acquire()
+        l.release(latency=2.0)
+        l.acquire()
+        l.release(latency=2.0)
+        self.assertEqual(l.stats()['limit'], 1)
+
+        # one more every `limit` calls
+        for _ in range(3):
+            l.acquire()
+            l.release(latency=0.1)
+        self.assertEqual(l.stats()['limit'], 2)
+
+        self.assertEqual(l.stats(), {
+            'limit': 2,
+            'in_flight': 0,
+            'calls': 6,
+            'errors': 1,
+            'decreases': 3,
+        })
+
+    def test_concurrency(self):
+        l = limiter.Limiter('test', max_concurrency=3)
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def call():
+            with l.slot():
+                with lock:
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight[1], in_flight[0])
+                time.sleep(0.01)
+                with lock:
+                    in_flight[0] -= 1
+
+        threads = list(threading.Thread(target=call) for _ in range(10))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(in_flight[1], 3)
+        self.assertEqual(l.stats()['calls'], 10)
+
+    def test_slot_error(self):
+        l = limiter.Limiter('test', max_concurrency=2)
+        with self.assertRaises(ValueError):
+            with l.slot():
+                raise ValueError()
+        self.assertEqual(l.stats()['in_flight'], 0)
+        self.assertEqual(l.stats()['limit'], 1)
+
+    def test_rate(self):
+        l = limiter.Limiter('test', max_concurrency=2, rate=100, burst=2)
+        with mock.patch('time.sleep') as sleep:
+            for _ in range(3):
+                with l.slot():
+                    pass
+
+        # the third call waits for a token
+        self.assertTrue(sleep.called)
+
+    def test_options(self):
+        cfg.LIMITS = {
+            'default': {'max_concurrency': 4},
+            'nova': {'rate': 10},
+        }
+        self.addCleanup(setattr, cfg, 'LIMITS', None)
+
+        options = limiter._options('nova')
+        self.assertEqual(options['max_concurrency'], 4)
+        self.assertEqual(options['rate'], 10)
+        self.assertEqual(limiter._options('tsdb')['rate'],
+                         cfg.DEFAULT_LIMITS_RATE)
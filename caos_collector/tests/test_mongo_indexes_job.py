@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+
+import datetime
+import unittest
+
+from bson import SON
+
+from caos_collector.jobs import mongo_indexes_job
+
+
+class TestMongoIndexes(unittest.TestCase):
+    def test_analyze_explain(self):
+        explain = {
+            'queryPlanner': {
+                'winningPlan': {
+                    'stage': 'SORT',
+                    'inputStage': {
+                        'stage': 'FETCH',
+                        'inputStage': {
+                            'stage': 'IXSCAN',
+                            'indexName': 'project_id_1',
+                        },
+                    },
+                },
+            },
+            'executionStats': {
+                'nReturned': 10,
+                'totalDocsExamined': 1000,
+                'totalKeysExamined': 1000,
+            },
+        }
+
+        report = mongo_indexes_job.analyze_explain(explain)
+        self.assertFalse(report['collscan'])
+        self.assertTrue(report['blocking_sort'])
+        self.assertEqual(report['indexes'], ['project_id_1'])
+        self.assertEqual(report['ratio'], 100.0)
+
+        explain['queryPlanner']['winningPlan'] = {'stage': 'COLLSCAN'}
+        report = mongo_indexes_job.analyze_explain(explain)
+        self.assertTrue(report['collscan'])
+        self.assertEqual(report['indexes'], [])
+
+    def test_recommend_index(self):
+        ts = datetime.datetime(2018, 1, 1)
+        query = SON([
+            ('resource_id', {'$in': ['r1', 'r2']}),
+            ('project_id', 'p1'),
+            ('counter_name', 'cpu'),
+            ('timestamp', {'$gte': ts, '$lte': ts}),
+            ('source', 'openstack'),
+        ])
+
+        keys = mongo_indexes_job.recommend_index(
+            query, sort=[('timestamp', 1)])
+        self.assertEqual(keys, [
+            ('project_id', 1),
+            ('counter_name', 1),
+            ('source', 1),
+            ('timestamp', 1),
+            ('resource_id', 1),
+        ])
+
+        # without a sort, $in is an equality match
+        keys = mongo_indexes_job.recommend_index(query)
+        self.assertEqual(keys[0], ('resource_id', 1))
+        self.assertEqual(keys[-1], ('timestamp', 1))
+
+    def test_has_index(self):
+        index_information = {
+            '_id_': {'key': [('_id', 1)]},
+            'meter_idx': {'key': [('project_id', 1.0),
+                                  ('counter_name', 1.0),
+                                  ('timestamp', 1.0)]},
+        }
+
+        self.assertTrue(mongo_indexes_job.has_index(
+            index_information, [('project_id', 1), ('counter_name', 1)]))
+        self.assertFalse(mongo_indexes_job.has_index(
+            index_information, [('counter_name', 1)]))
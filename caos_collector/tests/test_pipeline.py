@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import threading
+import time
+import unittest
+
+from caos_collector.pipeline import Pipeline
+from caos_collector.pipeline import Stage
+
+
+class TestPipeline(unittest.TestCase):
+    def test_run(self):
+        written = []
+        lock = threading.Lock()
+
+        def write(item):
+            with lock:
+                written.append(item)
+
+        stages = [
+            Stage('fetch', lambda i: i, workers=4),
+            # odd items are dropped
+            Stage('compute', lambda i: i * 10 if i % 2 == 0 else None,
+                  workers=2),
+            Stage('write', write, workers=3),
+        ]
+        Pipeline(stages, queue_size=2).run(iter(range(100)))
+
+        self.assertEqual(sorted(written),
+                         list(i * 10 for i in range(0, 100, 2)))
+        self.assertEqual(list(s.processed for s in stages), [100, 100, 50])
+        for s in stages:
+            self.assertLessEqual(s.max_depth, 2)
+
+    def test_backpressure(self):
+        produced = []
+
+        def items():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        def slow_write(item):
+            # the producer can't get ahead of the bounded queues
+            self.assertLessEqual(len(produced), item + 1 + 3 * 2 + 3)
+            time.sleep(0.001)
+
+        stages = [
+            Stage('fetch', lambda i: i),
+            Stage('write', slow_write),
+        ]
+        Pipeline(stages, queue_size=2).run(items())
+        self.assertEqual(stages[1].processed, 10)
+
+    def test_error(self):
+        def fail(item):
+            if item == 3:
+                raise ValueError("failed on {i}".format(i=item))
+            return item
+
+        stages = [
+            Stage('fetch', fail, workers=2),
+            Stage('write', lambda i: None),
+        ]
+        with self.assertRaisesRegexp(ValueError, "failed on 3"):
+            Pipeline(stages, queue_size=1).run(iter(range(1000)))
+
+        # the remaining items are discarded
+        self.assertLess(stages[0].processed, 1000)
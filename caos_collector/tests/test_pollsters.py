@@ -0,0 +1,743 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import bson
+import copy
+import datetime
+import mock
+import unittest
+
+from bson.raw_bson import RawBSONDocument
+
+from caos_collector import ceilometer
+from caos_collector import cfg
+from caos_collector import pollsters
+
+
+START = datetime.datetime(2018, 1, 1, 10, 0, 0)
+END = datetime.datetime(2018, 1, 1, 11, 0, 0)
+
+
+def _gnocchi_group(project_id, resource_id, measures):
+    return {
+        'group': {
+            'project_id': project_id,
+            'id': resource_id,
+        },
+        'measures': list(
+            (START + datetime.timedelta(seconds=t),
+             300.0, v) for t, v in measures),
+    }
+
+
+def _gnocchi_backend():
+    backend = ceilometer.GnocchiCeilometerBackend()
+    backend._gnocchi = mock.Mock()
+    backend.find = mock.Mock()
+    return backend
+
+
+class TestGnocchiPollsters(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = 300
+        cfg.CEILOMETER_GNOCCHI_FETCH_CHUNK = 86400
+
+        backend = _gnocchi_backend()
+        patcher = mock.patch('caos_collector.ceilometer._ceilometer_backend',
+                             backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.find = backend.find
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = None
+        cfg.CEILOMETER_GNOCCHI_FETCH_CHUNK = None
+
+    def _pollster(self, project_id='p1'):
+        return pollsters.GnocchiCPUTimePollster(project_id=project_id,
+                                                period=3600,
+                                                start=START,
+                                                end=END)
+
+    def test_measure_projects_single_query(self):
+        find = self.find
+        find.return_value = [
+            # 1 cpu second every second
+            _gnocchi_group('p1', 'r1', [(-600, 0), (4200, 4800e9)]),
+            _gnocchi_group('p1', 'r2', [(-600, 0), (4200, 2400e9)]),
+            _gnocchi_group('p2', 'r3', [(-600, 0), (4200, 1200e9)]),
+            # not enough samples
+            _gnocchi_group('p3', 'r4', [(0, 0)]),
+        ]
+
+        values = self._pollster(project_id=None).measure_projects(
+            ['p1', 'p2', 'p3'])
+
+        self.assertEqual(find.call_count, 1)
+        kwargs = find.call_args[1]
+        self.assertEqual(kwargs['groupby'], ["project_id", "id"])
+        self.assertEqual(kwargs['query']['and'][0],
+                         {"in": {"project_id": ['p1', 'p2', 'p3']}})
+
+        self.assertEqual(values, {'p1': 3600 + 1800, 'p2': 900})
+
+    def test_measure(self):
+        find = self.find
+        find.return_value = [
+            _gnocchi_group('p1', 'r1', [(-600, 0), (4200, 4800e9)]),
+        ]
+
+        self.assertEqual(self._pollster().measure(), 3600)
+
+        find.return_value = []
+        self.assertIsNone(self._pollster().measure())
+
+
+class TestGnocchiGranularity(unittest.TestCase):
+    # like ceilometer-high
+    DEFINITION = [
+        (1.0, 3600.0),
+        (60.0, 86400.0),
+        (3600.0, 365 * 86400.0),
+    ]
+
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = 'auto'
+        cfg.CEILOMETER_GNOCCHI_MIN_POINTS_PER_PERIOD = 12
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = None
+        cfg.CEILOMETER_GNOCCHI_MIN_POINTS_PER_PERIOD = None
+
+    def _granularity(self, period, end):
+        pollster = pollsters.GnocchiCPUTimePollster(
+            project_id='p1',
+            period=period,
+            start=end - datetime.timedelta(seconds=period),
+            end=end)
+        return pollster.select_granularity()
+
+    @mock.patch('caos_collector.ceilometer.archive_policy')
+    def test_auto(self, archive_policy):
+        archive_policy.return_value = self.DEFINITION
+        now = datetime.datetime.utcnow().replace(minute=0, second=0,
+                                                 microsecond=0)
+
+        # 1s is lost after 1h, 3600s would give one point per period
+        self.assertEqual(self._granularity(3600, now), 60)
+        self.assertEqual(self._granularity(86400, now), 3600)
+
+        # 60s are already lost
+        old = now - datetime.timedelta(days=2)
+        self.assertEqual(self._granularity(3600, old), 3600)
+
+    @mock.patch('caos_collector.ceilometer.archive_policy')
+    def test_fixed(self, archive_policy):
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = 300
+        self.assertEqual(self._granularity(86400, END), 300)
+        self.assertFalse(archive_policy.called)
+
+    @mock.patch('caos_collector.ceilometer.archive_policy')
+    def test_no_policy(self, archive_policy):
+        archive_policy.return_value = None
+        self.assertEqual(self._granularity(3600, END),
+                         cfg.DEFAULT_CEILOMETER_GNOCCHI_FALLBACK_GRANULARITY)
+
+
+def _gnocchi_aggregates(project_id, measures):
+    return {
+        'group': {
+            'project_id': project_id,
+        },
+        'measures': {
+            'measures': {
+                'aggregated': list(
+                    (START + datetime.timedelta(seconds=t), 300.0, v)
+                    for t, v in measures),
+            },
+        },
+    }
+
+
+class TestGnocchiAggregatesPollsters(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = "300"
+        cfg.CEILOMETER_GNOCCHI_FETCH_CHUNK = 86400
+
+        backend = _gnocchi_backend()
+        patcher = mock.patch('caos_collector.ceilometer._ceilometer_backend',
+                             backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.find = backend.find
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = None
+        cfg.CEILOMETER_GNOCCHI_FETCH_CHUNK = None
+
+    @mock.patch('caos_collector.ceilometer.aggregates')
+    def test_cpu_time(self, aggregates):
+        find = self.find
+        # 1 cpu second every second, as rateofchange over 300s
+        aggregates.return_value = [
+            _gnocchi_aggregates('p1', list(
+                (t, 300e9) for t in range(300, 3900, 300))),
+        ]
+        find.return_value = [
+            _gnocchi_group('p1', 'r1', [(-600, 0), (4200, 4800e9)]),
+        ]
+
+        pollster = pollsters.GnocchiAggregatesCPUTimePollster(
+            project_id=None, period=3600, start=START, end=END)
+        values = pollster.measure_projects(['p1'])
+
+        self.assertEqual(aggregates.call_count, 1)
+        kwargs = aggregates.call_args[1]
+        self.assertEqual(kwargs['groupby'], ["project_id"])
+        self.assertEqual(kwargs['granularity'], 300)
+        self.assertIn("(rateofchange (metric cpu mean))", kwargs['operations'])
+
+        reference = pollster.reference_class(
+            project_id=None, period=3600, start=START, end=END)
+        reference_values = reference.measure_projects(['p1'])
+
+        self.assertAlmostEqual(values['p1'], reference_values['p1'],
+                               delta=reference_values['p1'] * 0.05)
+        self.assertEqual(values, {'p1': 3600})
+
+    @mock.patch('caos_collector.ceilometer.aggregates')
+    def test_wallclock_time(self, aggregates):
+        find = self.find
+        # 2 vcpus for the whole period
+        aggregates.return_value = [
+            _gnocchi_aggregates('p1', list(
+                (t, 2) for t in range(-300, 3900, 300))),
+        ]
+        find.return_value = [
+            _gnocchi_group('p1', 'r1', [(-600, 2), (4200, 2)]),
+        ]
+
+        pollster = pollsters.GnocchiAggregatesWallClockTimeOcataPollster(
+            project_id=None, period=3600, start=START, end=END)
+        values = pollster.measure_projects(['p1'])
+
+        reference = pollster.reference_class(
+            project_id=None, period=3600, start=START, end=END)
+        reference_values = reference.measure_projects(['p1'])
+
+        self.assertEqual(values, {'p1': 7200})
+        self.assertEqual(values, reference_values)
+
+
+class TestGnocchiMultiMeter(unittest.TestCase):
+    MEASURES = {
+        'cpu': {
+            ('p1', 'r1'): [(-600, 0), (1800, 1800e9), (4200, 4800e9)],
+            ('p1', 'r2'): [(-600, 0), (4200, 2400e9)],
+            ('p2', 'r3'): [(-600, 0), (4200, 1200e9)],
+        },
+        'vcpus': {
+            ('p1', 'r1'): [(-600, 2), (1800, 2), (4200, 2)],
+            ('p1', 'r2'): [(-600, 1), (1200, 4), (4200, 4)],
+            ('p2', 'r3'): [(-600, 1), (4200, 1)],
+        },
+    }
+
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = 300
+        cfg.CEILOMETER_GNOCCHI_FETCH_CHUNK = 86400
+
+        self.backend = _gnocchi_backend()
+        self.backend.find.side_effect = self._find
+        self.backend._gnocchi.aggregates.fetch.side_effect = self._fetch
+        patcher = mock.patch('caos_collector.ceilometer._ceilometer_backend',
+                             self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = None
+        cfg.CEILOMETER_GNOCCHI_FETCH_CHUNK = None
+
+    def _find(self, metrics, **kwargs):
+        return list(
+            _gnocchi_group(project_id, resource_id, measures)
+            for (project_id, resource_id), measures
+            in sorted(self.MEASURES[metrics].items()))
+
+    def _fetch(self, operations, **kwargs):
+        groups = {}
+        for counter_name, resources in self.MEASURES.items():
+            if "({meter} mean)".format(meter=counter_name) not in operations:
+                continue
+            for (project_id, resource_id), measures in resources.items():
+                group = groups.setdefault(project_id, {})
+                group.setdefault(resource_id, {})[counter_name] = {
+                    'mean': _gnocchi_group(project_id, resource_id,
+                                           measures)['measures'],
+                }
+
+        return list({
+            'group': {'project_id': project_id},
+            'measures': {'measures': resources},
+        } for project_id, resources in groups.items())
+
+    def test_measure_projects(self):
+        pollster_classes = (pollsters.GnocchiCPUTimePollster,
+                            pollsters.GnocchiWallClockTimeOcataPollster)
+
+        multi_meter = pollsters.GnocchiMultiMeterPollster(list(
+            pollster_class(project_id=None, period=3600,
+                           start=START, end=END)
+            for pollster_class in pollster_classes))
+        values = multi_meter.measure_projects(['p1', 'p2'])
+
+        fetch = self.backend._gnocchi.aggregates.fetch
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(fetch.call_args[1]['operations'],
+                         "(metric (cpu mean) (vcpus mean))")
+        self.assertEqual(self.backend.find.call_count, 0)
+
+        for pollster_class in pollster_classes:
+            pollster = pollster_class(project_id=None, period=3600,
+                                      start=START, end=END)
+            reference_values = pollster.measure_projects(['p1', 'p2'])
+            self.assertEqual(values[pollster.counter_name], reference_values)
+
+        self.assertEqual(values['cpu'], {'p1': 3600 + 1800, 'p2': 900})
+
+
+class FakeGnocchiMetric(object):
+    """ Serves the measures of a few resources with one cpu second
+    every second and a vcpus change in the middle. """
+
+    def __init__(self, granularity=300):
+        self.granularity = granularity
+        self.calls = []
+
+    def aggregation(self, metrics, start, stop, granularity, **kwargs):
+        self.calls.append((start, stop))
+
+        ret = []
+        for project_id, resource_id in (('p1', 'r1'), ('p1', 'r2'),
+                                        ('p2', 'r3')):
+            measures = []
+            t = START - datetime.timedelta(days=2)
+            while t <= END + datetime.timedelta(days=2):
+                if start <= t <= stop:
+                    x = (t - START).total_seconds()
+                    if metrics == 'cpu':
+                        # cputime reset in the middle
+                        v = x if x < 3000 else x - 3000
+                        v = (v + 1e6) * 1e9
+                    else:
+                        v = 1 if x < 1800 else 2
+                    measures.append((t, granularity, v))
+                t += datetime.timedelta(seconds=granularity)
+
+            ret.append({
+                'group': {'project_id': project_id, 'id': resource_id},
+                'measures': measures,
+            })
+        return ret
+
+
+class TestGnocchiChunks(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = 300
+        cfg.CEILOMETER_GNOCCHI_FETCH_WORKERS = 3
+
+        self.backend = ceilometer.GnocchiCeilometerBackend()
+        self.backend._gnocchi = mock.Mock()
+        self.backend._gnocchi.metric = FakeGnocchiMetric()
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_GNOCCHI_POLICY_GRANULARITY = None
+        cfg.CEILOMETER_GNOCCHI_FETCH_CHUNK = None
+        cfg.CEILOMETER_GNOCCHI_FETCH_WORKERS = None
+
+    def _measure(self, pollster_class, chunk):
+        cfg.CEILOMETER_GNOCCHI_FETCH_CHUNK = chunk
+        pollster = pollster_class(project_id=None,
+                                  period=86400,
+                                  start=START - datetime.timedelta(days=1),
+                                  end=END + datetime.timedelta(days=1))
+
+        with mock.patch('caos_collector.ceilometer._ceilometer_backend',
+                        self.backend):
+            return (pollster.measure_projects(['p1', 'p2']),
+                    pollster.find_samples(['p1', 'p2']))
+
+    def test_chunks(self):
+        for pollster_class in (pollsters.GnocchiCPUTimePollster,
+                               pollsters.GnocchiWallClockTimeOcataPollster):
+            self.backend._gnocchi.metric = FakeGnocchiMetric()
+            values, grouped = self._measure(pollster_class, chunk=10 ** 6)
+            self.assertEqual(len(self.backend._gnocchi.metric.calls), 2)
+
+            chunked_values, chunked_grouped = self._measure(pollster_class,
+                                                            chunk=3600)
+            self.assertEqual(len(self.backend._gnocchi.metric.calls), 2 + 2 * 50)
+
+            self.assertEqual(set(values.keys()), set(['p1', 'p2']))
+            for project_id in values:
+                self.assertAlmostEqual(values[project_id],
+                                       chunked_values[project_id])
+
+            # only the needed samples are kept
+            for project_id in grouped:
+                for resource_id in grouped[project_id]:
+                    self.assertLessEqual(
+                        len(grouped[project_id][resource_id]), 8)
+                    self.assertEqual(
+                        grouped[project_id][resource_id],
+                        chunked_grouped[project_id][resource_id])
+
+    def test_fold_counter(self):
+        values, _ = self._measure(pollsters.GnocchiCPUTimePollster,
+                                  chunk=3600)
+        # the reset is corrected, but the increment across it is lost
+        self.assertAlmostEqual(values['p2'], 2 * 86400 + 3600 - 300)
+
+
+def _mongo_samples(resource_id, values, key, step=600):
+    samples = []
+    for i, v in enumerate(values):
+        sample = {
+            'resource_id': resource_id,
+            'timestamp': START + datetime.timedelta(seconds=i * step - 1200),
+        }
+        if key == 'resource_metadata.vcpus':
+            sample['resource_metadata'] = {'vcpus': v, 'status': 'active'}
+        else:
+            sample[key] = v
+        samples.append(sample)
+    return samples
+
+
+class TestMongoPollsters(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        # r1 and r2 in a chunk, r3 in another one
+        cfg.CEILOMETER_MONGODB_IN_CHUNK = 2
+        cfg.CEILOMETER_MONGODB_QUERY_WORKERS = 2
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_MONGODB_IN_CHUNK = None
+        cfg.CEILOMETER_MONGODB_QUERY_WORKERS = None
+
+    def _measure(self, pollster_class, docs, key):
+        # what the $project stage returns
+        raw_docs = sorted(
+            (RawBSONDocument(bson.BSON.encode({
+                'resource_id': d['resource_id'],
+                'timestamp': d['timestamp'],
+                'value': d.get('resource_metadata', d)[key.split('.')[-1]],
+            })) for d in docs),
+            key=lambda d: d['timestamp'])
+
+        def aggregate(dbname, pipeline, raw):
+            resources = pipeline[0]['$match']['resource_id']['$in']
+            return iter(list(
+                d for d in raw_docs if d['resource_id'] in resources))
+
+        backend = ceilometer.MongoCeilometerBackend()
+        backend.aggregate = mock.Mock(side_effect=aggregate)
+
+        pollster = pollster_class(project_id='p1',
+                                  period=3600,
+                                  start=START,
+                                  end=END)
+        with mock.patch('caos_collector.ceilometer._ceilometer_backend',
+                        backend), \
+                mock.patch('caos_collector.ceilometer.find_resources',
+                           return_value=['r1', 'r2', 'r3']):
+            value = pollster.measure()
+
+        self.assertEqual(backend.aggregate.call_count, 2)
+        self.assertEqual(backend.aggregate.call_args[1], {'raw': True})
+        pipeline = backend.aggregate.call_args[0][1]
+        self.assertEqual(
+            pipeline[-1]['$project'],
+            {'_id': 0, 'resource_id': 1, 'timestamp': 1, 'value': '$' + key})
+        return value
+
+    def _expected(self, pollster_class, docs, key):
+        pollster = pollster_class(project_id='p1',
+                                  period=3600,
+                                  start=START,
+                                  end=END)
+
+        ret = 0
+        for resource_id in ('r1', 'r2', 'r3'):
+            samples = list({
+                'timestamp': d['timestamp'],
+                key: d.get('resource_metadata', d).get(key.split('.')[-1]),
+            } for d in copy.deepcopy(docs) if d['resource_id'] == resource_id)
+            v = pollster.aggregate_resource(samples, key=key)
+            if v is not None:
+                ret += v
+        return ret
+
+    def test_cpu_time(self):
+        key = 'counter_volume'
+        docs = (_mongo_samples('r1', [i * 600e9 for i in range(10)], key)
+                # reset of the counter
+                + _mongo_samples('r2', [0, 300e9, 600e9, 0, 600e9, 1200e9,
+                                        1800e9, 2400e9, 3000e9, 3600e9], key)
+                # not enough samples
+                + _mongo_samples('r3', [0], key))
+
+        value = self._measure(pollsters.MongoCPUTimePollster, docs, key)
+        self.assertAlmostEqual(
+            value,
+            self._expected(pollsters.MongoCPUTimePollster, docs, key))
+        self.assertAlmostEqual(value, 3600 + 3000)
+
+    def test_wallclock_time(self):
+        for pollster_class, key in (
+                (pollsters.MongoWallClockTimePollster,
+                 'resource_metadata.vcpus'),
+                (pollsters.MongoWallClockTimeOcataPollster,
+                 'counter_volume')):
+            docs = (_mongo_samples('r1', [2] * 10, key)
+                    + _mongo_samples('r2', [1, 1, 1, 4, 4, 4, 4, 2, 2, 2], key)
+                    + _mongo_samples('r3', [1], key))
+
+            value = self._measure(pollster_class, docs, key)
+            self.assertAlmostEqual(
+                value,
+                self._expected(pollster_class, docs, key))
+
+
+class TestMongoMultiMeter(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        cfg.CEILOMETER_MONGODB_IN_CHUNK = 1000
+        cfg.CEILOMETER_MONGODB_QUERY_WORKERS = 1
+
+        self.docs = []
+        for counter_name, value in (('cpu', 600e9), ('instance', 2)):
+            for resource_id in ('r1', 'r2'):
+                for i in range(10):
+                    doc = {
+                        'resource_id': resource_id,
+                        'counter_name': counter_name,
+                        'timestamp': (START + datetime.timedelta(
+                            seconds=i * 600 - 1200)),
+                        'counter_volume': value * i,
+                        'resource_metadata': {
+                            'vcpus': value,
+                            # the first samples are not active
+                            'status': 'active' if i else 'building',
+                        },
+                    }
+                    self.docs.append(doc)
+        self.docs.sort(key=lambda d: d['timestamp'])
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_MONGODB_IN_CHUNK = None
+        cfg.CEILOMETER_MONGODB_QUERY_WORKERS = None
+
+    @staticmethod
+    def _eval(expression, doc):
+        # evaluate the $project expressions of the pipeline
+        if isinstance(expression, dict):
+            condition, then, otherwise = expression['$cond']
+            field, value = condition['$eq']
+            if TestMongoMultiMeter._eval(field, doc) == value:
+                return TestMongoMultiMeter._eval(then, doc)
+            return TestMongoMultiMeter._eval(otherwise, doc)
+
+        value = doc
+        for k in expression[1:].split('.'):
+            value = value[k]
+        return value
+
+    @staticmethod
+    def _match(query, doc):
+        for field, condition in query.items():
+            if field == '$or':
+                if not any(TestMongoMultiMeter._match(q, doc)
+                           for q in condition):
+                    return False
+                continue
+
+            value = TestMongoMultiMeter._eval('$' + field, doc)
+            if isinstance(condition, dict):
+                if '$in' in condition and value not in condition['$in']:
+                    return False
+                if '$gte' in condition and value < condition['$gte']:
+                    return False
+                if '$lte' in condition and value > condition['$lte']:
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def _aggregate(self, dbname, pipeline, raw):
+        match, _, project = pipeline
+        query = dict(match['$match'])
+        query.pop('project_id')
+        query.pop('source')
+
+        value = project['$project']['value']
+        return iter(list(
+            RawBSONDocument(bson.BSON.encode({
+                'resource_id': d['resource_id'],
+                'counter_name': d['counter_name'],
+                'timestamp': d['timestamp'],
+                'value': self._eval(value, d),
+            })) for d in self.docs if self._match(query, d)))
+
+    def test_measure(self):
+        backend = ceilometer.MongoCeilometerBackend()
+        backend.aggregate = mock.Mock(side_effect=self._aggregate)
+
+        pollster_classes = (pollsters.MongoCPUTimePollster,
+                            pollsters.MongoWallClockTimePollster)
+
+        with mock.patch('caos_collector.ceilometer._ceilometer_backend',
+                        backend), \
+                mock.patch('caos_collector.ceilometer.find_resources',
+                           return_value=['r1', 'r2']) as find_resources:
+            multi_meter = pollsters.MongoMultiMeterPollster(list(
+                pollster_class(project_id='p1', period=3600,
+                               start=START, end=END)
+                for pollster_class in pollster_classes))
+            values = multi_meter.measure()
+
+            self.assertEqual(find_resources.call_count, 1)
+            self.assertEqual(find_resources.call_args[1]['meter'],
+                             ['cpu', 'instance'])
+            self.assertEqual(backend.aggregate.call_count, 1)
+
+            for pollster_class in pollster_classes:
+                pollster = pollster_class(project_id='p1', period=3600,
+                                          start=START, end=END)
+                self.assertAlmostEqual(values[pollster.counter_name],
+                                       pollster.measure())
+
+        self.assertAlmostEqual(values['cpu'], 2 * 3600)
+
+
+class TestAdaptiveMargin(unittest.TestCase):
+    def setUp(self):
+        cfg.CEILOMETER_POLLING_PERIOD = 600
+        cfg.CEILOMETER_ADAPTIVE_MARGIN = True
+        cfg.CEILOMETER_MONGODB_IN_CHUNK = 1000
+        cfg.CEILOMETER_MONGODB_QUERY_WORKERS = 1
+        pollsters._cadences.clear()
+
+        # samples every 300s, but r2 misses the ones right before the
+        # start of the window
+        self.docs = []
+        for resource_id in ('r1', 'r2'):
+            for t in range(-600, 4200 + 1, 300):
+                if resource_id == 'r2' and -600 < t < 300:
+                    continue
+                self.docs.append({
+                    'resource_id': resource_id,
+                    'timestamp': START + datetime.timedelta(seconds=t),
+                    'value': (t + 600) * 1e9,
+                })
+        self.docs.sort(key=lambda d: d['timestamp'])
+
+    def tearDown(self):
+        cfg.CEILOMETER_POLLING_PERIOD = None
+        cfg.CEILOMETER_ADAPTIVE_MARGIN = None
+        cfg.CEILOMETER_MONGODB_IN_CHUNK = None
+        cfg.CEILOMETER_MONGODB_QUERY_WORKERS = None
+        pollsters._cadences.clear()
+
+    def _aggregate(self, dbname, pipeline, raw):
+        query = pipeline[0]['$match']
+        resources = query['resource_id']['$in']
+        timestamps = query['timestamp']
+        return iter(list(
+            RawBSONDocument(bson.BSON.encode(d)) for d in self.docs
+            if d['resource_id'] in resources
+            and timestamps['$gte'] <= d['timestamp'] <= timestamps['$lte']))
+
+    def _measure(self):
+        backend = ceilometer.MongoCeilometerBackend()
+        backend.aggregate = mock.Mock(side_effect=self._aggregate)
+
+        pollster = pollsters.MongoCPUTimePollster(project_id='p1',
+                                                  period=3600,
+                                                  start=START,
+                                                  end=END)
+        with mock.patch('caos_collector.ceilometer._ceilometer_backend',
+                        backend), \
+                mock.patch('caos_collector.ceilometer.find_resources',
+                           return_value=['r1', 'r2']):
+            value = pollster.measure()
+        return value, backend.aggregate.call_args_list
+
+    def test_margin(self):
+        # the first measure uses the polling period and learns the
+        # cadence
+        value, calls = self._measure()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(pollsters._cadences[('cpu', 'p1')], 300)
+
+        # the second one uses the cadence, and retries r2
+        adaptive_value, calls = self._measure()
+        self.assertEqual(len(calls), 2)
+
+        timestamps = calls[0][0][1][0]['$match']['timestamp']
+        self.assertEqual(timestamps['$gte'],
+                         START - datetime.timedelta(seconds=330))
+
+        retry = calls[1][0][1][0]['$match']
+        self.assertEqual(retry['resource_id']['$in'], ['r2'])
+        self.assertEqual(retry['timestamp']['$gte'],
+                         START - datetime.timedelta(seconds=600))
+
+        self.assertAlmostEqual(value, adaptive_value)
+        self.assertAlmostEqual(value, 2 * 3600)
+
+    def test_disabled(self):
+        cfg.CEILOMETER_ADAPTIVE_MARGIN = False
+        self._measure()
+        _, calls = self._measure()
+        self.assertEqual(len(calls), 1)
+
+        timestamps = calls[0][0][1][0]['$match']['timestamp']
+        self.assertEqual(timestamps['$gte'],
+                         START - datetime.timedelta(seconds=600))
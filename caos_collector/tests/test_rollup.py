@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import argparse
+import datetime
+import mock
+import unittest
+
+from caos_collector import rollup
+from caos_collector.jobs import rollup_job
+
+
+def h(hour):
+    return datetime.datetime(2018, 1, 1) + datetime.timedelta(hours=hour)
+
+
+def samples(*points):
+    return list({'timestamp': h(t), 'value': v} for t, v in points)
+
+
+class TestRollup(unittest.TestCase):
+    def test_windows(self):
+        self.assertEqual(rollup.windows(86400, h(0), h(53)),
+                         [(h(0), h(24)), (h(24), h(48))])
+        self.assertEqual(rollup.windows(86400, h(3), h(48)),
+                         [(h(0), h(24)), (h(24), h(48))])
+        self.assertEqual(rollup.windows(86400, h(24), h(47)), [])
+
+    def test_delta(self):
+        s = samples((1, 1.0), (2, 2.0), (24, 4.0), (25, 8.0))
+        self.assertEqual(rollup.delta(s, h(0), h(24)), 7.0)
+        self.assertEqual(rollup.delta(s, h(24), h(48)), 8.0)
+        self.assertIsNone(rollup.delta(s, h(48), h(72)))
+
+    def test_gauge(self):
+        # 10 up to 6, then 20 up to 18, then 40
+        s = samples((-5, 10.0), (6, 20.0), (18, 40.0))
+
+        self.assertEqual(rollup.gauge(s, h(0), h(24), 'min'), 10.0)
+        self.assertEqual(rollup.gauge(s, h(0), h(24), 'max'), 40.0)
+        self.assertEqual(rollup.gauge(s, h(0), h(24), 'last'), 40.0)
+        self.assertEqual(rollup.gauge(s, h(0), h(24), 'avg'),
+                         (10.0 * 6 + 20.0 * 12 + 40.0 * 6) / 24)
+
+        # only the value before the window
+        self.assertEqual(rollup.gauge(s, h(24), h(48), 'avg'), 40.0)
+        self.assertIsNone(rollup.gauge(s, h(-24), h(-6), 'avg'))
+
+        with self.assertRaises(RuntimeError):
+            rollup.gauge(s, h(0), h(24), 'median')
+
+
+class TestRollupJob(unittest.TestCase):
+    @mock.patch.object(rollup_job.tsdb, 'create_sample')
+    @mock.patch.object(rollup_job.tsdb, 'samples')
+    @mock.patch.object(rollup_job.tsdb, 'last_timestamp')
+    def test_rollup_series(self, last_timestamp, tsdb_samples,
+                           create_sample):
+        # the daily series is empty, the hourly one is up to 60
+        last_timestamp.side_effect = lambda tags, metric_name, period: {
+            86400: datetime.datetime(1970, 1, 1),
+            3600: h(60),
+        }[period]
+        tsdb_samples.return_value = samples(*((t, 1.0)
+                                              for t in range(1, 61)))
+
+        parser = argparse.ArgumentParser()
+        rollup_job.RollupJob.setup_parser(parser)
+        args = parser.parse_args(['-s', '2018-01-01T00:00:00Z'])
+
+        tags = [{'key': 'project', 'value': 'p1'}]
+        rollup_job.RollupJob().rollup_series(tags, 'cpu', None, start=h(0),
+                                             now=h(70), args=args)
+
+        self.assertEqual(tsdb_samples.call_args[1]['period'], 3600)
+        self.assertEqual(create_sample.call_args_list, [
+            mock.call(metric_name='cpu', period=86400, tags=tags,
+                      timestamp=h(24), value=24.0, overwrite=False),
+            mock.call(metric_name='cpu', period=86400, tags=tags,
+                      timestamp=h(48), value=24.0, overwrite=False),
+        ])
+
+    @mock.patch.object(rollup_job.tsdb, 'create_sample')
+    @mock.patch.object(rollup_job.tsdb, 'samples')
+    @mock.patch.object(rollup_job.tsdb, 'last_timestamp')
+    def test_rollup_series_missing(self, last_timestamp, tsdb_samples,
+                                   create_sample):
+        last_timestamp.side_effect = lambda tags, metric_name, period: {
+            86400: datetime.datetime(1970, 1, 1),
+            3600: h(60),
+        }[period]
+        # the sample of hour 30 is missing
+        tsdb_samples.return_value = samples(*((t, 1.0)
+                                              for t in range(1, 61)
+                                              if t != 30))
+
+        parser = argparse.ArgumentParser()
+        rollup_job.RollupJob.setup_parser(parser)
+        args = parser.parse_args(['-s', '2018-01-01T00:00:00Z'])
+        self.assertEqual(rollup.missing(tsdb_samples.return_value, 3600,
+                                        h(24), h(48)), [h(30)])
+
+        tags = [{'key': 'project', 'value': 'p1'}]
+        job = rollup_job.RollupJob()
+
+        # the second day is waiting for its missing sample
+        job.rollup_series(tags, 'cpu', None, start=h(0), now=h(70),
+                          args=args)
+        self.assertEqual(create_sample.call_args_list, [
+            mock.call(metric_name='cpu', period=86400, tags=tags,
+                      timestamp=h(24), value=24.0, overwrite=False),
+        ])
+
+        # and is rolled up without it after a day
+        create_sample.reset_mock()
+        job.rollup_series(tags, 'cpu', None, start=h(0), now=h(72),
+                          args=args)
+        self.assertEqual(create_sample.call_args_list, [
+            mock.call(metric_name='cpu', period=86400, tags=tags,
+                      timestamp=h(24), value=24.0, overwrite=False),
+            mock.call(metric_name='cpu', period=86400, tags=tags,
+                      timestamp=h(48), value=23.0, overwrite=False),
+        ])
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import argparse
+import datetime
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from caos_collector.jobs import series_repair_job
+
+
+def h(hour):
+    return datetime.datetime(2018, 1, 1, hour, 0)
+
+
+class TestSeriesRepair(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_ranges(self):
+        ranges = series_repair_job.ranges([h(1), h(2), h(3), h(5), h(7),
+                                           h(8)], 3600)
+        self.assertEqual(ranges, [(h(1), h(3)), (h(5), h(5)), (h(7), h(8))])
+        self.assertEqual(series_repair_job.ranges([], 3600), [])
+
+    @mock.patch.object(series_repair_job.SeriesRepairJob, '_repair')
+    @mock.patch.object(series_repair_job.tsdb, 'samples')
+    @mock.patch.object(series_repair_job.openstack, 'project')
+    def test_run(self, project, samples, repair):
+        project.return_value = {'p1': {'name': 'project 1'}}
+        samples.return_value = list({'timestamp': h(i), 'value': 1.0}
+                                    for i in [1, 2, 4, 5])
+
+        parser = argparse.ArgumentParser()
+        series_repair_job.SeriesRepairJob.setup_parser(parser)
+        args = parser.parse_args(['-p', 'p1', '-M', 'cputime',
+                                  '-s', '2018-01-01T01:00:00Z',
+                                  '-e', '2018-01-01T08:00:00Z',
+                                  '--ledger', os.path.join(self.tmp_dir,
+                                                           'ledger.sqlite')])
+
+        series_repair_job.SeriesRepairJob()._run(args)
+
+        self.assertEqual(samples.call_args[1]['metric_name'], 'cpu')
+        self.assertEqual(repair.call_args_list, [
+            mock.call('p1', 'cputime', h(3), h(3), 3600),
+            mock.call('p1', 'cputime', h(6), h(7), 3600),
+        ])
+
+        # the gaps which are still there (e.g. an idle project) are not
+        # tried again
+        repair.reset_mock()
+        series_repair_job.SeriesRepairJob()._run(args)
+        self.assertFalse(repair.called)
+
+        args.restart = True
+        series_repair_job.SeriesRepairJob()._run(args)
+        self.assertEqual(repair.call_count, 2)
+        self.assertTrue(samples.call_args[1]['create'])
+
+    @mock.patch.object(series_repair_job.SeriesRepairJob, '_repair')
+    @mock.patch.object(series_repair_job.tsdb, 'samples')
+    @mock.patch.object(series_repair_job.openstack, 'project')
+    def test_dry_run(self, project, samples, repair):
+        project.return_value = {'p1': {'name': 'project 1'}}
+        # e.g. the series doesn't exist
+        samples.return_value = []
+
+        parser = argparse.ArgumentParser()
+        series_repair_job.SeriesRepairJob.setup_parser(parser)
+        args = parser.parse_args(['-p', 'p1', '-M', 'cputime', '-n',
+                                  '-s', '2018-01-01T01:00:00Z',
+                                  '-e', '2018-01-01T08:00:00Z',
+                                  '--ledger', os.path.join(self.tmp_dir,
+                                                           'ledger.sqlite')])
+
+        series_repair_job.SeriesRepairJob()._run(args)
+
+        self.assertFalse(samples.call_args[1]['create'])
+        self.assertFalse(repair.called)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from caos_collector import cfg
+from caos_collector import sharding
+
+
+KEYS = list("project-{i}".format(i=i) for i in range(1000))
+
+
+class TestHashRing(unittest.TestCase):
+    def test_owner(self):
+        ring = sharding.HashRing(['a', 'b', 'c'])
+        owners = dict((k, ring.owner(k)) for k in KEYS)
+
+        # every member gets its share
+        for member in ['a', 'b', 'c']:
+            n = sum(1 for o in owners.values() if o == member)
+            self.assertTrue(200 < n < 500, n)
+
+        self.assertEqual(sharding.HashRing(['c', 'a', 'b']).owner(KEYS[0]),
+                         owners[KEYS[0]])
+
+    def test_consistency(self):
+        ring = sharding.HashRing(['a', 'b', 'c'])
+        ring4 = sharding.HashRing(['a', 'b', 'c', 'd'])
+
+        # only the keys moving to the new member change owner
+        for k in KEYS:
+            if ring4.owner(k) != 'd':
+                self.assertEqual(ring4.owner(k), ring.owner(k))
+
+    def test_empty(self):
+        self.assertIsNone(sharding.HashRing([]).owner('project'))
+
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        cfg.SHARDING_ENABLED = True
+        cfg.SHARDING_STORE = 'sqlite'
+        cfg.SHARDING_STORE_PATH = os.path.join(self.tmp_dir, 'sharding.sqlite')
+        cfg.SHARDING_LEASE_TTL = 300
+        cfg.SHARDING_REPLICAS = 100
+        cfg.SHARDING_MEMBER_ID = 'a'
+
+        sharding._store = None
+        sharding._last_heartbeat = None
+        sharding.join()
+
+    def tearDown(self):
+        cfg.SHARDING_ENABLED = None
+        sharding._store = None
+        sharding._last_heartbeat = None
+        sharding._joined = False
+        shutil.rmtree(self.tmp_dir)
+
+    def _owned_by(self, member_id):
+        cfg.SHARDING_MEMBER_ID = member_id
+        sharding._last_heartbeat = None
+        return sharding.owned(KEYS)
+
+    def test_disabled(self):
+        cfg.SHARDING_ENABLED = False
+        self.assertEqual(sharding.owned(KEYS), KEYS)
+
+    def test_not_joined(self):
+        # e.g. a one-off job, while another collector is in the ring
+        sharding.leave()
+        sharding._get_store().heartbeat('b', 300)
+
+        cfg.SHARDING_MEMBER_ID = 'c'
+        self.assertEqual(sharding.owned(KEYS), KEYS)
+        self.assertEqual(sharding._get_store().members(), ['b'])
+
+    def test_single_member(self):
+        self.assertEqual(sharding.owned(KEYS), KEYS)
+        self.assertEqual(sharding._get_store().members(), ['a'])
+
+    def test_partition(self):
+        # join the ring
+        sharding._get_store().heartbeat('b', 300)
+        sharding._get_store().heartbeat('c', 300)
+
+        owned = list(self._owned_by(m) for m in ['a', 'b', 'c'])
+
+        self.assertEqual(sorted(sum(owned, [])), sorted(KEYS))
+        for o in owned:
+            self.assertTrue(len(o) > 0)
+
+    def test_lease(self):
+        store = sharding._get_store()
+        store.heartbeat('b', -1)
+        self.assertEqual(sharding.owned(KEYS), KEYS)
+
+        store.heartbeat('b', 300)
+        self.assertNotEqual(self._owned_by('a'), KEYS)
+
+        sharding.leave()
+        self.assertEqual(store.members(), ['b'])
+
+        cfg.SHARDING_MEMBER_ID = 'b'
+        sharding.join()
+        self.assertEqual(self._owned_by('b'), KEYS)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import threading
+import time
+import unittest
+
+from caos_collector import singleflight
+
+
+class TestSingleFlight(unittest.TestCase):
+    def _run_concurrently(self, func, n):
+        results = []
+        lock = threading.Lock()
+
+        def call():
+            try:
+                r = func()
+            except Exception as e:
+                r = e
+            with lock:
+                results.append(r)
+
+        threads = list(threading.Thread(target=call) for _ in range(n))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_coalesced(self):
+        calls = []
+        group = singleflight.Group('test')
+
+        def lookup(tags):
+            calls.append(tags)
+            time.sleep(0.05)
+            return {'id': 's1'}
+
+        results = self._run_concurrently(
+            lambda: group.do('key', lookup, tags=[]), 5)
+
+        self.assertEqual(results, [{'id': 's1'}] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(group.stats(), {'calls': 5, 'coalesced': 4})
+
+        # later calls aren't coalesced
+        group.do('key', lookup, tags=[])
+        self.assertEqual(len(calls), 2)
+
+    def test_error(self):
+        group = singleflight.Group('test')
+
+        def fail():
+            time.sleep(0.05)
+            raise ValueError("failed")
+
+        results = self._run_concurrently(lambda: group.do('key', fail), 3)
+        self.assertEqual(len(results), 3)
+        for r in results:
+            self.assertIsInstance(r, ValueError)
+
+    def test_decorator(self):
+        calls = []
+
+        @singleflight.coalesced('test_decorator')
+        def series(tags, metric_name):
+            calls.append(metric_name)
+            time.sleep(0.05)
+            return metric_name
+
+        tags = [{'key': 'project', 'value': 'p1'}]
+        results = self._run_concurrently(
+            lambda: series(tags=tags, metric_name='cpu'), 3)
+        self.assertEqual(results, ['cpu'] * 3)
+        self.assertEqual(calls, ['cpu'])
+
+    def test_freeze(self):
+        self.assertEqual(
+            singleflight.freeze({'b': [1, {'c': 2}], 'a': None}),
+            (('a', None), ('b', (1, (('c', 2), )))))
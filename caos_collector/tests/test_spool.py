@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import datetime
+import json
+import os
+import requests_mock
+import shutil
+import tempfile
+import unittest
+
+from caos_collector import cfg
+from caos_collector import spool
+from caos_collector import tsdb
+
+
+CAOS_TSDB_API_ENDPOINT = "http://some-url"
+
+TIMESTAMP = datetime.datetime(2018, 1, 1, 10, 0, 0)
+
+
+def _enqueue(s, value):
+    return s.enqueue(metric_name='cpu', period=3600,
+                     tags=[{'key': 'project', 'value': 'p1'}],
+                     timestamp=TIMESTAMP, value=value, overwrite=True)
+
+
+class TestSpool(unittest.TestCase):
+    def setUp(self):
+        cfg.CAOS_TSDB_API_URL = CAOS_TSDB_API_ENDPOINT
+        tsdb.initialize()
+
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'spool', 'spool.sqlite')
+
+    def tearDown(self):
+        tsdb.set_spool(None)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_enqueue(self):
+        s = spool.Spool(self.path, max_samples=2)
+        self.assertTrue(_enqueue(s, 1.0))
+        self.assertTrue(_enqueue(s, 2.0))
+        self.assertFalse(_enqueue(s, 3.0))
+
+        batch = s.peek(10)
+        self.assertEqual(list(sample['value'] for _, sample in batch),
+                         [1.0, 2.0])
+        self.assertEqual(batch[0][1]['timestamp'], TIMESTAMP)
+
+        s.ack([batch[0][0]])
+        s.close()
+
+        # the samples survive a restart
+        s = spool.Spool(self.path, max_samples=2, synchronous='full')
+        self.assertEqual(len(s), 1)
+        self.assertEqual(s.peek(10)[0][1]['value'], 2.0)
+        s.close()
+
+    @requests_mock.Mocker()
+    def test_flush(self, m):
+        s = spool.Spool(self.path, max_samples=0)
+        tsdb.set_spool(s)
+        for v in range(5):
+            tsdb.create_sample(metric_name='cpu', period=3600,
+                               tags=[{'key': 'project', 'value': 'p1'}],
+                               timestamp=TIMESTAMP, value=float(v),
+                               overwrite=True)
+        self.assertEqual(len(s), 5)
+        self.assertFalse(m.called)
+
+        sample = {'timestamp': '2018-01-01T10:00:00Z', 'value': 0.0}
+        m.post(CAOS_TSDB_API_ENDPOINT + "/graphql", json={
+            'data': dict(('sample{i}'.format(i=i), sample)
+                         for i in range(2))})
+
+        self.assertEqual(spool.flush(s, batch_size=2), 5)
+        self.assertEqual(len(s), 0)
+        self.assertEqual(m.call_count, 3)
+
+        request = json.loads(m.request_history[0].text)
+        self.assertIn('sample1: create_sample(series: $series1',
+                      request['query'])
+        self.assertEqual(request['variables']['value1'], 1.0)
+        self.assertEqual(request['variables']['timestamp0'],
+                         '2018-01-01T10:00:00Z')
+        self.assertEqual(request['variables']['series0']['period'], 3600)
+        s.close()
+
+    @requests_mock.Mocker()
+    def test_flush_error(self, m):
+        s = spool.Spool(self.path, max_samples=0)
+        _enqueue(s, 1.0)
+
+        m.post(CAOS_TSDB_API_ENDPOINT + "/graphql", status_code=500,
+               json={'errors': ['some error']})
+        with self.assertRaises(tsdb.GraphqlError):
+            spool.flush(s, batch_size=10)
+
+        # kept for the next drain
+        self.assertEqual(len(s), 1)
+        s.close()
+
+    @requests_mock.Mocker()
+    def test_flush_request_failed(self, m):
+        s = spool.Spool(self.path, max_samples=0)
+        _enqueue(s, 1.0)
+        _enqueue(s, 2.0)
+
+        m.post(CAOS_TSDB_API_ENDPOINT + "/graphql", json={
+            'data': None,
+            'errors': [{'message': 'some error'}]})
+        with self.assertRaises(tsdb.GraphqlError):
+            spool.flush(s, batch_size=10)
+
+        # the whole batch is kept for the next drain
+        self.assertEqual(list(sample['value'] for _, sample in s.peek(10)),
+                         [1.0, 2.0])
+        s.close()
+
+    @requests_mock.Mocker()
+    def test_flush_rejected(self, m):
+        s = spool.Spool(self.path, max_samples=0)
+        _enqueue(s, 1.0)
+        _enqueue(s, 2.0)
+
+        sample = {'timestamp': '2018-01-01T10:00:00Z', 'value': 2.0}
+        m.post(CAOS_TSDB_API_ENDPOINT + "/graphql", json={
+            'data': {'sample0': None, 'sample1': sample},
+            'errors': [{'message': 'bad sample', 'path': ['sample0']}]})
+
+        # only the rejected sample is dropped
+        self.assertEqual(spool.flush(s, batch_size=10), 2)
+        self.assertEqual(len(s), 0)
+        s.close()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+import requests_mock
+import threading
+import unittest
+
+from caos_collector import cfg
+from caos_collector import transport
+from caos_collector import tsdb
+
+
+CAOS_TSDB_API_ENDPOINT = "http://some-url"
+
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        cfg.CAOS_TSDB_API_URL = CAOS_TSDB_API_ENDPOINT
+        cfg.HTTP_POOL_SIZE = 4
+        cfg.HTTP_WORKERS = 8
+        tsdb.initialize()
+
+    def tearDown(self):
+        transport.shutdown()
+        cfg.HTTP_POOL_SIZE = None
+        cfg.HTTP_WORKERS = None
+
+    def test_session(self):
+        session = transport.session()
+        self.assertIs(transport.session(), session)
+
+        adapter = session.get_adapter(CAOS_TSDB_API_ENDPOINT)
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+    @requests_mock.Mocker()
+    def test_graphql_async(self, m):
+        threads = set()
+
+        def callback(request, context):
+            threads.add(threading.current_thread().name)
+            return {'data': {'query': request.json()['query']}}
+
+        m.post(CAOS_TSDB_API_ENDPOINT + "/graphql", json=callback)
+
+        futures = list(tsdb.graphql_async("query {i}".format(i=i))
+                       for i in range(20))
+        results = list(f.result() for f in futures)
+
+        self.assertEqual(results,
+                         list({'query': "query {i}".format(i=i)}
+                              for i in range(20)))
+        self.assertEqual(m.call_count, 20)
+        self.assertLessEqual(len(threads), 8)
+        self.assertNotIn(threading.current_thread().name, threads)
+
+    @requests_mock.Mocker()
+    def test_graphql_async_error(self, m):
+        m.post(CAOS_TSDB_API_ENDPOINT + "/graphql", json={'errors': ['e']})
+
+        future = tsdb.graphql_async("query")
+        with self.assertRaises(tsdb.GraphqlError):
+            future.result()
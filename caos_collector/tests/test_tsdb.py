@@ -168,3 +168,81 @@ class TestTsdb(unittest.TestCase):
                 logs.check(
                     ('caos-collector.caos_collector.tsdb', 'ERROR', "GRAPHQL response has no `data`: raising..."),
                 )
+
+    @requests_mock.Mocker()
+    def test_create_gauge_sample(self, m):
+        import datetime
+
+        cfg.CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL = 3600
+        tsdb._gauges.clear()
+        self.addCleanup(tsdb._gauges.clear)
+        self.addCleanup(setattr, cfg, 'CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL',
+                        None)
+
+        mock_tsdb_graphql(m, data={'sample': {}})
+        t0 = datetime.datetime(2018, 1, 1, 10, 0, 0)
+        tags = [{'key': 'project', 'value': 'p1'}]
+
+        def create(minutes, value, tags=tags):
+            tsdb.create_gauge_sample(
+                metric_name='quota.vcpus', tags=tags,
+                timestamp=t0 + datetime.timedelta(minutes=minutes),
+                value=value)
+            return m.call_count
+
+        self.assertEqual(create(0, 10), 1)
+        # unchanged
+        self.assertEqual(create(10, 10), 1)
+        # another series
+        self.assertEqual(create(10, 10, tags=[]), 2)
+        # changed
+        self.assertEqual(create(20, 20), 3)
+        self.assertEqual(create(30, 20), 3)
+        # keyframe
+        self.assertEqual(create(80, 20), 4)
+
+        cfg.CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL = 0
+        self.assertEqual(create(90, 20), 5)
+
+    @requests_mock.Mocker()
+    def test_samples(self, m):
+        import datetime
+
+        m.post(CAOS_TSDB_API_ENDPOINT + "/graphql", [
+            {'json': {'data': {'series': {'id': 's1'}}}},
+            {'json': {'data': {'series': {'samples': [
+                {'timestamp': '2018-01-01T10:00:00Z', 'value': 1.0},
+            ]}}}},
+        ])
+
+        samples = tsdb.samples(tags=[{'key': 'project', 'value': 'p2'}],
+                               metric_name='cpu', period=3600,
+                               start=datetime.datetime(2018, 1, 1),
+                               end=datetime.datetime(2018, 1, 2))
+
+        self.assertEqual(samples, [{
+            'timestamp': datetime.datetime(2018, 1, 1, 10, 0, 0),
+            'value': 1.0,
+        }])
+        self.assertEqual(m.last_request.json()['variables'], {
+            'id': 's1',
+            'from': '2018-01-01T00:00:00Z',
+            'to': '2018-01-02T00:00:00Z',
+        })
+
+    @requests_mock.Mocker()
+    def test_samples_no_series(self, m):
+        import datetime
+
+        m.post(CAOS_TSDB_API_ENDPOINT + "/graphql",
+               json={'data': {'series': None}})
+
+        samples = tsdb.samples(tags=[{'key': 'project', 'value': 'p2'}],
+                               metric_name='cpu', period=3600,
+                               start=datetime.datetime(2018, 1, 1),
+                               end=datetime.datetime(2018, 1, 2),
+                               create=False)
+
+        self.assertEqual(samples, [])
+        self.assertEqual(m.call_count, 1)
+        self.assertNotIn('mutation', m.last_request.json()['query'])
@@ -24,6 +24,7 @@
 #
 ################################################################################
 
+import datetime
 import unittest
 
 from caos_collector import utils
@@ -94,3 +95,41 @@ class TestUtils(unittest.TestCase):
 
         value = utils.deep_merge(a, b)
         self.assertEqual(value, expected)
+
+    def test_timedelta_seconds(self):
+        cases = [
+            (None, None),
+            (300, 300.0),
+            ("300.0", 300.0),
+            ("0:05:00", 300.0),
+            ("1 day, 0:00:00", 86400.0),
+            ("30 days, 1:00:30.5", 30 * 86400 + 3630.5),
+        ]
+
+        for value, expected in cases:
+            self.assertEqual(utils.timedelta_seconds(value), expected)
+
+        with self.assertRaises(RuntimeError):
+            utils.timedelta_seconds("five minutes")
+
+    def test_missing_timestamps(self):
+        start = datetime.datetime(2018, 1, 1, 10, 30)
+        end = datetime.datetime(2018, 1, 1, 16, 0)
+
+        def h(hour):
+            return datetime.datetime(2018, 1, 1, hour, 0)
+
+        missing = utils.missing_timestamps(
+            3600, start, end, [h(11), h(12), h(14)])
+        self.assertEqual(missing, [h(13), h(15)])
+
+        self.assertEqual(utils.missing_timestamps(3600, start, end, []),
+                         utils.timeline(3600, start, end))
+
+        # the slot before an unaligned start is never expected
+        start = datetime.datetime(2018, 1, 1, 16, 23, 45)
+        end = datetime.datetime(2018, 1, 1, 20, 0)
+        self.assertEqual(utils.missing_timestamps(3600, start, end, []),
+                         [h(17), h(18), h(19)])
+        self.assertEqual(utils.missing_timestamps(
+            3600, start, end, [h(17), h(18), h(19)]), [])
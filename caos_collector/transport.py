@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+################################################################################
+#
+# caos-collector - CAOS collector
+#
+# Copyright © 2018 INFN - Istituto Nazionale di Fisica Nucleare (Italy)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+# Author: Fabrizio Chiarello <fabrizio.chiarello@pd.infn.it>
+#
+################################################################################
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import requests
+
+import cfg
+import log
+
+
+logger = log.get_logger(__name__)
+
+
+_session = None
+_executor = None
+_lock = threading.Lock()
+
+
+def session():
+    """ The requests.Session shared by the REST calls to caos-tsdb and
+    openstack, keeping up to HTTP_POOL_SIZE connections to each
+    host. """
+
+    global _session
+
+    with _lock:
+        if _session is None:
+            pool_size = cfg.HTTP_POOL_SIZE or 10
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def executor():
+    """ The executor running the *_async calls, with up to
+    HTTP_WORKERS requests in flight. """
+
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=cfg.HTTP_WORKERS or 10)
+        return _executor
+
+
+def submit(func, *args, **kwargs):
+    """ Call __func__ in the executor, returning a
+    concurrent.futures.Future. """
+
+    return executor().submit(func, *args, **kwargs)
+
+
+def shutdown():
+    global _session
+    global _executor
+
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -32,7 +32,10 @@ import semver
 from uuid import uuid4
 
 import cfg
+import limiter
 import log
+import singleflight
+import transport
 import utils
 
 
@@ -77,6 +80,14 @@ __jwt_auth = JWTAuth()
 _caos_tsdb_api_url = None
 _token = None
 
+# when set, samples are enqueued here instead of being written (see
+# spool.py)
+_spool = None
+
+# the last (timestamp, value) written to each gauge series, see
+# create_gauge_sample()
+_gauges = {}
+
 
 def initialize():
     global _caos_tsdb_api_url
@@ -85,6 +96,12 @@ def initialize():
         _caos_tsdb_api_url = cfg.CAOS_TSDB_API_URL
 
 
+def set_spool(spool):
+    global _spool
+
+    _spool = spool
+
+
 def _check_version_rules(version, rules):
     ret = True
     for rule in rules:
@@ -153,7 +170,7 @@ def refresh_token():
 
 
 def _request(rest_type, api, data=None, params=None, return_data=True):
-    fun = getattr(requests, rest_type)
+    fun = getattr(transport.session(), rest_type)
     url = "%s/%s" % (_caos_tsdb_api_url, api)
     request_id = generate_request_id()
 
@@ -166,7 +183,9 @@ def _request(rest_type, api, data=None, params=None, return_data=True):
                          params=params, json=data))
     r = None
     try:
-        r = fun(url, json=data, params=params, auth=__jwt_auth, headers=headers)
+        with limiter.get_limiter('tsdb').slot():
+            r = fun(url, json=data, params=params, auth=__jwt_auth,
+                    headers=headers)
     except requests.exceptions.ConnectionError as e:
         raise ConnectionError(e)
 
@@ -193,7 +212,7 @@ def post(api, *args, **kwargs):
     return _request(rest_type='post', api=api, *args, **kwargs)
 
 
-def graphql(query, variables={}):
+def _graphql_response(query, variables={}):
     data = {
         'query': query,
         'variables': variables
@@ -219,7 +238,16 @@ def graphql(query, variables={}):
         raise GraphqlError("GRAPHQL response has no `data`: json={json}"
                            .format(json=json))
 
-    return json['data']
+    return json
+
+
+def graphql(query, variables={}):
+    return _graphql_response(query, variables)['data']
+
+
+def graphql_async(query, variables={}):
+    """ Like graphql(), but returns a concurrent.futures.Future. """
+    return transport.submit(graphql, query, variables)
 
 
 def status():
@@ -359,6 +387,7 @@ def create_metric(name, type=""):
     return graphql(query)['metric']
 
 
+@singleflight.coalesced('get_or_create_series')
 def get_or_create_series(tags, metric_name, period):
     query = '''
 mutation($period: Int!, $metric: MetricPrimary!, $tags: [TagPrimary!]!) {
@@ -390,7 +419,56 @@ mutation($period: Int!, $metric: MetricPrimary!, $tags: [TagPrimary!]!) {
     return r
 
 
+def find_series(tags, metric_name, period):
+    """ Like get_or_create_series(), but None if the series doesn't
+    exist. """
+
+    query = '''
+query($period: Int!, $metric: MetricPrimary!, $tags: [TagPrimary!]!) {
+  series(period: $period, metric: $metric, tags: $tags) {
+    id
+    period
+    metric {
+      name
+    }
+    tags {
+      key
+      value
+    }
+    last_timestamp
+    ttl
+  }
+}
+'''
+
+    variables = {
+        'metric': {
+            'name': metric_name
+        },
+        'period': period,
+        'tags': tags
+    }
+
+    return graphql(query, variables)['series']
+
+
 def create_sample(metric_name, period, tags, timestamp, value, overwrite=False):
+    # the sample is written later by the spool drainer, unless the
+    # spool is full
+    if _spool is not None and _spool.enqueue(
+            metric_name=metric_name, period=period, tags=tags,
+            timestamp=timestamp, value=value, overwrite=overwrite):
+        logger.info("Spooling new sample for metric {metric}, period {period}, "
+                    "tags {tags}, timestamp {timestamp}, value {value}, "
+                    "overwrite {overwrite}"
+                    .format(metric=metric_name,
+                            period=period,
+                            tags=tags,
+                            timestamp=timestamp,
+                            value=value,
+                            overwrite=overwrite))
+        return None
+
     query = '''
 mutation($series: SeriesPrimary!, $timestamp: Datetime!, $value: Float!, $overwrite: Boolean) {
   sample: create_sample(series: $series, timestamp: $timestamp, value: $value, overwrite: $overwrite) {
@@ -426,6 +504,113 @@ mutation($series: SeriesPrimary!, $timestamp: Datetime!, $value: Float!, $overwr
     return graphql(query, variables)['sample']
 
 
+def create_samples(samples):
+    """ Create many samples with a single request.
+
+    __samples__ is a list of dicts with the arguments of
+    create_sample(). Each one is an aliased create_sample mutation,
+    the result is the list of the created samples (None for the ones
+    rejected with an error of their own).
+
+    If the whole request fails (no data, or errors not bound to a
+    sample) GraphqlError is raised, since none of the samples can be
+    considered as written.
+    """
+
+    if not samples:
+        return []
+
+    declarations = []
+    mutations = []
+    variables = {}
+    for i, s in enumerate(samples):
+        declarations.append(
+            "$series{i}: SeriesPrimary!, $timestamp{i}: Datetime!, "
+            "$value{i}: Float!, $overwrite{i}: Boolean".format(i=i))
+        mutations.append(
+            "  sample{i}: create_sample(series: $series{i}, "
+            "timestamp: $timestamp{i}, value: $value{i}, "
+            "overwrite: $overwrite{i}) {{\n"
+            "    timestamp\n"
+            "    value\n"
+            "  }}".format(i=i))
+
+        variables['series{i}'.format(i=i)] = {
+            'metric': {
+                'name': s['metric_name']
+            },
+            'period': s['period'],
+            'tags': s['tags'],
+        }
+        variables['timestamp{i}'.format(i=i)] = utils.format_date(
+            s['timestamp'])
+        variables['value{i}'.format(i=i)] = s['value']
+        variables['overwrite{i}'.format(i=i)] = s.get('overwrite', False)
+
+    query = "mutation({declarations}) {{\n{mutations}\n}}".format(
+        declarations=", ".join(declarations),
+        mutations="\n".join(mutations))
+
+    logger.info("Creating {n} new samples".format(n=len(samples)))
+
+    json = _graphql_response(query, variables)
+    data = json['data']
+    errors = json.get('errors') or []
+
+    # the aliases of the samples with an error of their own
+    rejected = set()
+    for error in errors:
+        path = error.get('path') if isinstance(error, dict) else None
+        if not path:
+            data = None
+            break
+        rejected.add(path[0])
+
+    if data is None:
+        raise GraphqlError("GRAPHQL request failed: json={json}"
+                           .format(json=json))
+
+    results = []
+    for i in range(len(samples)):
+        alias = 'sample{i}'.format(i=i)
+        if alias in rejected:
+            results.append(None)
+        elif data.get(alias) is None:
+            raise GraphqlError("GRAPHQL response misses `{alias}`: "
+                               "json={json}".format(alias=alias, json=json))
+        else:
+            results.append(data[alias])
+    return results
+
+
+def create_gauge_sample(metric_name, tags, timestamp, value):
+    """ Create a sample of a gauge, i.e. a series with period 0.
+
+    The sample is skipped if the value didn't change since the last
+    one written, unless CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL seconds
+    passed since then. A keyframe interval of 0 writes every sample.
+    """
+
+    key = (metric_name,
+           tuple(sorted((t['key'], t['value']) for t in tags)))
+
+    interval = cfg.CAOS_TSDB_GAUGE_KEYFRAME_INTERVAL
+    last = _gauges.get(key)
+    if interval and last is not None:
+        last_timestamp, last_value = last
+        elapsed = (timestamp - last_timestamp).total_seconds()
+        if last_value == value and 0 <= elapsed < interval:
+            logger.debug("Skipping unchanged sample for metric {metric}, "
+                         "tags {tags}, value {value}"
+                         .format(metric=metric_name, tags=tags, value=value))
+            return None
+
+    r = create_sample(metric_name=metric_name, period=0, tags=tags,
+                      timestamp=timestamp, value=value)
+    _gauges[key] = (timestamp, value)
+    return r
+
+
 def last_timestamp(tags, metric_name, period):
     last_timestamp = get_or_create_series(tags=tags,
                                           metric_name=metric_name,
@@ -459,3 +644,46 @@ def sample(tags, metric_name, period, timestamp):
     '''.format(series_id=series_id, timestamp=utils.format_date(timestamp))
 
     return graphql(query)['series']['sample']
+
+
+def samples(tags, metric_name, period, start, end, create=True):
+    """ The samples of the series between __start__ and __end__, with
+    parsed timestamps.
+
+    If __create__ is False, a missing series is not created and has
+    no samples.
+    """
+
+    if create:
+        series = get_or_create_series(tags=tags,
+                                      metric_name=metric_name,
+                                      period=period)
+    else:
+        series = find_series(tags=tags, metric_name=metric_name,
+                             period=period)
+        if series is None:
+            return []
+    series_id = series['id']
+
+    query = '''
+query($id: ID!, $from: Datetime, $to: Datetime) {
+  series(id: $id) {
+    samples(from: $from, to: $to) {
+      timestamp
+      value
+    }
+  }
+}
+'''
+
+    variables = {
+        'id': series_id,
+        'from': utils.format_date(start),
+        'to': utils.format_date(end),
+    }
+
+    r = graphql(query, variables)['series']['samples'] or []
+    return list({
+        'timestamp': utils.parse_date(s['timestamp']),
+        'value': s['value'],
+    } for s in r)
@@ -24,9 +24,12 @@
 #
 ################################################################################
 
+import collections
 import datetime
 import math
+import re
 from collections import Mapping
+from multiprocessing.pool import ThreadPool
 from operator import add
 
 import numpy
@@ -53,6 +56,40 @@ def parse_date(date):
     return datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
 
 
+_TIMEDELTA_REGEX = re.compile(
+    r"^((?P<days>\d+) days?, )?(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+(\.\d+)?)$")  # noqa: E501
+
+
+def timedelta_seconds(value):
+    """Converts a timedelta, in seconds or formatted like
+    `str(datetime.timedelta)` (e.g. '1 day, 0:05:00'), to seconds.
+
+    >>> timedelta_seconds('0:05:00')
+    300.0
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, (int, long, float)):
+        return float(value)
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    match = _TIMEDELTA_REGEX.match(value)
+    if match is None:
+        raise RuntimeError("Cannot parse timedelta `{value}`"
+                           .format(value=value))
+
+    return datetime.timedelta(
+        days=int(match.group('days') or 0),
+        hours=int(match.group('hours')),
+        minutes=int(match.group('minutes')),
+        seconds=float(match.group('seconds'))).total_seconds()
+
+
 # Based on
 # https://stackoverflow.com/questions/7402573/use-type-information-to-cast-values-stored-as-strings
 def convert(value, type_):
@@ -132,6 +169,44 @@ def timeline(period, start=EPOCH, end=datetime.datetime.utcnow()):
     return grid
 
 
+def missing_timestamps(period, start, end, timestamps):
+    """ The timestamps of timeline(period, start, end) which are not
+    in __timestamps__. """
+
+    grid = numpy.array(list((t - EPOCH).total_seconds()
+                            for t in timeline(period, start, end)),
+                       dtype=float)
+
+    existing = numpy.array(list((t - EPOCH).total_seconds()
+                                for t in timestamps), dtype=float)
+
+    missing = numpy.setdiff1d(grid, existing, assume_unique=True)
+    return list(EPOCH + datetime.timedelta(seconds=int(t))
+                for t in missing)
+
+
+def imap_bounded(func, iterable, workers):
+    """Like itertools.imap(), but calls `func` in up to `workers`
+    threads.
+
+    Results are yielded in order and at most `workers` of them are
+    pending at any time, so that memory stays bounded even if the
+    consumer is slower than the producers.
+    """
+    pool = ThreadPool(workers)
+    try:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item, )))
+            if len(pending) >= workers:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
 def interp(x, y, x0, left=None, right=None):
     # check order
     if not numpy.all(numpy.diff(x) > 0):